@@ -0,0 +1,164 @@
+"""
+Async (ASGI) read endpoints of the catalog. The products answer what an anonymous
+client gets from the sync API, filters included, so one cached payload per path
+serves every client. The category list is for staff only, like its sync twin.
+"""
+
+import hashlib
+import json
+
+from asgiref.sync import sync_to_async
+from django.core.cache import caches
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import HttpResponse, HttpResponseNotAllowed, JsonResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import quote_etag
+from rest_framework.exceptions import AuthenticationFailed, NotAuthenticated, PermissionDenied
+from rest_framework.pagination import _positive_int
+from rest_framework.request import Request
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import replace_query_param
+
+from online_shop import settings
+from e_shop.API.resources import ProductKeysetPagination
+from e_shop.API.serializers import ProductReadSerializer, CategorySerializer
+from e_shop.asyncorm import alist, aget
+from e_shop.cache import amodel_versions
+from e_shop.models import Product, Category
+from e_shop.pagination import apaginate_keyset
+from e_shop.search import search_products, search_arguments, SEARCH_ORDERING
+
+PAGE_CACHE = getattr(settings, "STOREFRONT_PAGE_CACHE", {})
+
+
+def _not_found(detail="Not found."):
+    return JsonResponse({"detail": detail}, status=404)
+
+
+def _authenticate(request):
+    # the authenticators of the sync API, they query the database
+    api_request = Request(request, authenticators=[authentication() for authentication
+                                                   in api_settings.DEFAULT_AUTHENTICATION_CLASSES])
+    try:
+        api_request.user
+    except AuthenticationFailed as exc:
+        return api_request, exc
+    return api_request, None
+
+
+def _refused(api_request, exc):
+    # the response of APIView.handle_exception for the same failure
+    response = JsonResponse({"detail": exc.detail}, status=exc.status_code)
+    if isinstance(exc, (NotAuthenticated, AuthenticationFailed)):
+        header = api_request.authenticators[0].authenticate_header(api_request) \
+            if api_request.authenticators else None
+        if header:
+            response["WWW-Authenticate"] = header
+        else:
+            response.status_code = 403
+    return response
+
+
+async def _staff_only(request):
+    """The IsAdminUser permission of the sync API: None when it passes, else the refusal"""
+    api_request, failed = await sync_to_async(_authenticate)(request)
+    if failed is None and not api_request.user.is_authenticated:
+        failed = NotAuthenticated()
+    elif failed is None and not api_request.user.is_staff:
+        failed = PermissionDenied()
+    return _refused(api_request, failed) if failed else None
+
+
+async def _cached_json(request, models, build):
+    """
+    The payload is cached under the versions of `models` and the full path,
+    an unchanged payload is answered with a 304 before the cache is read.
+    """
+    if request.method not in ("GET", "HEAD"):
+        return HttpResponseNotAllowed(["GET", "HEAD"])
+
+    versions = await amodel_versions(*models)
+    digest = hashlib.md5(f"{versions}:{request.get_full_path()}".encode()).hexdigest()
+    key = f"e_shop:async-api:{digest}"
+    etag = quote_etag(digest)
+
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        cache = caches[PAGE_CACHE.get("CACHE_ALIAS", "default")]
+        content = await cache.aget(key)
+        if content is None:
+            data = await build()
+            if isinstance(data, HttpResponse):
+                return data
+            content = json.dumps(data, cls=DjangoJSONEncoder)
+            await cache.aset(key, content, PAGE_CACHE.get("TIMEOUT", 60 * 10))
+        response = HttpResponse(content, content_type="application/json")
+    response["ETag"] = etag
+    return response
+
+
+def _page_size(request):
+    pagination = ProductKeysetPagination
+    try:
+        return _positive_int(request.GET[pagination.page_size_query_param], strict=True,
+                             cutoff=pagination.max_page_size)
+    except (KeyError, ValueError):
+        return pagination.page_size
+
+
+def _link(request, cursor):
+    if cursor is None:
+        return None
+    return replace_query_param(request.build_absolute_uri(),
+                               ProductKeysetPagination.cursor_query_param, cursor)
+
+
+def _available_products():
+    return ProductReadSerializer.setup_eager_loading(Product.objects.filter(is_available=True))
+
+
+async def product_list(request):
+    # the filters of the sync list, the payload is cached per full path
+    try:
+        search = search_arguments(request.GET)
+    except ValueError as exc:
+        return JsonResponse({"detail": str(exc)}, status=400)
+
+    async def build():
+        products = search_products(_available_products(), **search)
+        ordering = SEARCH_ORDERING if search["query"] else ProductKeysetPagination.ordering
+        try:
+            page = await apaginate_keyset(products, ordering, _page_size(request),
+                                          request.GET.get(ProductKeysetPagination.cursor_query_param))
+        except ValueError:
+            return _not_found("Invalid cursor")
+
+        results = ProductReadSerializer(page.object_list, many=True, context={"request": request}).data
+        return {"next": _link(request, page.next_cursor),
+                "previous": _link(request, page.previous_cursor),
+                "results": results}
+
+    return await _cached_json(request, (Product, Category), build)
+
+
+async def product_detail(request, pk):
+    async def build():
+        try:
+            product = await aget(_available_products(), pk=pk)
+        except Product.DoesNotExist:
+            return _not_found()
+        return ProductReadSerializer(product, context={"request": request}).data
+
+    return await _cached_json(request, (Product, Category), build)
+
+
+async def category_list(request):
+    refused = await _staff_only(request)
+    if refused is not None:
+        return refused
+
+    async def build():
+        categories = await alist(Category.objects.order_by("id"))
+        return CategorySerializer(categories, many=True).data
+
+    return await _cached_json(request, (Category, ), build)
@@ -1,12 +1,75 @@
+import copy
+import uuid
+from datetime import timedelta
+
+from django.core.cache import caches
+from django.db import transaction
 from django.utils import timezone
 from rest_framework import exceptions
 from rest_framework.authentication import TokenAuthentication
 
+from e_shop.cache import LRUCache
+from online_shop import settings
+
+TOKEN_AUTHENTICATION = getattr(settings, "TOKEN_AUTHENTICATION", {})
+TOKEN_TIME_TO_LIVE = timedelta(seconds=TOKEN_AUTHENTICATION.get("TIME_TO_LIVE", 60 * 10))
+
+# validated tokens: key -> (user, token, expiry time, revocation generation of the user)
+_token_cache = LRUCache(maxsize=TOKEN_AUTHENTICATION.get("CACHE_MAXSIZE", 10000),
+                        timeout=TOKEN_AUTHENTICATION.get("CACHE_TIMEOUT", 60))
+
+
+def _revocations():
+    return caches[TOKEN_AUTHENTICATION.get("CACHE_ALIAS", "default")]
+
+
+def _generation_key(user_id):
+    return f"e_shop:token-generation:{user_id}"
+
+
+def forget_token(key):
+    _token_cache.delete(key)
+
+
+def forget_user_tokens(user_id):
+    """
+    Every process drops the validated tokens of the user at their next use. The
+    generation is a fresh value, never a counter that could come back after an
+    eviction, and it moves once the revocation is committed, so that a token
+    validated meanwhile is not cached under it.
+    """
+    transaction.on_commit(
+        lambda: _revocations().set(_generation_key(user_id), uuid.uuid4().hex, timeout=None))
+
 
 # Exercise #4
 class TokenWithTimeToLiveAuthentication(TokenAuthentication):
+    """
+    Token authentication with a lifetime. Validated tokens are kept in a bounded
+    in-process cache, so most requests authenticate without a query. A cached
+    token is only used while the revocation generation of its user in the shared
+    cache is the one it was validated under.
+    """
+
     def authenticate_credentials(self, key):
-        user, token = super().authenticate_credentials(key=key)
-        if (timezone.now() - token.created).seconds > (60 * 10):
+        cached = _token_cache.get(key)
+        if cached is not None and _revocations().get(_generation_key(cached[0].pk)) != cached[3]:
+            forget_token(key)
+            cached = None
+        if cached is None:
+            user, token = super().authenticate_credentials(key=key)
+            generation = _revocations().get(_generation_key(user.pk))
+            cached = (user, token, token.created + TOKEN_TIME_TO_LIVE, generation)
+
+            # never keep the token in the cache after its death
+            seconds_left = (cached[2] - timezone.now()).total_seconds()
+            if seconds_left > 0:
+                _token_cache.set(key, cached, timeout=min(seconds_left, _token_cache.timeout))
+
+        user, token, expires, _ = cached
+        if timezone.now() >= expires:
+            forget_token(key)
             raise exceptions.AuthenticationFailed("Token is dead :(")
-        return user, token
+
+        # every request gets its own copy of the user
+        return copy.copy(user), token
@@ -1,22 +1,40 @@
-from django.db import transaction
-from rest_framework import status
+import hashlib
+import io
+from decimal import Decimal
+
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.http import quote_etag
+from rest_framework import status, mixins
+from rest_framework.authtoken.models import Token
 from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError, NotFound
 from rest_framework.generics import CreateAPIView
-from rest_framework.pagination import PageNumberPagination
+from rest_framework.parsers import MultiPartParser
+from rest_framework.pagination import PageNumberPagination, BasePagination, _positive_int
 from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
 from rest_framework.views import APIView
-from rest_framework.viewsets import ModelViewSet
+from rest_framework.viewsets import ModelViewSet, GenericViewSet
 from rest_framework.permissions import IsAuthenticated, AllowAny, IsAdminUser
-from rest_framework_simplejwt.token_blacklist.models import OutstandingToken, \
-    BlacklistedToken
 from rest_framework_simplejwt.tokens import RefreshToken
 
 from e_shop.API.permissions import IsAdminOrReadOnly, CustomerBuyAndReadOrAdminReadOnly, \
     CustomerRefundAndReadOrAdminRefundAndRead
 from e_shop.API.serializers import RegisterSerializer, ProductReadSerializer, \
     ProductWriteSerializer, CategorySerializer, PurchaseReadSerializer, \
-    PurchaseWriteSerializer, RefundReadSerializer, RefundWriteSerializer
+    PurchaseWriteSerializer, RefundReadSerializer, RefundWriteSerializer, BasketSerializer, \
+    ReservationSerializer, RefundBatchSerializer
+from e_shop.API.tokens import blacklist_user_tokens
+from e_shop.analytics import sales_report, report_arguments
+from e_shop.cache import model_versions
+from e_shop.imports import import_products, queue_import, FORMATS, IMPORT_INLINE_LIMIT
 from e_shop.models import Purchase, Customer, Product, Category, PurchaseReturns
+from e_shop.pagination import paginate_keyset
+from e_shop.search import search_products, search_arguments, SEARCH_ORDERING
+from e_shop.reservations import active_reservations
+from e_shop.services import buy_product, buy_basket, refund_purchase, refund_purchases, reject_refunds, \
+    queue_refunds, reserve_stock, release_reservation, CheckoutError, InsufficientFunds, RefundError, \
+    REFUND_INLINE_LIMIT
 
 
 class RegisterView(CreateAPIView):
@@ -29,6 +47,11 @@ class LogoutView(APIView):
     permission_classes = (IsAuthenticated, )
 
     def post(self, request):
+        # a DRF token dies with the logout, its cached authentication goes with it
+        if isinstance(request.auth, Token):
+            request.auth.delete()
+            return Response(status=status.HTTP_205_RESET_CONTENT)
+
         try:
             refresh_token = request.data["refresh_token"]
             token = RefreshToken(refresh_token)
@@ -43,47 +66,207 @@ class LogoutAllView(APIView):
     permission_classes = (IsAuthenticated,)
 
     def post(self, request):
-        tokens = OutstandingToken.objects.filter(user_id=request.user.id)
-        for token in tokens:
-            BlacklistedToken.objects.get_or_create(token=token)
-
+        blacklist_user_tokens(request.user.id)
         return Response(status=status.HTTP_205_RESET_CONTENT)
 
 
+def _exact_amounts(data):
+    # the JSON renderer turns Decimal into float, amounts are strings like in the serializers
+    if isinstance(data, dict):
+        return {key: _exact_amounts(value) for key, value in data.items()}
+    if isinstance(data, list):
+        return [_exact_amounts(value) for value in data]
+    return str(data) if isinstance(data, Decimal) else data
+
+
+class SalesReportView(APIView):
+    """Revenue, refund rates and top sellers from the sales rollups"""
+    permission_classes = (IsAdminUser, )
+
+    def get(self, request):
+        try:
+            arguments = report_arguments(request.query_params)
+        except ValueError as exc:
+            raise ValidationError(str(exc))
+        return Response(_exact_amounts(sales_report(**arguments)))
+
+
+class EagerLoadingViewSetMixin:
+    """Applies the eager loading plan of the read serializer to lists and single objects"""
+
+    def filter_queryset(self, queryset):
+        queryset = super().filter_queryset(queryset)
+        serializer_class = self.get_serializer_class()
+        if hasattr(serializer_class, "setup_eager_loading"):
+            queryset = serializer_class.setup_eager_loading(queryset)
+        return queryset
+
+
+class ConditionalGetViewSetMixin:
+    """
+    ETag and If-None-Match for list and detail endpoints. The ETag is built from the
+    versions of `etag_models`, so an unchanged resource is answered with a 304
+    before anything is queried or serialized.
+    """
+    etag_models = ()
+
+    def get_etag(self, request):
+        versions = model_versions(*self.etag_models)
+        raw = f"{versions}:{request.user.pk}:{request.get_full_path()}:{request.accepted_media_type}"
+        return quote_etag(hashlib.md5(raw.encode()).hexdigest())
+
+    def _conditional(self, handler, request, *args, **kwargs):
+        etag = self.get_etag(request)
+        response = get_conditional_response(request, etag=etag)
+        if response is None:
+            response = handler(request, *args, **kwargs)
+        if response.status_code in (status.HTTP_200_OK, status.HTTP_304_NOT_MODIFIED):
+            response["ETag"] = etag
+        patch_vary_headers(response, ("Authorization", "Cookie"))
+        return response
+
+    def list(self, request, *args, **kwargs):
+        return self._conditional(super().list, request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self._conditional(super().retrieve, request, *args, **kwargs)
+
+
 class ProductAPIListPagination(PageNumberPagination):
     page_size = 3
     page_size_query_param = 'page_size'
     max_page_size = 2
 
 
-class ProductViewSet(ModelViewSet):
+class KeysetAPIPagination(BasePagination):
+    """
+    Keyset pagination, page N costs the same as page 1.
+    The total count is only computed on request with `?count=true`.
+    """
+    page_size = 3
+    page_size_query_param = 'page_size'
+    max_page_size = 2
+    cursor_query_param = 'cursor'
+    count_query_param = 'count'
+    ordering = ("id", )
+
+    def get_ordering(self, queryset):
+        return self.ordering
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.count = queryset.count() \
+            if request.query_params.get(self.count_query_param) == "true" else None
+        try:
+            self.page = paginate_keyset(queryset, self.get_ordering(queryset),
+                                        self.get_page_size(request),
+                                        request.query_params.get(self.cursor_query_param))
+        except ValueError:
+            raise NotFound("Invalid cursor")
+        return list(self.page)
+
+    def get_page_size(self, request):
+        try:
+            return _positive_int(request.query_params[self.page_size_query_param], strict=True,
+                                 cutoff=self.max_page_size)
+        except (KeyError, ValueError):
+            return self.page_size
+
+    def _link(self, cursor):
+        if cursor is None:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, cursor)
+
+    def get_paginated_response(self, data):
+        response = {"next": self._link(self.page.next_cursor),
+                    "previous": self._link(self.page.previous_cursor),
+                    "results": data}
+        if self.count is not None:
+            response = {"count": self.count, **response}
+        return Response(response)
+
+
+class ProductKeysetPagination(KeysetAPIPagination):
+    ordering = ("name", "id")
+
+    def get_ordering(self, queryset):
+        # search results come best match first
+        return SEARCH_ORDERING if "rank" in queryset.query.annotations else self.ordering
+
+
+class PurchaseKeysetPagination(KeysetAPIPagination):
+    ordering = ("-time_purchase", "-id")
+
+
+class RefundKeysetPagination(KeysetAPIPagination):
+    ordering = ("-time_request_return", "-id")
+
+
+class ProductViewSet(ConditionalGetViewSetMixin, EagerLoadingViewSetMixin, ModelViewSet):
     queryset = Product.objects.all()
+    etag_models = (Product, Category)
     permission_classes = (IsAdminOrReadOnly,)
-    pagination_class = ProductAPIListPagination
+    pagination_class = ProductKeysetPagination
+    read_replica = True
 
     def get_queryset(self):
         return super().get_queryset() \
             if self.request.user.is_superuser \
             else Product.objects.filter(is_available=True)
 
+    def filter_queryset(self, queryset):
+        queryset = super().filter_queryset(queryset)
+        if self.action != "list":
+            return queryset
+
+        # ?q= with ?category=, ?price_min= and ?price_max=
+        try:
+            return search_products(queryset, **search_arguments(self.request.query_params))
+        except ValueError as exc:
+            raise ValidationError({"detail": str(exc)})
+
     def get_serializer_class(self):
         if self.request.method == 'GET':
             return ProductReadSerializer
         return ProductWriteSerializer
 
+    @action(detail=False, methods=["post"], url_path="import",
+            permission_classes=(IsAdminUser, ), parser_classes=(MultiPartParser, ))
+    def import_catalog(self, request):
+        """Create or update products from an uploaded CSV or JSON Lines catalog, big ones in a job"""
+        catalog = request.FILES.get("file")
+        if catalog is None:
+            raise ValidationError({"file": "Upload the catalog in this field"})
+        file_format = request.data.get("type") or catalog.name.rsplit(".", 1)[-1].lower()
+        if file_format not in FORMATS:
+            raise ValidationError({"type": f"Unknown format, use one of: {', '.join(FORMATS)}"})
 
-class CategoryViewSet(ModelViewSet):
+        if catalog.size > IMPORT_INLINE_LIMIT:
+            job = queue_import(catalog, file_format)
+            return Response({"queued": job.pk}, status=status.HTTP_202_ACCEPTED)
+
+        lines = io.TextIOWrapper(catalog.file, encoding="utf-8-sig", newline="")
+        stats = import_products(lines, file_format)
+        return Response(stats.as_dict())
+
+
+class CategoryViewSet(ConditionalGetViewSetMixin, ModelViewSet):
     queryset = Category.objects.all()
+    etag_models = (Category, )
     serializer_class = CategorySerializer
     permission_classes = (IsAdminUser,)
     pagination_class = ProductAPIListPagination
+    read_replica = True
 
 
-class PurchaseViewSet(ModelViewSet):
+class PurchaseViewSet(ConditionalGetViewSetMixin, EagerLoadingViewSetMixin, ModelViewSet):
     http_method_names = ["get", "post"]
     queryset = Purchase.objects.all()
+    etag_models = (Purchase, Product, Category)
     permission_classes = (CustomerBuyAndReadOrAdminReadOnly, )
-    pagination_class = ProductAPIListPagination
+    pagination_class = PurchaseKeysetPagination
+    read_replica = True
 
     def get_queryset(self):
         return super().get_queryset() \
@@ -93,39 +276,52 @@ class PurchaseViewSet(ModelViewSet):
     def get_serializer_class(self):
         if self.request.method == "GET":
             return PurchaseReadSerializer
+        if self.action == "bulk":
+            return BasketSerializer
         if self.request.method == "POST":
             return PurchaseWriteSerializer
 
     def perform_create(self, serializer):
-        customer = serializer.validated_data["customer"]
-        product = serializer.validated_data["product"]
-        amount_product = serializer.validated_data["amount"]
-
-        price_at_time_purchase = product.price
-        purchase_total = amount_product * price_at_time_purchase
-
-        # the current state of the buyer's account
-        wallet = customer.wallet
-
-        # the current quantity of the product in stock
-        product_amount = product.amount
-
-        wallet -= purchase_total
-        customer.wallet = wallet
-
-        product_amount -= amount_product
-        product.amount = product_amount
-
-        with transaction.atomic():
-            customer.save()
-            product.save()
-            serializer.save(price_at_time_purchase=price_at_time_purchase)
-
+        try:
+            serializer.instance = buy_product(serializer.validated_data["customer"],
+                                              serializer.validated_data["product"],
+                                              serializer.validated_data["amount"])
+        except CheckoutError as exc:
+            raise ValidationError(str(exc))
+
+    @action(detail=False, methods=["post"])
+    def bulk(self, request):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        lines = [(line["product"], line["amount"]) for line in serializer.validated_data["lines"]]
 
-class RefundPurchaseViewSet(ModelViewSet):
+        try:
+            purchases = buy_basket(serializer.validated_data["customer"], lines)
+        except InsufficientFunds as exc:
+            results = [{"product": product, "amount": amount, "status": "rejected"}
+                       for product, amount in lines]
+            return Response({"detail": str(exc), "lack": str(exc.lack), "lines": results},
+                            status=status.HTTP_400_BAD_REQUEST)
+        except CheckoutError as exc:
+            results = [{"product": product, "amount": amount,
+                        "status": "failed" if product in exc.products else "rejected",
+                        "detail": str(exc) if product in exc.products else None}
+                       for product, amount in lines]
+            return Response({"detail": "The basket was not bought", "lines": results},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        results = [{"product": purchase.product_id, "amount": purchase.amount, "status": "bought",
+                    "purchase": purchase.pk, "price_at_time_purchase": str(purchase.price_at_time_purchase)}
+                   for purchase in purchases]
+        return Response({"lines": results}, status=status.HTTP_201_CREATED)
+
+
+class RefundPurchaseViewSet(ConditionalGetViewSetMixin, EagerLoadingViewSetMixin, ModelViewSet):
     queryset = PurchaseReturns.objects.all()
+    etag_models = (PurchaseReturns, Purchase, Product, Category)
     permission_classes = (CustomerRefundAndReadOrAdminRefundAndRead, )
-    pagination_class = ProductAPIListPagination
+    pagination_class = RefundKeysetPagination
+    read_replica = True
 
     def get_queryset(self):
         return super().get_queryset() \
@@ -140,33 +336,55 @@ class RefundPurchaseViewSet(ModelViewSet):
     @action(detail=True, methods=['delete'])
     def confirm(self, request, pk=None):
         return_purchase = self.get_object()
+        try:
+            refund_purchase(return_purchase)
+        except RefundError as exc:
+            raise ValidationError(str(exc))
 
-        # data of the deleted purchase
-        purchase = return_purchase.to_purchase
-        product = purchase.product
-        amount_product = purchase.amount
-        price_product = purchase.price_at_time_purchase
-        sum_purchase = amount_product * price_product
-        customer = purchase.customer
-
-        # the current state of the buyer's account
-        wallet = customer.wallet
-
-        # the current quantity of the product in stock
-        product_amount = product.amount
-
-        # return data
-        wallet += sum_purchase
-        customer.wallet = wallet
+        return Response(status=status.HTTP_207_MULTI_STATUS)
 
-        product_amount += amount_product
-        product.amount = product_amount
+    def _batch(self, request):
+        serializer = RefundBatchSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        ids = serializer.validated_data["ids"]
+        # only the requests the user may see are processed
+        return ids, list(self.get_queryset().filter(pk__in=ids).values_list("pk", flat=True))
+
+    @action(detail=False, methods=["post"], url_path="bulk-approve", permission_classes=[IsAdminUser])
+    def bulk_approve(self, request):
+        ids, allowed = self._batch(request)
+        if len(allowed) > REFUND_INLINE_LIMIT:
+            jobs = queue_refunds(allowed)
+            return Response({"queued": sorted(allowed), "jobs": [job.pk for job in jobs],
+                             "skipped": sorted(set(ids) - set(allowed))},
+                            status=status.HTTP_202_ACCEPTED)
+        approved = refund_purchases(allowed)
+        return Response({"approved": sorted(approved),
+                         "skipped": sorted(set(ids) - set(approved))})
+
+    @action(detail=False, methods=["post"], url_path="bulk-reject", permission_classes=[IsAdminUser])
+    def bulk_reject(self, request):
+        ids, allowed = self._batch(request)
+        return Response({"rejected": reject_refunds(allowed),
+                         "skipped": sorted(set(ids) - set(allowed))})
+
+
+class ReservationViewSet(mixins.ListModelMixin, mixins.CreateModelMixin, mixins.DestroyModelMixin,
+                         GenericViewSet):
+    """Active stock holds of the customer, POST holds units and DELETE releases them"""
+    serializer_class = ReservationSerializer
+    permission_classes = (IsAuthenticated, )
 
-        # refund transaction
-        with transaction.atomic():
-            customer.save()
-            product.save()
-            return_purchase.delete()
-            purchase.delete()
+    def get_queryset(self):
+        return active_reservations().filter(customer=self.request.user).order_by("expires_at", "id")
 
-        return Response(status=status.HTTP_207_MULTI_STATUS)
+    def perform_create(self, serializer):
+        try:
+            serializer.instance = reserve_stock(serializer.validated_data["customer"],
+                                                serializer.validated_data["product"],
+                                                serializer.validated_data["amount"])
+        except CheckoutError as exc:
+            raise ValidationError(str(exc))
+
+    def perform_destroy(self, instance):
+        release_reservation(self.request.user, instance.product_id)
@@ -3,7 +3,52 @@ from rest_framework import serializers
 from rest_framework.relations import PrimaryKeyRelatedField
 from rest_framework.validators import UniqueValidator
 
-from e_shop.models import Product, Customer, Purchase, Category, PurchaseReturns
+from e_shop.images import schedule_variants
+from e_shop.middleware import record_timing
+from e_shop.models import Product, Customer, Purchase, Category, PurchaseReturns, StockReservation
+
+
+def prefixed(prefix, lookups):
+    return tuple(f"{prefix}__{lookup}" for lookup in lookups)
+
+
+class EagerLoadingMixin:
+    """
+    A read serializer declares which related rows and columns it renders,
+    viewsets apply the plan to their querysets before serializing.
+    """
+    select_related_fields = ()
+    prefetch_related_fields = ()
+    only_fields = ()
+
+    @classmethod
+    def setup_eager_loading(cls, queryset):
+        if cls.select_related_fields:
+            queryset = queryset.select_related(*cls.select_related_fields)
+        if cls.prefetch_related_fields:
+            queryset = queryset.prefetch_related(*cls.prefetch_related_fields)
+        if cls.only_fields:
+            queryset = queryset.only(*cls.only_fields)
+        return queryset
+
+
+class TimedListSerializer(serializers.ListSerializer):
+    @property
+    def data(self):
+        with record_timing("serializer"):
+            return super().data
+
+
+class TimedSerializerMixin:
+    """
+    Serialization time is reported by the instrumentation middleware,
+    with many=True the list serializer of Meta must be TimedListSerializer.
+    """
+
+    @property
+    def data(self):
+        with record_timing("serializer"):
+            return super().data
 
 
 class RegisterSerializer(serializers.ModelSerializer):
@@ -12,6 +57,9 @@ class RegisterSerializer(serializers.ModelSerializer):
                                      validators=[validate_password])
     password2 = serializers.CharField(write_only=True,
                                       required=True)
+    # the opening deposit of the ledger
+    wallet = serializers.DecimalField(max_digits=9, decimal_places=2, min_value=0,
+                                      required=False, allow_null=True)
 
     class Meta:
         model = Customer
@@ -38,10 +86,11 @@ class RegisterSerializer(serializers.ModelSerializer):
         return customer
 
 
-class CategorySerializer(serializers.ModelSerializer):
+class CategorySerializer(TimedSerializerMixin, serializers.ModelSerializer):
     class Meta:
         model = Category
         fields = "__all__"
+        list_serializer_class = TimedListSerializer
 
 
 class CategoryPurchaseSerializer(serializers.ModelSerializer):
@@ -50,12 +99,15 @@ class CategoryPurchaseSerializer(serializers.ModelSerializer):
         fields = ("name", )
 
 
-class ProductReadSerializer(serializers.ModelSerializer):
+class ProductReadSerializer(TimedSerializerMixin, EagerLoadingMixin, serializers.ModelSerializer):
     category = CategorySerializer()
+    photo_urls = serializers.ReadOnlyField()
+    select_related_fields = ("category", )
 
     class Meta:
         model = Product
-        exclude = ("slug", )
+        exclude = ("slug", "photo_variants")
+        list_serializer_class = TimedListSerializer
 
 
 class ProductWriteSerializer(serializers.ModelSerializer):
@@ -63,6 +115,16 @@ class ProductWriteSerializer(serializers.ModelSerializer):
         model = Product
         fields = "__all__"
 
+    def save(self, **kwargs):
+        # the old resized copies don't match a new photo
+        photo_changed = "photo" in self.validated_data
+        if photo_changed:
+            kwargs["photo_variants"] = {}
+        product = super().save(**kwargs)
+        if photo_changed:
+            schedule_variants(product)
+        return product
+
 
 class ProductPurchaseSerializer(serializers.ModelSerializer):
     category = CategoryPurchaseSerializer()
@@ -78,12 +140,16 @@ class CustomerSerializer(serializers.ModelSerializer):
         fields = ("username", )
 
 
-class PurchaseReadSerializer(serializers.ModelSerializer):
+class PurchaseReadSerializer(TimedSerializerMixin, EagerLoadingMixin, serializers.ModelSerializer):
     product = ProductPurchaseSerializer()
+    select_related_fields = ("product__category", )
+    only_fields = ("id", "customer", "amount", "time_purchase", "price_at_time_purchase",
+                   "product__name", "product__category__name")
 
     class Meta:
         model = Purchase
         fields = "__all__"
+        list_serializer_class = TimedListSerializer
 
 
 class PurchaseWriteSerializer(serializers.ModelSerializer):
@@ -109,12 +175,30 @@ class PurchaseWriteSerializer(serializers.ModelSerializer):
         return data
 
 
-class RefundReadSerializer(serializers.ModelSerializer):
+class BasketLineSerializer(serializers.ModelSerializer):
+    # a plain integer, the checkout looks up all products of the basket at once
+    product = serializers.IntegerField()
+
+    class Meta:
+        model = Purchase
+        fields = ("product", "amount")
+
+
+class BasketSerializer(serializers.Serializer):
+    customer = serializers.HiddenField(default=serializers.CurrentUserDefault())
+    lines = BasketLineSerializer(many=True, allow_empty=False)
+
+
+class RefundReadSerializer(TimedSerializerMixin, EagerLoadingMixin, serializers.ModelSerializer):
     to_purchase = PurchaseReadSerializer()
+    select_related_fields = prefixed("to_purchase", PurchaseReadSerializer.select_related_fields)
+    only_fields = ("id", "time_request_return") + \
+        prefixed("to_purchase", PurchaseReadSerializer.only_fields)
 
     class Meta:
         model = PurchaseReturns
         fields = "__all__"
+        list_serializer_class = TimedListSerializer
 
 
 class RefundWriteSerializer(serializers.ModelSerializer):
@@ -125,3 +209,19 @@ class RefundWriteSerializer(serializers.ModelSerializer):
     class Meta:
         model = PurchaseReturns
         fields = "__all__"
+
+
+class RefundBatchSerializer(serializers.Serializer):
+    ids = serializers.ListField(child=serializers.IntegerField(min_value=1), allow_empty=False,
+                                max_length=1000)
+
+
+class ReservationSerializer(serializers.ModelSerializer):
+    customer = serializers.HiddenField(default=serializers.CurrentUserDefault())
+
+    class Meta:
+        model = StockReservation
+        fields = ("id", "customer", "product", "amount", "expires_at")
+        read_only_fields = ("expires_at", )
+        # a new hold of the same product replaces the previous one
+        validators = []
@@ -0,0 +1,25 @@
+"""
+Typeahead endpoint of the catalog. It is answered from the in-memory index of
+the process, without a database query, so it is a plain Django view.
+"""
+
+from django.http import HttpResponseNotAllowed, JsonResponse
+
+from e_shop.suggest import SUGGEST_INDEX, LIMIT, MAX_LIMIT
+
+
+def product_suggest(request):
+    """Names of available products and categories that start with `?q=`"""
+    if request.method not in ("GET", "HEAD"):
+        return HttpResponseNotAllowed(["GET", "HEAD"])
+    try:
+        limit = max(1, min(int(request.GET.get("limit", LIMIT)), MAX_LIMIT))
+    except ValueError:
+        return JsonResponse({"detail": "Invalid limit"}, status=400)
+
+    prefix = request.GET.get("q", "")
+    suggestions = SUGGEST_INDEX.suggest(prefix, limit)
+    response = JsonResponse({"query": prefix, "ready": SUGGEST_INDEX.ready,
+                             "results": [suggestion.as_dict() for suggestion in suggestions]})
+    response["Cache-Control"] = "max-age=30"
+    return response
@@ -0,0 +1,40 @@
+from itertools import islice
+
+from rest_framework_simplejwt.token_blacklist.models import OutstandingToken, \
+    BlacklistedToken
+from rest_framework_simplejwt.utils import aware_utcnow
+
+BATCH_SIZE = 1000
+
+
+def _batches(iterable, batch_size):
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, batch_size)):
+        yield batch
+
+
+def blacklist_user_tokens(user_id, batch_size=BATCH_SIZE):
+    """Blacklist every live refresh token of the user, a few statements whatever their number"""
+    token_ids = OutstandingToken.objects \
+        .filter(user_id=user_id, expires_at__gt=aware_utcnow(), blacklistedtoken__isnull=True) \
+        .values_list("id", flat=True)
+
+    blacklisted = 0
+    for batch in _batches(token_ids.iterator(chunk_size=batch_size), batch_size):
+        BlacklistedToken.objects.bulk_create([BlacklistedToken(token_id=token_id) for token_id in batch],
+                                             ignore_conflicts=True)
+        blacklisted += len(batch)
+    return blacklisted
+
+
+def purge_expired_tokens(batch_size=BATCH_SIZE):
+    """
+    Delete expired outstanding tokens, their blacklist entries go with them.
+    Short batches keep the locks short on busy tables.
+    """
+    purged = 0
+    expired = OutstandingToken.objects.filter(expires_at__lte=aware_utcnow())
+    while token_ids := list(expired.values_list("id", flat=True)[:batch_size]):
+        OutstandingToken.objects.filter(id__in=token_ids).delete()
+        purged += len(token_ids)
+        yield purged
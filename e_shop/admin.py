@@ -1,13 +1,27 @@
 from django.contrib import admin
+from django.db import transaction, IntegrityError
+from django.utils import timezone
 
-from e_shop.models import Customer, Product, Purchase, PurchaseReturns, Category
+from e_shop.models import Customer, Product, Purchase, PurchaseReturns, Category, SalesRollup, \
+    StockReservation, WalletTransaction, Job
+from e_shop.search import search_products
+from e_shop.services import refund_purchases, reject_refunds, queue_refunds, REFUND_INLINE_LIMIT
+from e_shop.wallet import with_balance
 
 
 class CustomerAdmin(admin.ModelAdmin):
-    list_display = ("username", "wallet", "first_name", "last_name", "email", "is_staff")
+    list_display = ("username", "balance", "first_name", "last_name", "email", "is_staff")
     list_display_links = ("username",)
     search_fields = ("username", "first_name", "last_name", "email")
 
+    def get_queryset(self, request):
+        # the balances of a page are read with the page, not one query per row
+        return with_balance(super().get_queryset(request))
+
+    @admin.display(description="Wallet", ordering="balance")
+    def balance(self, customer):
+        return customer.balance
+
 
 class ProductAdmin(admin.ModelAdmin):
     list_display = ("id", "name", "amount", "price", "category", "is_available")
@@ -17,6 +31,12 @@ class ProductAdmin(admin.ModelAdmin):
     search_fields = ("name",)
     prepopulated_fields = {"slug": ("name",)}
 
+    def get_search_results(self, request, queryset, search_term):
+        # the full-text index instead of ILIKE '%term%' over every row
+        if not search_term.strip():
+            return queryset, False
+        return search_products(queryset, query=search_term), False
+
 
 class PurchaseAdmin(admin.ModelAdmin):
     list_display = ("id", "product", "amount", "price_at_time_purchase", "customer", "time_purchase")
@@ -25,19 +45,113 @@ class PurchaseAdmin(admin.ModelAdmin):
 
 
 class PurchaseReturnsAdmin(admin.ModelAdmin):
-    list_display = ("to_purchase", "time_request_return")
+    list_display = ("to_purchase", "customer", "product", "time_request_return")
     list_display_links = ("to_purchase",)
+    list_select_related = ("to_purchase__customer", "to_purchase__product")
+    actions = ("approve_selected", "reject_selected")
+
+    @admin.display(description="Customer")
+    def customer(self, refund):
+        return refund.to_purchase.customer
+
+    @admin.display(description="Product")
+    def product(self, refund):
+        return refund.to_purchase.product
+
+    @admin.action(description="Approve selected refunds")
+    def approve_selected(self, request, queryset):
+        refund_ids = list(queryset.values_list("pk", flat=True))
+        if len(refund_ids) > REFUND_INLINE_LIMIT:
+            jobs = queue_refunds(refund_ids)
+            self.message_user(request, f"{len(refund_ids)} refunds queued for approval in {len(jobs)} jobs")
+            return
+        approved = refund_purchases(refund_ids)
+        self.message_user(request, f"{len(approved)} refunds approved")
+
+    @admin.action(description="Reject selected refunds")
+    def reject_selected(self, request, queryset):
+        rejected = reject_refunds(list(queryset.values_list("pk", flat=True)))
+        self.message_user(request, f"{rejected} refunds rejected")
 
 
 class CategoryAdmin(admin.ModelAdmin):
-    list_display = ("id", "name")
+    list_display = ("id", "name", "product_count", "available_count", "in_stock_count")
     list_display_links = ("name",)
     search_fields = ("name",)
     prepopulated_fields = {"slug": ("name",)}
 
 
+class SalesRollupAdmin(admin.ModelAdmin):
+    list_display = ("bucket", "period", "product", "category", "orders", "units_sold", "revenue",
+                    "refunds", "refunded")
+    list_display_links = ("bucket",)
+    list_filter = ("period",)
+    list_select_related = ("product", "category")
+    date_hierarchy = "bucket"
+
+
+class WalletTransactionAdmin(admin.ModelAdmin):
+    list_display = ("id", "customer", "kind", "amount", "time_create")
+    list_display_links = ("id",)
+    list_filter = ("kind",)
+    list_select_related = ("customer",)
+    raw_id_fields = ("customer",)
+
+    # the ledger is append-only, money is moved by the shop itself
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+
+class JobAdmin(admin.ModelAdmin):
+    list_display = ("id", "name", "status", "attempts", "run_at", "locked_by", "time_done")
+    list_display_links = ("id",)
+    list_filter = ("status", "name")
+    readonly_fields = ("name", "kwargs", "key", "status", "attempts", "max_attempts", "run_at",
+                       "locked_by", "locked_at", "last_error", "time_done")
+    actions = ("retry_selected",)
+
+    def has_add_permission(self, request):
+        return False
+
+    @admin.action(description="Retry selected failed jobs")
+    def retry_selected(self, request, queryset):
+        retry = dict(status=Job.QUEUED, attempts=0, run_at=timezone.now(), time_done=None)
+        failed = queryset.filter(status=Job.FAILED)
+        retried = failed.filter(key__isnull=True).update(**retry)
+        skipped = 0
+        # a keyed job waits while another job with its key, e.g. the next run of a
+        # periodic task, is queued or running
+        for job_id in failed.filter(key__isnull=False).values_list("pk", flat=True):
+            try:
+                with transaction.atomic():
+                    retried += Job.objects.filter(pk=job_id, status=Job.FAILED).update(**retry)
+            except IntegrityError:
+                skipped += 1
+        message = f"{retried} jobs queued again"
+        if skipped:
+            message += f", {skipped} skipped as a job with the same key is queued or running"
+        self.message_user(request, message)
+
+
+class StockReservationAdmin(admin.ModelAdmin):
+    list_display = ("id", "product", "customer", "amount", "expires_at")
+    list_display_links = ("id",)
+    list_select_related = ("product", "customer")
+    raw_id_fields = ("product", "customer")
+
+
 admin.site.register(Customer, CustomerAdmin)
 admin.site.register(Product, ProductAdmin)
 admin.site.register(Purchase, PurchaseAdmin)
 admin.site.register(PurchaseReturns, PurchaseReturnsAdmin)
 admin.site.register(Category, CategoryAdmin)
+admin.site.register(SalesRollup, SalesRollupAdmin)
+admin.site.register(StockReservation, StockReservationAdmin)
+admin.site.register(WalletTransaction, WalletTransactionAdmin)
+admin.site.register(Job, JobAdmin)
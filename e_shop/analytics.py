@@ -0,0 +1,197 @@
+"""This is the sales analytics of application E_SHOP, it reads and maintains SalesRollup"""
+
+from collections import defaultdict
+from datetime import timedelta
+from decimal import Decimal
+
+from django.db import transaction, IntegrityError
+from django.db.models import F, Sum, Count, Min, DecimalField
+from django.db.models.functions import Trunc
+from django.utils import timezone
+
+from .exports import parse_moment
+from .models import SalesRollup, Purchase
+
+PERIODS = (SalesRollup.HOUR, SalesRollup.DAY)
+COUNTERS = ("orders", "units_sold", "revenue", "refunds", "units_refunded", "refunded")
+BACKFILL_WINDOW = timedelta(days=31)
+DEFAULT_RANGE = timedelta(days=30)
+MAX_TOP = 100
+
+
+def bucket_of(moment, period):
+    """Start of the hour or of the day of `moment` in the current time zone"""
+    local = timezone.localtime(moment)
+    if period == SalesRollup.HOUR:
+        return local.replace(minute=0, second=0, microsecond=0)
+    return local.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def _add(period, bucket, product_id, category_id, **counters):
+    """Add `counters` to a rollup row, the row is created on the first sale of its bucket"""
+    rows = SalesRollup.objects.filter(period=period, bucket=bucket, product_id=product_id)
+    if rows.update(**{name: F(name) + value for name, value in counters.items()}):
+        return
+    try:
+        with transaction.atomic():
+            SalesRollup.objects.create(period=period, bucket=bucket, product_id=product_id,
+                                       category_id=category_id, **counters)
+    except IntegrityError:
+        # a concurrent transaction created it in the meantime
+        rows.update(**{name: F(name) + value for name, value in counters.items()})
+
+
+def record_sales(purchases, categories):
+    """
+    Count new purchases in their buckets, `categories` maps product ids to category ids.
+    Call it in the transaction that creates the purchases.
+    """
+    totals = defaultdict(lambda: [0, 0, Decimal(0)])
+    for purchase in purchases:
+        for period in PERIODS:
+            total = totals[(period, bucket_of(purchase.time_purchase, period), purchase.product_id)]
+            total[0] += 1
+            total[1] += purchase.amount
+            total[2] += purchase.amount * purchase.price_at_time_purchase
+
+    # the same order in every transaction, rows are locked without deadlocks
+    for (period, bucket, product_id), (orders, units, revenue) in sorted(totals.items()):
+        _add(period, bucket, product_id, categories[product_id],
+             orders=orders, units_sold=units, revenue=revenue)
+
+
+def record_refund(purchase, category_id):
+    """Count an approved refund in the buckets of the refunded sale"""
+    record_refunds([purchase], {purchase.product_id: category_id})
+
+
+def record_refunds(purchases, categories):
+    """
+    Count approved refunds in the buckets of the refunded sales, `categories` maps
+    product ids to category ids. Call it in the transaction that deletes the purchases.
+    """
+    totals = defaultdict(lambda: [0, 0, Decimal(0)])
+    for purchase in purchases:
+        for period in PERIODS:
+            total = totals[(period, bucket_of(purchase.time_purchase, period), purchase.product_id)]
+            total[0] += 1
+            total[1] += purchase.amount
+            total[2] += purchase.amount * purchase.price_at_time_purchase
+
+    for (period, bucket, product_id), (refunds, units, refunded) in sorted(totals.items()):
+        _add(period, bucket, product_id, categories[product_id],
+             refunds=refunds, units_refunded=units, refunded=refunded)
+
+
+def _rebuild(start, end):
+    purchases = Purchase.objects.filter(time_purchase__gte=start, time_purchase__lt=end)
+    rollups = SalesRollup.objects.filter(bucket__gte=start, bucket__lt=end)
+
+    rows = {}
+    tzinfo = timezone.get_current_timezone()
+    for period in PERIODS:
+        sales = purchases.annotate(bucket=Trunc("time_purchase", period, tzinfo=tzinfo)) \
+            .values("bucket", "product_id", "product__category_id") \
+            .annotate(orders=Count("id"), units_sold=Sum("amount"),
+                      revenue=Sum(F("amount") * F("price_at_time_purchase"),
+                                  output_field=DecimalField(max_digits=14, decimal_places=2))) \
+            .order_by()
+        for sale in sales:
+            rows[(period, sale["bucket"], sale["product_id"])] = SalesRollup(
+                period=period, bucket=sale["bucket"], product_id=sale["product_id"],
+                category_id=sale["product__category_id"], orders=sale["orders"],
+                units_sold=sale["units_sold"], revenue=sale["revenue"])
+
+    # refunded purchases are deleted, the rollups are the only record of them
+    for refunded in rollups.filter(refunds__gt=0):
+        row = rows.setdefault((refunded.period, refunded.bucket, refunded.product_id),
+                              SalesRollup(period=refunded.period, bucket=refunded.bucket,
+                                          product_id=refunded.product_id,
+                                          category_id=refunded.category_id))
+        row.refunds, row.units_refunded, row.refunded = \
+            refunded.refunds, refunded.units_refunded, refunded.refunded
+        row.orders += refunded.refunds
+        row.units_sold += refunded.units_refunded
+        row.revenue += refunded.refunded
+
+    rollups.delete()
+    SalesRollup.objects.bulk_create(rows.values(), batch_size=1000)
+    return len(rows)
+
+
+def backfill(date_from=None, date_to=None, stdout=None):
+    """
+    Rebuild the rollups of whole days from the purchases, in windows of a month.
+    Sales that happen in a window while it is rebuilt can be lost, so run it for
+    past days or while the shop is quiet.
+    """
+    if date_from is None:
+        date_from = Purchase.objects.aggregate(first=Min("time_purchase"))["first"]
+        first_rollup = SalesRollup.objects.aggregate(first=Min("bucket"))["first"]
+        date_from = min(filter(None, (date_from, first_rollup)), default=None)
+        if date_from is None:
+            return 0
+    start = bucket_of(date_from, SalesRollup.DAY)
+    end = bucket_of(date_to or timezone.now(), SalesRollup.DAY) + timedelta(days=1)
+
+    written = 0
+    while start < end:
+        window_end = min(start + BACKFILL_WINDOW, end)
+        with transaction.atomic():
+            written += _rebuild(start, window_end)
+        if stdout:
+            stdout.write(f"{timezone.localtime(start):%Y-%m-%d} - "
+                         f"{timezone.localtime(window_end):%Y-%m-%d}: {written} rollups")
+        start = window_end
+    return written
+
+
+def _totals(rows):
+    totals = rows.aggregate(**{name: Sum(name) for name in COUNTERS})
+    return {name: 0 if value is None else value for name, value in totals.items()}
+
+
+def refund_rate(totals):
+    return round(totals["units_refunded"] / totals["units_sold"], 4) if totals["units_sold"] else 0
+
+
+def sales_report(period=SalesRollup.DAY, date_from=None, date_to=None, category=None, top=10):
+    """
+    Revenue, refund rates and top sellers of the buckets from date_from up to (not
+    including) date_to. Only rollup rows are read, so the cost depends on the
+    number of buckets, not on the number of purchases.
+    """
+    rows = SalesRollup.objects.filter(period=period)
+    if date_from:
+        rows = rows.filter(bucket__gte=bucket_of(date_from, period))
+    if date_to:
+        rows = rows.filter(bucket__lt=date_to)
+    if category:
+        rows = rows.filter(category_id=category)
+
+    sums = {name: Sum(name) for name in ("orders", "units_sold", "revenue", "units_refunded", "refunded")}
+    totals = _totals(rows)
+    return {
+        "period": period,
+        "totals": {**totals, "refund_rate": refund_rate(totals)},
+        "buckets": list(rows.values("bucket").annotate(**sums).order_by("bucket")),
+        "categories": [{**row, "refund_rate": refund_rate(row)} for row in
+                       rows.values("category_id", "category__name").annotate(**sums).order_by("-revenue")],
+        "top_products": list(rows.values("product_id", "product__name")
+                             .annotate(**sums).order_by("-units_sold", "product_id")[:top]),
+    }
+
+
+def report_arguments(params):
+    """Arguments of sales_report from query parameters, ValueError if they are invalid"""
+    period = params.get("period") or SalesRollup.DAY
+    if period not in PERIODS:
+        raise ValueError(f"Unknown period, use one of: {', '.join(PERIODS)}")
+    return {
+        "period": period,
+        "date_from": parse_moment(params["from"]) if params.get("from")
+        else timezone.now() - DEFAULT_RANGE,
+        "date_to": parse_moment(params["to"], end=True) if params.get("to") else None,
+        "category": int(params["category"]) if params.get("category") else None,
+        "top": min(int(params.get("top") or 10), MAX_TOP),
+    }
@@ -1,6 +1,22 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_migrate
 
 
 class EShopConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'e_shop'
+
+    def ready(self):
+        from . import checks, signals, tasks  # noqa: F401
+
+        post_migrate.connect(repair_search_index, sender=self)
+
+
+def repair_search_index(using, **kwargs):
+    # SQLite copies a table to alter it and its triggers are dropped with the old table
+    from django.db import connections
+    from .search import install_search_index, FTS_TABLE
+
+    connection = connections[using]
+    if connection.vendor == "sqlite" and FTS_TABLE in connection.introspection.table_names():
+        install_search_index(connection)
@@ -0,0 +1,80 @@
+"""This is the async (ASGI) storefront of application E_SHOP"""
+
+import hashlib
+
+from asgiref.sync import sync_to_async
+from django.http import HttpResponseNotAllowed, Http404
+from django.template.response import TemplateResponse
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.http import http_date, quote_etag
+
+from .cache import acatalog_version, page_cache_key, aget_cached_page, set_cached_page, \
+    get_sidebar_categories, last_modified
+from .models import Product
+from .pagination import apaginate_keyset
+from .utils import menu
+
+
+def _resolve_user(request):
+    # the user is lazily loaded from the session, that query must not run in the event loop
+    request.user.is_authenticated
+    return request.user
+
+
+async def shop_home(request):
+    """ShopHome for ASGI deployments, the page and its cache are the same"""
+    if request.method not in ("GET", "HEAD"):
+        return HttpResponseNotAllowed(["GET", "HEAD"])
+
+    user = await sync_to_async(_resolve_user)(request)
+    version = await acatalog_version()
+
+    if not user.is_authenticated:
+        key = page_cache_key(request, version)
+        etag = quote_etag(hashlib.md5(key.encode()).hexdigest())
+        modified = last_modified(version)
+
+        response = get_conditional_response(request, etag=etag, last_modified=modified)
+        if response is None:
+            response = await aget_cached_page(key)
+        if response is None:
+            response = await _render_home(request, user, version)
+            if response.status_code == 200:
+                # the handler renders the page in a thread, the callback runs there
+                response.add_post_render_callback(
+                    lambda rendered: None if rendered.cookies else set_cached_page(key, rendered))
+
+        response.headers["ETag"] = etag
+        response.headers["Last-Modified"] = http_date(modified)
+    else:
+        response = await _render_home(request, user, version)
+
+    patch_vary_headers(response, ("Cookie", ))
+    return response
+
+
+async def _render_home(request, user, version):
+    queryset = Product.objects.select_related("category")
+    if not user.is_superuser:
+        queryset = queryset.filter(is_available=True)
+
+    try:
+        page = await apaginate_keyset(queryset, ("name", "id"), 4, request.GET.get("cursor"))
+    except ValueError:
+        raise Http404("Invalid cursor")
+
+    context = {
+        "products": page.object_list,
+        "object_list": page.object_list,
+        "page_obj": page,
+        "paginator": None,
+        "is_paginated": page.has_other_pages(),
+        "title": "Admin-Products" if user.is_superuser else "E-Shop",
+        "categories": await sync_to_async(get_sidebar_categories)(user.is_superuser),
+        "catalog_version": version,
+        "cat_selected": 0,
+    }
+    if user.is_superuser:
+        context["menu"] = menu
+
+    return TemplateResponse(request, "e_shop/index.html", context)
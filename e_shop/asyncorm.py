@@ -0,0 +1,21 @@
+"""This is the async database access of application E_SHOP"""
+
+from asgiref.sync import sync_to_async
+from django.db.models import QuerySet
+
+# the async queryset interface (aiterator, aget) came with Django 4.1, before it
+# queries run through sync_to_async in the one thread that keeps the connection
+NATIVE_ASYNC_ORM = hasattr(QuerySet, "aiterator")
+
+if NATIVE_ASYNC_ORM:
+    async def alist(queryset):
+        return [obj async for obj in queryset.aiterator()]
+
+    async def aget(queryset, *args, **kwargs):
+        return await queryset.aget(*args, **kwargs)
+else:
+    async def alist(queryset):
+        return await sync_to_async(list)(queryset)
+
+    async def aget(queryset, *args, **kwargs):
+        return await sync_to_async(queryset.get)(*args, **kwargs)
@@ -0,0 +1,453 @@
+"""This is the latency benchmark of application E_SHOP, it drives the views in process"""
+
+import asyncio
+import statistics
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from io import BytesIO
+
+from django.conf import settings
+from django.core.handlers.asgi import ASGIHandler
+from django.core.handlers.wsgi import WSGIHandler
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, setup_databases, teardown_databases, \
+    setup_test_environment, teardown_test_environment
+from rest_framework.test import APIClient
+
+from .models import Customer, Product, Purchase, PurchaseReturns
+from .seed import seed_shop
+
+
+@contextmanager
+def throwaway_databases(verbosity=0):
+    """
+    Fresh test databases in place of the configured ones while a benchmark runs.
+    The seeded shop, its superuser and the refunds it approves are dropped with
+    them, and the outgoing mail goes to the locmem backend.
+    """
+    setup_test_environment()
+    old_config = setup_databases(verbosity, interactive=False, serialized_aliases=())
+    try:
+        yield
+    finally:
+        teardown_databases(old_config, verbosity)
+        teardown_test_environment()
+
+
+def _host():
+    # the test runner only allows "testserver", a DEBUG run only allows localhost
+    return "testserver" if "testserver" in settings.ALLOWED_HOSTS else "localhost"
+
+
+class Scenario:
+    """
+    One endpoint driven `iterations` times. `prepare` returns the arguments of every
+    request, so requests that consume rows (refunds) get a fresh row each time.
+    """
+
+    def __init__(self, name, method, client, prepare):
+        self.name = name
+        self.method = method
+        self.client = client
+        self.prepare = prepare
+
+
+def _percentile(values, percent):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(percent / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def _session_client(user=None):
+    client = Client(HTTP_HOST=_host(), raise_request_exception=False)
+    if user:
+        client.force_login(user)
+    return client
+
+
+def _api_client(user):
+    client = APIClient(HTTP_HOST=_host(), raise_request_exception=False)
+    client.force_authenticate(user)
+    return client
+
+
+def _new_purchases(customer, product, number):
+    """Ids of `number` new purchases without refund requests"""
+    Purchase.objects.bulk_create([
+        Purchase(customer=customer, product=product, amount=1, price_at_time_purchase=product.price)
+        for _ in range(number)])
+    return list(Purchase.objects.filter(customer=customer, purchasereturns__isnull=True)
+                .order_by("-id").values_list("id", flat=True)[:number])
+
+
+def build_scenarios(dataset):
+    customer = Customer.objects.get(pk=dataset["customers"][0])
+    admin, _ = Customer.objects.get_or_create(username=f"{dataset['tag']}-admin",
+                                              defaults={"is_staff": True, "is_superuser": True})
+    product = Product.objects.filter(pk__in=dataset["products"], is_available=True) \
+        .order_by("pk").first()
+    Product.objects.filter(pk=product.pk).update(amount=30000)
+
+    def refund_requests(number):
+        purchases = _new_purchases(customer, product, number)
+        PurchaseReturns.objects.bulk_create([PurchaseReturns(to_purchase_id=purchase_id)
+                                             for purchase_id in purchases])
+        return list(PurchaseReturns.objects.filter(to_purchase_id__in=purchases)
+                    .values_list("id", flat=True))
+
+    anonymous = _session_client()
+    logged_in = _session_client(customer)
+    superuser = _session_client(admin)
+    api_customer = _api_client(customer)
+    api_admin = _api_client(admin)
+
+    return [
+        Scenario("home", "get", anonymous, lambda n: [("/", {})] * n),
+        Scenario("home (customer)", "get", logged_in, lambda n: [("/", {})] * n),
+        Scenario("product", "get", logged_in,
+                 lambda n: [(product.get_absolute_url(), {})] * n),
+        Scenario("product-buy", "post", logged_in,
+                 lambda n: [(f"/product/buy/{product.slug}/", {"amount": 1})] * n),
+        Scenario("purchase", "get", logged_in, lambda n: [("/customer/purchase/", {})] * n),
+        Scenario("refund-purchase", "post", logged_in,
+                 lambda n: [(f"/refund-purchase/{purchase_id}/", {})
+                            for purchase_id in _new_purchases(customer, product, n)]),
+        Scenario("admin-refund-approve", "post", superuser,
+                 lambda n: [(f"/admin-refund-approve/{refund_id}/", {})
+                            for refund_id in refund_requests(n)]),
+        Scenario("api/shop-home", "get", api_customer, lambda n: [("/api/shop-home/", {})] * n),
+        Scenario("api/purchase", "get", api_customer, lambda n: [("/api/purchase/", {})] * n),
+        Scenario("api/purchase (buy)", "post", api_customer,
+                 lambda n: [("/api/purchase/", {"product": product.pk, "amount": 1})] * n),
+        Scenario("api/refund", "post", api_customer,
+                 lambda n: [("/api/refund/", {"to_purchase": purchase_id})
+                            for purchase_id in _new_purchases(customer, product, n)]),
+        Scenario("api/refund (confirm)", "delete", api_admin,
+                 lambda n: [(f"/api/refund/{refund_id}/confirm/", {}) for refund_id in refund_requests(n)]),
+    ]
+
+
+def run_scenario(scenario, iterations, warmup):
+    requests = scenario.prepare(iterations + warmup)
+    call = getattr(scenario.client, scenario.method)
+
+    latencies, queries, errors = [], [], 0
+    started = time.perf_counter()
+    for number, (url, data) in enumerate(requests):
+        with CaptureQueriesContext(connection) as captured:
+            start = time.perf_counter()
+            response = call(url, data)
+            elapsed = time.perf_counter() - start
+        if number < warmup:
+            started = time.perf_counter()
+            continue
+        latencies.append(elapsed * 1000)
+        queries.append(len(captured))
+        if response.status_code >= 400:
+            errors += 1
+    total = time.perf_counter() - started
+
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "p50_ms": round(_percentile(latencies, 50), 3),
+        "p95_ms": round(_percentile(latencies, 95), 3),
+        "p99_ms": round(_percentile(latencies, 99), 3),
+        "mean_ms": round(statistics.fmean(latencies), 3),
+        "rps": round(len(latencies) / total, 1) if total else None,
+        "queries_median": statistics.median(queries),
+        "queries_max": max(queries),
+    }
+
+
+def current_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(categories=10, products=1000, customers=100, purchases=10000, refunds=100,
+                   iterations=100, warmup=5, only=None, seed=0, stdout=None):
+    """Seed a shop, drive every scenario and return the report as a dict"""
+    dataset = seed_shop(categories=categories, products=products, customers=customers,
+                        purchases=purchases, refunds=refunds, seed=seed, stdout=stdout)
+
+    report = {"commit": current_commit(),
+              "dataset": {"categories": categories, "products": products, "customers": customers,
+                          "purchases": purchases, "refunds": refunds},
+              "iterations": iterations,
+              "endpoints": {}}
+    for scenario in build_scenarios(dataset):
+        if only and scenario.name not in only:
+            continue
+        report["endpoints"][scenario.name] = run_scenario(scenario, iterations, warmup)
+        if stdout:
+            stdout.write(f"{scenario.name}: {report['endpoints'][scenario.name]}")
+    return report
+
+
+def compare_reports(baseline, current, tolerance=0.2):
+    """Endpoints whose p95 latency grew by more than `tolerance` or that need more queries"""
+    regressions = {}
+    for name, result in current["endpoints"].items():
+        before = baseline.get("endpoints", {}).get(name)
+        if not before:
+            continue
+        slower = result["p95_ms"] > before["p95_ms"] * (1 + tolerance)
+        more_queries = result["queries_max"] > before["queries_max"]
+        if slower or more_queries:
+            regressions[name] = {"p95_ms": (before["p95_ms"], result["p95_ms"]),
+                                 "queries_max": (before["queries_max"], result["queries_max"])}
+    return regressions
+
+
+def catalog_paths(dataset=None):
+    """
+    Pairs of the same page served by the sync view and by the async one, for a
+    product of the seeded `dataset` or, without it, for one the database already has
+    """
+    products = Product.objects.filter(is_available=True)
+    if dataset is not None:
+        products = products.filter(pk__in=dataset["products"])
+    product = products.order_by("pk").first()
+    if product is None:
+        raise ValueError("The database has no available product to benchmark")
+    return {
+        "home": ("/", "/async/"),
+        "product list": ("/api/shop-home/", "/api/async/shop-home/"),
+        "product detail": (f"/api/shop-home/{product.pk}/", f"/api/async/shop-home/{product.pk}/"),
+    }
+
+
+def _wsgi_request(application, path):
+    path, _, query = path.partition("?")
+    environ = {"REQUEST_METHOD": "GET", "PATH_INFO": path, "QUERY_STRING": query,
+               "SCRIPT_NAME": "", "SERVER_NAME": _host(), "SERVER_PORT": "80",
+               "HTTP_HOST": _host(), "REMOTE_ADDR": "127.0.0.1", "SERVER_PROTOCOL": "HTTP/1.1",
+               "wsgi.version": (1, 0), "wsgi.url_scheme": "http", "wsgi.input": BytesIO(),
+               "wsgi.errors": BytesIO(), "wsgi.multithread": True, "wsgi.multiprocess": False,
+               "wsgi.run_once": False}
+    status = []
+    body = application(environ, lambda status_line, headers: status.append(status_line))
+    try:
+        for _ in body:
+            pass
+    finally:
+        if hasattr(body, "close"):
+            body.close()
+    return int(status[0].split()[0])
+
+
+async def _asgi_request(application, path):
+    path, _, query = path.partition("?")
+    scope = {"type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1",
+             "method": "GET", "scheme": "http", "path": path, "raw_path": path.encode(),
+             "query_string": query.encode(), "root_path": "",
+             "headers": [(b"host", _host().encode())],
+             "client": ("127.0.0.1", 0), "server": (_host(), 80)}
+    status = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            status.append(message["status"])
+
+    await application(scope, receive, send)
+    return status[0]
+
+
+def _http_request(base_url, path):
+    try:
+        with urllib.request.urlopen(base_url.rstrip("/") + path) as response:
+            response.read()
+            return response.status
+    except urllib.error.HTTPError as error:
+        return error.code
+
+
+def _summary(latencies, statuses, elapsed):
+    return {
+        "requests": len(latencies),
+        "errors": sum(1 for status in statuses if status >= 400),
+        "rps": round(len(latencies) / elapsed, 1) if elapsed else None,
+        "p50_ms": round(_percentile(latencies, 50), 3),
+        "p95_ms": round(_percentile(latencies, 95), 3),
+    }
+
+
+def drive_threads(call, path, requests, concurrency):
+    """`requests` calls of call(path) from `concurrency` threads, like a threaded WSGI server"""
+    def timed(_):
+        start = time.perf_counter()
+        status = call(path)
+        return (time.perf_counter() - start) * 1000, status
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(timed, range(requests)))
+    elapsed = time.perf_counter() - started
+    return _summary([latency for latency, _ in results], [status for _, status in results], elapsed)
+
+
+def drive_asgi(application, path, requests, concurrency):
+    """`requests` calls of the ASGI application with at most `concurrency` in flight"""
+    async def run():
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def timed():
+            async with semaphore:
+                start = time.perf_counter()
+                status = await _asgi_request(application, path)
+                return (time.perf_counter() - start) * 1000, status
+
+        started = time.perf_counter()
+        results = await asyncio.gather(*[timed() for _ in range(requests)])
+        return results, time.perf_counter() - started
+
+    results, elapsed = asyncio.run(run())
+    return _summary([latency for latency, _ in results], [status for _, status in results], elapsed)
+
+
+def run_server_benchmarks(requests=500, concurrency=16, asgi_url=None, wsgi_url=None,
+                          categories=10, products=1000, seed=0, stdout=None):
+    """
+    Throughput of the catalog pages under ASGI and under WSGI, for the sync views
+    and for their async versions. The applications are driven in process unless the
+    base URL of a running server (e.g. uvicorn or daphne, gunicorn) is given. A server
+    reads its own database, so with a URL nothing is seeded and the pages of products
+    already in the configured database, which the server must share, are timed.
+    """
+    dataset = None
+    if not (asgi_url or wsgi_url):
+        dataset = seed_shop(categories=categories, products=products, customers=1, purchases=0,
+                            seed=seed, stdout=stdout)
+
+    if asgi_url:
+        asgi = ("asgi", lambda path: drive_threads(lambda p: _http_request(asgi_url, p), path,
+                                                   requests, concurrency))
+    else:
+        asgi_application = ASGIHandler()
+        asgi = ("asgi", lambda path: drive_asgi(asgi_application, path, requests, concurrency))
+    if wsgi_url:
+        wsgi = ("wsgi", lambda path: drive_threads(lambda p: _http_request(wsgi_url, p), path,
+                                                   requests, concurrency))
+    else:
+        wsgi_application = WSGIHandler()
+        wsgi = ("wsgi", lambda path: drive_threads(lambda p: _wsgi_request(wsgi_application, p),
+                                                   path, requests, concurrency))
+
+    report = {"commit": current_commit(), "requests": requests, "concurrency": concurrency,
+              "in_process": not (asgi_url or wsgi_url), "endpoints": {}}
+    for name, paths in catalog_paths(dataset).items():
+        results = report["endpoints"][name] = {}
+        for server, drive in (wsgi, asgi):
+            for view, path in zip(("sync", "async"), paths):
+                if path is None:
+                    continue
+                results[f"{server} {view}"] = drive(path)
+                if stdout:
+                    stdout.write(f"{name}, {server} {view}: {results[f'{server} {view}']}")
+    return report
+
+
+SUGGEST_WORDS = ("red", "blue", "green", "black", "white", "wooden", "steel", "cotton", "leather",
+                 "smart", "vintage", "classic", "mini", "pro", "ultra", "chair", "phone", "lamp",
+                 "table", "shirt", "watch", "kettle", "bag", "pen", "book", "camera", "sofa",
+                 "jacket", "mug", "speaker", "charger", "blender", "bottle", "helmet", "kite")
+
+
+def _generated_names(number, rand):
+    for i in range(number):
+        words = rand.sample(SUGGEST_WORDS, rand.randint(2, 4))
+        yield f"{' '.join(words).capitalize()} {i}"
+
+
+def _micro_summary(latencies):
+    return {"p50_us": round(_percentile(latencies, 50) / 1000, 2),
+            "p95_us": round(_percentile(latencies, 95) / 1000, 2),
+            "p99_us": round(_percentile(latencies, 99) / 1000, 2)}
+
+
+def run_suggest_benchmarks(names=1000000, lookups=100000, changes=1000, seed=0, stdout=None):
+    """
+    Build the typeahead index from generated names, without the database, and
+    time its lookups per prefix length, single changes and the view in front of it.
+    """
+    import random
+    import tracemalloc
+
+    from django.test import RequestFactory
+
+    from .API.suggestions import product_suggest
+    from .suggest import PrefixIndex, Suggestion, SUGGEST_INDEX, PRODUCT
+
+    rand = random.Random(seed)
+    suggestions = [Suggestion(PRODUCT, pk, name, f"product-{pk}")
+                   for pk, name in enumerate(_generated_names(names, rand), start=1)]
+
+    index = PrefixIndex(max_entries=names + changes)
+    started = time.perf_counter()
+    index.load(suggestions)
+    build = time.perf_counter() - started
+    if stdout:
+        stdout.write(f"{names} names loaded in {build:.1f}s")
+
+    # the index on top of the entries, which the database rows become anyway
+    tracemalloc.start()
+    measured = PrefixIndex(max_entries=names)
+    measured.load(suggestions)
+    index_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del measured
+    entry_bytes = sum(sys.getsizeof(suggestion) + sys.getsizeof(suggestion.name) +
+                      sys.getsizeof(suggestion.slug) for suggestion in suggestions[:10000]) / 10000
+
+    report = {"names": names, "build_s": round(build, 2),
+              "memory_mb": {"index": round(index_bytes / 2 ** 20, 1),
+                            "entries": round(entry_bytes * names / 2 ** 20, 1)},
+              "lookups": {}}
+
+    for length in (1, 2, 3, 5, 8):
+        prefixes = [suggestions[rand.randrange(names)].name[:length] for _ in range(lookups)]
+        latencies = []
+        for prefix in prefixes:
+            start = time.perf_counter_ns()
+            index.lookup(prefix)
+            latencies.append(time.perf_counter_ns() - start)
+        report["lookups"][f"prefix {length}"] = _micro_summary(latencies)
+
+    for name, change in (
+            ("add", lambda i: index.add(Suggestion(PRODUCT, names + i, f"New product {i}", "new"))),
+            ("remove", lambda i: index.remove(PRODUCT, names + i, f"New product {i}"))):
+        latencies = []
+        for i in range(changes):
+            start = time.perf_counter_ns()
+            change(i)
+            latencies.append(time.perf_counter_ns() - start)
+        report[name] = _micro_summary(latencies)
+
+    # the whole view with the generated index in place of the loaded one
+    factory = RequestFactory()
+    loaded, ready = SUGGEST_INDEX.index, SUGGEST_INDEX.ready
+    SUGGEST_INDEX.index, SUGGEST_INDEX.ready = index, True
+    try:
+        latencies = []
+        for _ in range(min(lookups, 10000)):
+            request = factory.get("/api/products/suggest", {"q": suggestions[rand.randrange(names)].name[:3]})
+            start = time.perf_counter_ns()
+            product_suggest(request)
+            latencies.append(time.perf_counter_ns() - start)
+        report["view"] = _micro_summary(latencies)
+    finally:
+        SUGGEST_INDEX.index, SUGGEST_INDEX.ready = loaded, ready
+    return report
@@ -0,0 +1,197 @@
+"""This is the caching layer of application E_SHOP"""
+
+import math
+import time
+from collections import OrderedDict
+from threading import Lock
+
+from django.core.cache import caches
+from django.db.models import F
+
+from online_shop import settings
+from .models import Category, Product
+from .routers import read_from_primary, PIN_SECONDS
+
+SIDEBAR_CACHE = getattr(settings, "CATEGORY_SIDEBAR_CACHE", {})
+SIDEBAR_GENERATION_KEY = "e_shop:sidebar:generation"
+
+PAGE_CACHE = getattr(settings, "STOREFRONT_PAGE_CACHE", {})
+
+
+class LRUCache:
+    """Thread-safe per-process LRU cache, entries live for `timeout` seconds"""
+
+    def __init__(self, maxsize=128, timeout=None):
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, expires = self._data[key]
+            except KeyError:
+                return default
+            if expires is not None and expires <= time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, timeout=None):
+        timeout = self.timeout if timeout is None else timeout
+        expires = time.monotonic() + timeout if timeout is not None else None
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+_sidebar_cache = LRUCache(maxsize=SIDEBAR_CACHE.get("MAXSIZE", 16),
+                          timeout=SIDEBAR_CACHE.get("TIMEOUT", 60 * 5))
+
+
+def _shared_sidebar_cache():
+    alias = SIDEBAR_CACHE.get("CACHE_ALIAS")
+    return caches[alias] if alias else None
+
+
+def _sidebar_queryset(is_superuser):
+    # the denormalized counters, no join or aggregate over the products
+    if is_superuser:
+        return Category.objects.annotate(sidebar_count=F("product_count"))
+    return Category.objects.annotate(sidebar_count=F("available_count"))
+
+
+def get_sidebar_categories(is_superuser):
+    """
+    Categories annotated with `sidebar_count` for the sidebar.
+    Customers only count available products, the superuser counts all of them.
+    """
+    audience = "admin" if is_superuser else "customer"
+    shared = _shared_sidebar_cache()
+
+    # the generation lets other processes notice an invalidation made elsewhere
+    generation = shared.get(SIDEBAR_GENERATION_KEY, 0) if shared else 0
+    key = f"e_shop:sidebar:{generation}:{audience}"
+
+    categories = _sidebar_cache.get(key)
+    if categories is None and shared:
+        categories = shared.get(key)
+    if categories is None:
+        categories = list(_sidebar_queryset(is_superuser))
+        if shared:
+            shared.set(key, categories, SIDEBAR_CACHE.get("TIMEOUT", 60 * 5))
+    _sidebar_cache.set(key, categories)
+    return categories
+
+
+def invalidate_sidebar():
+    _sidebar_cache.clear()
+    shared = _shared_sidebar_cache()
+    if shared:
+        shared.add(SIDEBAR_GENERATION_KEY, 0, timeout=None)
+        shared.incr(SIDEBAR_GENERATION_KEY)
+
+
+def _page_cache():
+    return caches[PAGE_CACHE.get("CACHE_ALIAS", "default")]
+
+
+def _version_key(model):
+    return f"e_shop:version:{model._meta.label_lower}"
+
+
+def _primary_while_fresh(versions):
+    # the replicas may not have the rows of a version younger than the pin yet, a page
+    # or an ETag of that version is built from the primary so it never holds older rows
+    if max(versions, default=0) > time.time() - PIN_SECONDS:
+        read_from_primary()
+    return versions
+
+
+def model_versions(*models):
+    """
+    Second of the last change of every model, it is kept in the page cache backend.
+    Versions are whole seconds so that they can be sent as Last-Modified. A request
+    that gets a version younger than the replica pin reads from the primary.
+    """
+    cache = _page_cache()
+    keys = [_version_key(model) for model in models]
+    versions = cache.get_many(keys)
+    for key in keys:
+        if key not in versions:
+            cache.add(key, math.ceil(time.time()), timeout=None)
+            versions[key] = cache.get(key, math.ceil(time.time()))
+    return _primary_while_fresh([versions[key] for key in keys])
+
+
+async def amodel_versions(*models):
+    """model_versions for async views"""
+    cache = _page_cache()
+    keys = [_version_key(model) for model in models]
+    versions = await cache.aget_many(keys)
+    for key in keys:
+        if key not in versions:
+            await cache.aadd(key, math.ceil(time.time()), timeout=None)
+            versions[key] = await cache.aget(key, math.ceil(time.time()))
+    return _primary_while_fresh([versions[key] for key in keys])
+
+
+def bump_model_version(*models):
+    """
+    Move the versions of the models to a new second, even when they were bumped
+    in this second already: clients revalidating with If-Modified-Since only
+    notice a change when the Last-Modified second changes.
+    """
+    cache = _page_cache()
+    for model in models:
+        key = _version_key(model)
+        cache.set(key, max(math.ceil(time.time()), math.ceil(cache.get(key, 0)) + 1), timeout=None)
+
+
+def last_modified(version):
+    """Last-Modified of a response rendered at `version`, as a timestamp"""
+    return math.ceil(version)
+
+
+def catalog_version():
+    """Time of the last change of products or categories, pages rendered before it are stale"""
+    return max(model_versions(Product, Category))
+
+
+async def acatalog_version():
+    return max(await amodel_versions(Product, Category))
+
+
+def page_cache_key(request, version, variant=""):
+    return f"e_shop:page:{version}:{variant}:{request.get_full_path()}"
+
+
+def get_cached_page(key):
+    return _page_cache().get(key)
+
+
+def set_cached_page(key, response):
+    _page_cache().set(key, response, PAGE_CACHE.get("TIMEOUT", 60 * 10))
+
+
+async def aget_cached_page(key):
+    return await _page_cache().aget(key)
+
+
+async def aset_cached_page(key, response):
+    await _page_cache().aset(key, response, PAGE_CACHE.get("TIMEOUT", 60 * 10))
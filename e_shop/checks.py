@@ -0,0 +1,46 @@
+"""This is the system checks of application E_SHOP"""
+
+from django.core.checks import Error, Warning, Tags, register
+
+from online_shop import settings
+
+LOCAL_CACHES = ("django.core.cache.backends.locmem.LocMemCache",
+                "django.core.cache.backends.dummy.DummyCache")
+
+
+def _shared_cache_aliases():
+    # caches whose invalidations other processes have to see
+    aliases = {getattr(settings, "STOREFRONT_PAGE_CACHE", {}).get("CACHE_ALIAS", "default"),
+               getattr(settings, "PRODUCT_SUGGEST", {}).get("CACHE_ALIAS", "default"),
+               getattr(settings, "STOCK_RESERVATIONS", {}).get("CACHE_ALIAS", "default"),
+               getattr(settings, "TOKEN_AUTHENTICATION", {}).get("CACHE_ALIAS", "default"),
+               getattr(settings, "READ_REPLICAS", {}).get("CACHE_ALIAS", "default"),
+               getattr(settings, "CATEGORY_SIDEBAR_CACHE", {}).get("CACHE_ALIAS")}
+    return sorted(alias for alias in aliases if alias)
+
+
+def _local_caches():
+    caches = getattr(settings, "CACHES", {})
+    return [alias for alias in _shared_cache_aliases()
+            if caches.get(alias, {}).get("BACKEND", LOCAL_CACHES[0]) in LOCAL_CACHES]
+
+
+@register(Tags.caches)
+def check_shared_caches(app_configs, **kwargs):
+    """Page versions, ETags and held stock bumped in one process must be seen by the others"""
+    local = _local_caches()
+    if local and getattr(settings, "WEB_CONCURRENCY", 1) > 1:
+        return [Error(f"The cache '{alias}' is local to a process but WEB_CONCURRENCY runs "
+                      f"{settings.WEB_CONCURRENCY} of them, they would serve stale pages and 304s.",
+                      hint="Set CACHE_LOCATION to a cache shared by the processes.",
+                      id="e_shop.E001")
+                for alias in local]
+    return []
+
+
+@register(Tags.caches, deploy=True)
+def check_shared_caches_deploy(app_configs, **kwargs):
+    return [Warning(f"The cache '{alias}' is local to a process, it is only right with a single worker.",
+                    hint="Set CACHE_LOCATION to a cache shared by the processes.",
+                    id="e_shop.W001")
+            for alias in _local_caches()]
@@ -0,0 +1,82 @@
+"""This is the product counters of the categories of application E_SHOP"""
+
+from collections import defaultdict
+
+from django.db import transaction
+from django.db.models import F, Q, Count, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+
+from .cache import bump_model_version
+from .models import Category, Product
+
+COUNTERS = ("product_count", "available_count", "in_stock_count")
+STATE_FIELDS = ("category_id", "is_available", "amount")
+
+
+def product_state(category_id, is_available, amount):
+    """The counters of its category a product adds 1 to"""
+    counters = ["product_count"]
+    if is_available:
+        counters.append("available_count")
+        if amount > 0:
+            counters.append("in_stock_count")
+    return category_id, counters
+
+
+def state_deltas(before, after):
+    """
+    Changes of the counters when a product goes from state `before` to `after`,
+    states are (category_id, is_available, amount) and None for no product
+    """
+    deltas = defaultdict(lambda: defaultdict(int))
+    if before is not None:
+        category_id, counters = product_state(*before)
+        for counter in counters:
+            deltas[category_id][counter] -= 1
+    if after is not None:
+        category_id, counters = product_state(*after)
+        for counter in counters:
+            deltas[category_id][counter] += 1
+    return deltas
+
+
+def _counters_changed():
+    # updates send no signals, cached category lists and their ETags are bumped here
+    transaction.on_commit(lambda: bump_model_version(Category))
+
+
+def apply_deltas(deltas):
+    """Add the changes to the counters with F(), categories are updated in the order of their keys"""
+    updated = 0
+    for category_id in sorted(deltas):
+        changes = {counter: F(counter) + delta for counter, delta in deltas[category_id].items() if delta}
+        if changes:
+            updated += Category.objects.filter(pk=category_id).update(**changes)
+    if updated:
+        _counters_changed()
+
+
+def _count(condition):
+    return Coalesce(Subquery(Product.objects.filter(condition, category=OuterRef("pk"))
+                             .order_by().values("category")
+                             .annotate(count=Count("pk")).values("count")), Value(0))
+
+
+def recount_categories(category_ids=None):
+    """
+    Count the products of the categories again, all of them by default.
+    Return the ids of the categories whose counters had drifted.
+    """
+    categories = Category.objects.all()
+    if category_ids is not None:
+        categories = categories.filter(pk__in=category_ids)
+
+    before = {row[0]: row[1:] for row in categories.values_list("pk", *COUNTERS)}
+    categories.update(product_count=_count(Q()),
+                      available_count=_count(Q(is_available=True)),
+                      in_stock_count=_count(Q(is_available=True, amount__gt=0)))
+    after = {row[0]: row[1:] for row in categories.values_list("pk", *COUNTERS)}
+    drifted = [pk for pk, counters in after.items() if before.get(pk) != counters]
+    if drifted:
+        _counters_changed()
+    return drifted
@@ -0,0 +1,93 @@
+"""This is the purchase history export of application E_SHOP"""
+
+import csv
+import json
+from datetime import datetime, time, timedelta
+
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+from .models import Purchase
+
+CHUNK_SIZE = 2000
+FORMATS = ("csv", "jsonl")
+
+COLUMNS = (
+    ("id", "id"),
+    ("time_purchase", "time_purchase"),
+    ("customer_id", "customer_id"),
+    ("customer", "customer__username"),
+    ("product_id", "product_id"),
+    ("product", "product__name"),
+    ("category_id", "product__category_id"),
+    ("category", "product__category__name"),
+    ("amount", "amount"),
+    ("price", "price_at_time_purchase"),
+)
+
+
+def parse_moment(value, end=False):
+    """
+    A date or a datetime of a filter. A date starts the range at its first moment
+    or, with `end`, ends it right after the day, so date ranges include both days.
+    """
+    # dates first, parse_datetime reads a bare date as its midnight
+    day = parse_date(value)
+    if day is not None:
+        moment = datetime.combine(day + timedelta(days=1) if end else day, time.min)
+    else:
+        moment = parse_datetime(value)
+        if moment is None:
+            raise ValueError(f"Invalid date: {value}")
+    if timezone.is_naive(moment):
+        moment = timezone.make_aware(moment)
+    return moment
+
+
+def purchase_rows(date_from=None, date_to=None, customer=None, category=None):
+    """
+    Purchases joined with their customer, product and category as tuples in the
+    order of COLUMNS. The filters compare the purchase time as is, so the index
+    on time_purchase serves the date range.
+    """
+    queryset = Purchase.objects.all()
+    if date_from:
+        queryset = queryset.filter(time_purchase__gte=parse_moment(date_from))
+    if date_to:
+        queryset = queryset.filter(time_purchase__lt=parse_moment(date_to, end=True))
+    if customer:
+        queryset = queryset.filter(customer_id=customer)
+    if category:
+        queryset = queryset.filter(product__category_id=category)
+    return queryset.order_by("id").values_list(*(lookup for _, lookup in COLUMNS))
+
+
+def _record(row):
+    record = dict(zip((name for name, _ in COLUMNS), row))
+    record["time_purchase"] = record["time_purchase"].isoformat()
+    record["price"] = str(record["price"])
+    return record
+
+
+class _Echo:
+    # csv.writer writes into it and gets the line back
+    def write(self, value):
+        return value
+
+
+def render_csv(rows, chunk_size=CHUNK_SIZE):
+    writer = csv.writer(_Echo())
+    yield writer.writerow([name for name, _ in COLUMNS])
+    # a server-side cursor where the database supports it, memory use does not grow with the rows
+    for row in rows.iterator(chunk_size=chunk_size):
+        yield writer.writerow(_record(row).values())
+
+
+def render_jsonl(rows, chunk_size=CHUNK_SIZE):
+    for row in rows.iterator(chunk_size=chunk_size):
+        yield json.dumps(_record(row)) + "\n"
+
+
+def render(rows, export_format, chunk_size=CHUNK_SIZE):
+    renderer = {"csv": render_csv, "jsonl": render_jsonl}[export_format]
+    return renderer(rows, chunk_size)
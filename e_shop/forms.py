@@ -2,10 +2,14 @@ from django.contrib.auth.forms import UserCreationForm
 from django import forms
 from django.core.exceptions import ValidationError
 
+from .images import schedule_variants
 from .models import Customer, Purchase, Product, Category
+from .validators import validate_price
 
 
 class RegisterCustomerForm(UserCreationForm):
+    wallet = forms.DecimalField(max_digits=9, decimal_places=2, required=False)
+
     class Meta:
         model = Customer
         fields = ("username", "first_name", "last_name", "email",
@@ -13,31 +17,33 @@ class RegisterCustomerForm(UserCreationForm):
 
     def clean_wallet(self):
         wallet = self.cleaned_data.get("wallet")
-        if wallet < 0:
+        if wallet is not None and wallet < 0:
             raise ValidationError("The field can't be negative")
         return wallet
 
+    def save(self, commit=True):
+        # the balance of a new customer becomes its opening deposit in the ledger
+        self.instance.wallet = self.cleaned_data.get("wallet")
+        return super().save(commit=commit)
 
-class WalletCustomerForm(forms.ModelForm):
-    class Meta:
-        model = Customer
-        fields = ("wallet", )
-        labels = {"wallet": "Top up your account: "}
+
+class WalletCustomerForm(forms.Form):
+    wallet = forms.DecimalField(max_digits=9, decimal_places=2, label="Top up your account: ")
 
     def clean_wallet(self):
         wallet = self.cleaned_data.get("wallet")
-        if wallet < 0:
+        if wallet <= 0:
             raise ValidationError("Attention! You want to replenish your wallet, not to lose money)"
                                   " Use positive numbers")
         return wallet
 
 
 class BuyForm(forms.ModelForm):
-    def __init__(self, product=None, *args, **kwargs):
+    def __init__(self, product=None, *args, available=None, **kwargs):
         super().__init__(*args, **kwargs)
         self.product = product
         self.fields['amount'].widget.attrs["min"] = 1
-        self.fields['amount'].widget.attrs["max"] = self.product.amount
+        self.fields['amount'].widget.attrs["max"] = self.product.amount if available is None else available
 
     class Meta:
         model = Purchase
@@ -53,6 +59,15 @@ class BuyForm(forms.ModelForm):
         return form
 
 
+class ReserveForm(forms.Form):
+    amount = forms.IntegerField(min_value=1, max_value=1000, label="Hold quantity: ")
+
+    def __init__(self, *args, available=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        if available is not None:
+            self.fields['amount'].widget.attrs["max"] = available
+
+
 class AdminProductForm(forms.ModelForm):
     class Meta:
         model = Product
@@ -60,6 +75,19 @@ class AdminProductForm(forms.ModelForm):
 
     def clean_price(self):
         price = self.cleaned_data.get("price")
-        if price <= 0:
-            raise ValidationError("The price can't be negative and is equal to zero")
+        validate_price(price)
         return price
+
+    def save(self, commit=True):
+        product = super().save(commit=False)
+
+        # the old resized copies don't match a new photo
+        photo_changed = "photo" in self.changed_data
+        if photo_changed:
+            product.photo_variants = {}
+        if commit:
+            product.save()
+            self._save_m2m()
+            if photo_changed:
+                schedule_variants(product)
+        return product
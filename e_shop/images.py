@@ -0,0 +1,72 @@
+"""This is the product photo pipeline of application E_SHOP"""
+
+import os
+from io import BytesIO
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from PIL import Image, ImageOps
+
+from online_shop import settings
+from .cache import bump_model_version
+from .jobs import enqueue
+from .models import Product
+
+PHOTO_PIPELINE = getattr(settings, "PRODUCT_PHOTO_PIPELINE", {})
+VARIANTS = PHOTO_PIPELINE.get("VARIANTS", {"thumbnail": 300, "card": 600, "full": 1600})
+FORMATS = {"webp": "WEBP", "jpg": "JPEG"}
+
+
+def variant_name(photo_name, variant, extension):
+    root, _ = os.path.splitext(photo_name)
+    return f"{root}.{variant}.{extension}"
+
+
+def render_variants(photo_file):
+    """Yield (variant, extension, bytes) of every resized copy of an uploaded photo"""
+    with Image.open(photo_file) as image:
+        image = ImageOps.exif_transpose(image).convert("RGB")
+        for variant, max_side in VARIANTS.items():
+            resized = image.copy()
+            resized.thumbnail((max_side, max_side), Image.LANCZOS)
+            for extension, image_format in FORMATS.items():
+                buffer = BytesIO()
+                resized.save(buffer, image_format, quality=PHOTO_PIPELINE.get("QUALITY", 82),
+                             optimize=True)
+                yield variant, extension, buffer.getvalue()
+
+
+def delete_variants(names):
+    """Delete stored variant files, the missing ones are skipped"""
+    for name in names:
+        default_storage.delete(name)
+
+
+def generate_variants(product_id):
+    """Render and store the variants of the photo of a product, errors are left to the job queue"""
+    photo_name = Product.objects.filter(pk=product_id).values_list("photo", flat=True).first()
+    if not photo_name:
+        return
+
+    variants = {}
+    with default_storage.open(photo_name) as photo_file:
+        for variant, extension, content in render_variants(photo_file):
+            name = variant_name(photo_name, variant, extension)
+            if default_storage.exists(name):
+                default_storage.delete(name)
+            variants[f"{variant}.{extension}"] = default_storage.save(name, ContentFile(content))
+
+    # the photo may have been replaced while the variants were rendered
+    updated = Product.objects.filter(pk=product_id, photo=photo_name) \
+        .update(photo_variants=variants)
+    if updated:
+        bump_model_version(Product)
+    else:
+        # nothing refers to the copies of a replaced photo
+        delete_variants(variants.values())
+
+
+def schedule_variants(product):
+    """Queue the rendering of the variants, a worker picks it up once the saving transaction is committed"""
+    if product.photo:
+        enqueue("photo_variants", product_id=product.pk)
@@ -0,0 +1,308 @@
+"""This is the bulk product import of application E_SHOP"""
+
+import csv
+import inspect
+import io
+import json
+import logging
+import uuid
+
+from django.core.exceptions import ValidationError
+from django.core.files.storage import default_storage
+from django.db import transaction, IntegrityError, connection
+from django.db.models import QuerySet, BooleanField
+from django.utils.text import slugify
+
+from online_shop import settings
+from .cache import bump_model_version, invalidate_sidebar
+from .counters import recount_categories
+from .jobs import enqueue
+from .models import Product, Category
+from .suggest import SUGGEST_INDEX
+from .validators import validate_price
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1000
+IMPORT_INLINE_LIMIT = getattr(settings, "IMPORT_INLINE_LIMIT", 1024 * 1024)
+UPLOAD_DIRECTORY = "imports"
+FORMATS = ("csv", "jsonl")
+FIELDS = ("name", "description", "price", "amount", "is_available")
+MAX_ERRORS = 100
+BOOLEANS = {"true": True, "t": True, "yes": True, "y": True, "1": True,
+            "false": False, "f": False, "no": False, "n": False, "0": False}
+
+# bulk_create(update_conflicts=True) came with Django 4.1, before it the same
+# INSERT ... ON CONFLICT is written here, other databases get bulk_update
+NATIVE_UPSERT = "update_conflicts" in inspect.signature(QuerySet.bulk_create).parameters
+ON_CONFLICT_VENDORS = ("postgresql", "sqlite")
+
+
+class ImportStats:
+    def __init__(self):
+        self.rows = 0
+        self.created = 0
+        self.updated = 0
+        self.categories = 0
+        self.failed = 0
+        self.errors = []
+
+    def error(self, line, message):
+        self.failed += 1
+        if len(self.errors) < MAX_ERRORS:
+            self.errors.append({"line": line, "error": message})
+
+    def as_dict(self):
+        return {"rows": self.rows, "created": self.created, "updated": self.updated,
+                "categories": self.categories, "failed": self.failed, "errors": self.errors}
+
+
+def read_records(lines, file_format):
+    """Yield (line number, record) of a CSV or JSON Lines catalog, one line at a time"""
+    if file_format == "csv":
+        reader = csv.DictReader(lines)
+        for record in reader:
+            yield reader.line_num, record
+        return
+
+    for number, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+        try:
+            yield number, json.loads(line)
+        except ValueError:
+            yield number, ValidationError("Invalid JSON")
+
+
+def _clean_field(model, name, value):
+    field = model._meta.get_field(name)
+    if isinstance(field, BooleanField) and isinstance(value, str):
+        value = BOOLEANS.get(value.strip().lower(), value)
+    if value in (None, ""):
+        if field.has_default():
+            return field.get_default()
+        if field.blank and not field.null:
+            value = ""
+    return field.clean(value, None)
+
+
+def clean_record(record):
+    """The values of a product row, validated like the product forms do"""
+    if isinstance(record, ValidationError):
+        raise record
+    if not isinstance(record, dict):
+        raise ValidationError("A row must be an object")
+
+    values, errors = {}, {}
+    for name in FIELDS:
+        try:
+            values[name] = _clean_field(Product, name, record.get(name))
+        except ValidationError as exc:
+            errors[name] = exc.messages
+    if "price" in values:
+        try:
+            validate_price(values["price"])
+        except ValidationError as exc:
+            errors["price"] = exc.messages
+    try:
+        values["category"] = _clean_field(Category, "name", record.get("category"))
+    except ValidationError as exc:
+        errors["category"] = exc.messages
+    try:
+        values["slug"] = _clean_field(Product, "slug", record.get("slug")) if record.get("slug") else ""
+    except ValidationError as exc:
+        errors["slug"] = exc.messages
+
+    if errors:
+        raise ValidationError(errors)
+    return values
+
+
+def _slug_base(name, model, default):
+    max_length = model._meta.get_field("slug").max_length
+    return slugify(name)[:max_length].strip("-") or default
+
+
+def _unique_slugs(bases, taken, model):
+    """
+    A free slug for every (key, base) of `bases`, with a number appended when the
+    base is used. `taken` holds the slugs this import has used already.
+    """
+    max_length = model._meta.get_field("slug").max_length
+    existing = set(model.objects.filter(slug__in={base for _, base in bases})
+                   .values_list("slug", flat=True))
+    slugs = {}
+    for key, base in bases:
+        slug, number = base, 1
+        while slug in taken or slug in existing:
+            number += 1
+            suffix = f"-{number}"
+            slug = f"{base[:max_length - len(suffix)]}{suffix}"
+            if slug not in taken and model.objects.filter(slug=slug).exists():
+                existing.add(slug)
+        taken.add(slug)
+        slugs[key] = slug
+    return slugs
+
+
+def _category_ids(names, categories, stats):
+    """Ids of the categories by name, the missing ones are created"""
+    missing = set(names) - categories.keys()
+    if missing:
+        categories.update(Category.objects.filter(name__in=missing).values_list("name", "id"))
+        missing -= categories.keys()
+    if missing:
+        slugs = _unique_slugs([(name, _slug_base(name, Category, "category")) for name in missing],
+                              set(), Category)
+        Category.objects.bulk_create([Category(name=name, slug=slugs[name]) for name in missing])
+        categories.update(Category.objects.filter(name__in=missing).values_list("name", "id"))
+        stats.categories += len(missing)
+    return categories
+
+
+def _insert_on_conflict(products):
+    fields = [Product._meta.get_field(name) for name in
+              ("slug", "photo", "photo_variants", "category") + FIELDS]
+    columns = ", ".join(connection.ops.quote_name(field.column) for field in fields)
+    updates = ", ".join(f"{column} = EXCLUDED.{column}" for column in
+                        (connection.ops.quote_name(field.column) for field in fields[3:]))
+    row = "(" + ", ".join(["%s"] * len(fields)) + ")"
+
+    batch_size = connection.ops.bulk_batch_size(fields, products) or len(products)
+    with connection.cursor() as cursor:
+        for start in range(0, len(products), batch_size):
+            batch = products[start:start + batch_size]
+            params = [field.get_db_prep_save(getattr(product, field.attname), connection)
+                      for product in batch for field in fields]
+            cursor.execute(f"INSERT INTO {connection.ops.quote_name(Product._meta.db_table)} "
+                           f"({columns}) VALUES {', '.join([row] * len(batch))} "
+                           f"ON CONFLICT ({connection.ops.quote_name('slug')}) DO UPDATE SET {updates}",
+                           params)
+
+
+def _write(products, existing):
+    if NATIVE_UPSERT:
+        Product.objects.bulk_create(products, update_conflicts=True, unique_fields=["slug"],
+                                    update_fields=FIELDS + ("category", ))
+        return
+    if connection.vendor in ON_CONFLICT_VENDORS:
+        _insert_on_conflict(products)
+        return
+
+    updated = []
+    for product in products:
+        if product.slug in existing:
+            product.pk = existing[product.slug]
+            updated.append(product)
+    Product.objects.bulk_update(updated, FIELDS + ("category", ))
+    Product.objects.bulk_create([product for product in products if product.slug not in existing])
+
+
+def _save_chunk(rows, stats, categories, touched):
+    category_ids = _category_ids({values["category"] for _, values in rows}, categories, stats)
+
+    # a row without a slug updates the product of the same name or gets a new slug
+    slug_of_name = dict(Product.objects.filter(name__in=[values["name"] for _, values in rows])
+                        .values_list("name", "slug"))
+    needs_slug = {values["name"]: _slug_base(values["name"], Product, "product")
+                  for _, values in rows if not values["slug"] and values["name"] not in slug_of_name}
+    taken = {values["slug"] for _, values in rows if values["slug"]} | set(slug_of_name.values())
+    slug_of_name.update(_unique_slugs(needs_slug.items(), taken, Product))
+
+    # later rows of the same product win, a name can only belong to one slug
+    by_slug, owner = {}, {}
+    for line, values in rows:
+        slug = values["slug"] or slug_of_name[values["name"]]
+        if owner.get(values["name"], slug) != slug or slug_of_name.get(values["name"], slug) != slug:
+            stats.error(line, f"The name {values['name']!r} belongs to another product")
+            continue
+        owner[values["name"]] = slug
+        by_slug[slug] = (line, values)
+    if not by_slug:
+        return
+
+    stored = Product.objects.filter(slug__in=by_slug).values_list("slug", "id", "category_id")
+    existing = {slug: pk for slug, pk, _ in stored}
+    # products moved to another category change the counters of both
+    touched.update(category_id for _, _, category_id in stored)
+    touched.update(category_ids[values["category"]] for _, values in by_slug.values())
+    products = [(line, Product(slug=slug, category_id=category_ids[values["category"]],
+                               **{name: values[name] for name in FIELDS}))
+                for slug, (line, values) in by_slug.items()]
+
+    try:
+        with transaction.atomic():
+            _write([product for _, product in products], existing)
+    except IntegrityError:
+        # e.g. two products swapping their names, the rows are saved one by one
+        for line, product in products:
+            try:
+                with transaction.atomic():
+                    _write([product], existing)
+            except IntegrityError as exc:
+                stats.error(line, str(exc))
+                continue
+            if product.slug in existing:
+                stats.updated += 1
+            else:
+                stats.created += 1
+        return
+
+    stats.updated += len(existing)
+    stats.created += len(by_slug) - len(existing)
+
+
+def import_products(lines, file_format, chunk_size=CHUNK_SIZE, progress=None):
+    """
+    Create or update (by slug) the products of a CSV or JSON Lines catalog.
+    `lines` is any iterable of text lines, e.g. an open file, only one chunk
+    of rows is held in memory. `progress` is called with the stats after every chunk.
+    """
+    stats = ImportStats()
+    categories = {}
+    touched = set()
+    chunk = []
+
+    def flush():
+        _save_chunk(chunk, stats, categories, touched)
+        chunk.clear()
+        if progress:
+            progress(stats)
+
+    for line, record in read_records(lines, file_format):
+        stats.rows += 1
+        try:
+            chunk.append((line, clean_record(record)))
+        except ValidationError as exc:
+            stats.error(line, exc.message_dict if hasattr(exc, "error_dict") else exc.messages)
+            continue
+        if len(chunk) >= chunk_size:
+            flush()
+    if chunk:
+        flush()
+
+    # bulk queries send no signals, the counters of the touched categories are counted again
+    if stats.created or stats.updated:
+        recount_categories(touched)
+        bump_model_version(Product, Category)
+        invalidate_sidebar()
+        SUGGEST_INDEX.invalidate()
+    return stats
+
+
+def queue_import(catalog, file_format):
+    """Store an uploaded catalog and import it in a background job, return the job"""
+    path = default_storage.save(f"{UPLOAD_DIRECTORY}/{uuid.uuid4().hex}.{file_format}", catalog)
+    return enqueue("import_products", path=path, file_format=file_format)
+
+
+def import_stored(path, file_format):
+    """
+    Import a catalog stored by queue_import and delete it. A failed attempt keeps
+    the file for the next one, rows imported already are updated again by slug.
+    """
+    with default_storage.open(path, "rb") as stored:
+        stats = import_products(io.TextIOWrapper(stored, encoding="utf-8-sig", newline=""), file_format)
+    logger.info("Catalog %s imported: %s", path, stats.as_dict())
+    default_storage.delete(path)
+    return stats
@@ -0,0 +1,228 @@
+"""This is the background job queue of application E_SHOP, it needs nothing but the database"""
+
+import logging
+import multiprocessing
+import os
+import socket
+import threading
+import traceback
+import uuid
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from datetime import timedelta
+
+import django
+from django.db import transaction, connection, IntegrityError
+from django.db.models import F
+from django.utils import timezone
+
+from online_shop import settings
+from .models import Job
+
+logger = logging.getLogger(__name__)
+
+JOB_QUEUE = getattr(settings, "JOB_QUEUE", {})
+WORKERS = JOB_QUEUE.get("WORKERS", 4)
+POLL_INTERVAL = JOB_QUEUE.get("POLL_INTERVAL", 1)
+MAX_ATTEMPTS = JOB_QUEUE.get("MAX_ATTEMPTS", 5)
+BACKOFF = JOB_QUEUE.get("BACKOFF", 5)
+MAX_BACKOFF = JOB_QUEUE.get("MAX_BACKOFF", 60 * 60)
+LEASE = timedelta(seconds=JOB_QUEUE.get("LEASE", 60 * 10))
+KEEP_FINISHED = timedelta(seconds=JOB_QUEUE.get("KEEP_FINISHED", 60 * 60 * 24 * 7))
+PERIODIC = JOB_QUEUE.get("PERIODIC", {})
+
+TASKS = {}
+
+
+class UnknownTask(Exception):
+    pass
+
+
+def task(name):
+    """Register a function as the task `name`, it takes the keyword arguments of its jobs"""
+    def decorator(func):
+        TASKS[name] = func
+        return func
+    return decorator
+
+
+def enqueue(name, run_at=None, delay=None, key=None, max_attempts=MAX_ATTEMPTS, **kwargs):
+    """
+    Queue the task `name` with JSON serializable `kwargs` and return the job.
+    In a transaction the job is only seen by the workers once it is committed.
+    With a `key`, None is returned when a job with the same key is queued or running.
+    """
+    if name not in TASKS:
+        raise UnknownTask(name)
+    if run_at is None:
+        run_at = timezone.now() + timedelta(seconds=delay or 0)
+    job = Job(name=name, kwargs=kwargs, key=key, max_attempts=max_attempts, run_at=run_at)
+    if key is None:
+        job.save()
+        return job
+    try:
+        with transaction.atomic():
+            job.save()
+    except IntegrityError:
+        return None
+    return job
+
+
+def backoff(attempts):
+    """Seconds to wait before the next attempt after `attempts` failed ones"""
+    return min(BACKOFF * 2 ** (attempts - 1), MAX_BACKOFF)
+
+
+def claim(limit, worker):
+    """
+    Mark up to `limit` due jobs as running for `worker` and return them. Jobs
+    locked by other workers are skipped, the conditional update keeps the claim
+    exclusive on databases without row locks too.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        due = Job.objects.filter(status=Job.QUEUED, run_at__lte=now).order_by("run_at", "id")
+        if connection.features.has_select_for_update_skip_locked:
+            due = due.select_for_update(skip_locked=True)
+        job_ids = list(due.values_list("pk", flat=True)[:limit])
+        if not job_ids:
+            return []
+        token = f"{worker}:{uuid.uuid4().hex[:8]}"
+        Job.objects.filter(pk__in=job_ids, status=Job.QUEUED) \
+            .update(status=Job.RUNNING, locked_by=token, locked_at=now, attempts=F("attempts") + 1)
+    return list(Job.objects.filter(locked_by=token, status=Job.RUNNING).order_by("run_at", "id"))
+
+
+def _finish(job, error=None):
+    now = timezone.now()
+    running = Job.objects.filter(pk=job.pk, status=Job.RUNNING, locked_by=job.locked_by)
+    if error is None:
+        running.update(status=Job.DONE, time_done=now, last_error="")
+    elif job.attempts < job.max_attempts:
+        running.update(status=Job.QUEUED, run_at=now + timedelta(seconds=backoff(job.attempts)),
+                       last_error=error, locked_by="", locked_at=None)
+    else:
+        running.update(status=Job.FAILED, time_done=now, last_error=error)
+    _schedule_next(job.name, job.key)
+
+
+def execute(job_id):
+    """Run a claimed job, from a thread or from a process of the pool"""
+    try:
+        job = Job.objects.get(pk=job_id)
+        try:
+            func = TASKS.get(job.name)
+            if func is None:
+                raise UnknownTask(job.name)
+            func(**job.kwargs)
+        except Exception:
+            logger.exception("Job %s %s failed, attempt %s of %s", job.pk, job.name,
+                             job.attempts, job.max_attempts)
+            _finish(job, error=traceback.format_exc(limit=20))
+        else:
+            _finish(job)
+    finally:
+        connection.close()
+
+
+def _schedule_next(name, key):
+    interval = PERIODIC.get(name)
+    if interval and key == name:
+        # the next run of a periodic task, its key is free again
+        enqueue(name, delay=interval, key=name)
+
+
+def requeue_stale(lease=LEASE):
+    """Give the jobs of workers that died while running them back to the queue"""
+    stale = Job.objects.filter(status=Job.RUNNING, locked_at__lt=timezone.now() - lease)
+    exhausted = stale.filter(attempts__gte=F("max_attempts"))
+    periodic = list(exhausted.filter(key__in=list(PERIODIC)).values_list("name", "key"))
+    failed = exhausted.update(status=Job.FAILED, time_done=timezone.now(), last_error="The worker was lost")
+    for name, key in periodic:
+        _schedule_next(name, key)
+    return failed + stale.update(status=Job.QUEUED, locked_by="", locked_at=None)
+
+
+def renew_leases(jobs):
+    """Move the claim time of running `jobs` forward, requeue_stale leaves the jobs of live workers alone"""
+    if not jobs:
+        return 0
+    return Job.objects.filter(pk__in=[job.pk for job in jobs], locked_by__in={job.locked_by for job in jobs},
+                              status=Job.RUNNING).update(locked_at=timezone.now())
+
+
+def purge_finished(keep=KEEP_FINISHED):
+    deleted, _ = Job.objects.filter(status__in=(Job.DONE, Job.FAILED),
+                                    time_done__lt=timezone.now() - keep).delete()
+    return deleted
+
+
+def schedule_periodic():
+    """Queue the first run of every periodic task that has no queued or running job"""
+    for name in PERIODIC:
+        enqueue(name, key=name)
+
+
+@contextmanager
+def _closing_connection():
+    try:
+        yield
+    finally:
+        connection.close()
+
+
+class Worker:
+    """
+    Claim due jobs and run them in a pool of `concurrency` threads, or processes
+    for CPU bound tasks. The claimed jobs never outnumber the free slots, and their
+    leases are renewed while they run, however long that takes.
+    """
+
+    def __init__(self, concurrency=WORKERS, processes=False, poll_interval=POLL_INTERVAL, name=None):
+        self.concurrency = concurrency
+        self.processes = processes
+        self.poll_interval = poll_interval
+        self.name = name or f"{socket.gethostname()}:{os.getpid()}"
+        self.stopping = threading.Event()
+
+    def _executor(self):
+        if self.processes:
+            # spawned processes never share the connections of the worker, they set
+            # Django up before the first job is unpickled
+            return ProcessPoolExecutor(max_workers=self.concurrency, initializer=django.setup,
+                                       mp_context=multiprocessing.get_context("spawn"))
+        return ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="job")
+
+    def stop(self):
+        self.stopping.set()
+
+    def run(self, burst=False):
+        """Run jobs until stop() is called, or until the queue is empty with `burst`. Return the number run"""
+        housekeeping = timezone.now()
+        done = 0
+        # future -> the job it runs
+        running = {}
+        with self._executor() as executor, _closing_connection():
+            schedule_periodic()
+            while not self.stopping.is_set():
+                if timezone.now() >= housekeeping:
+                    renew_leases(list(running.values()))
+                    requeue_stale()
+                    purge_finished()
+                    housekeeping = timezone.now() + LEASE / 10
+
+                jobs = claim(self.concurrency - len(running), self.name) if len(running) < self.concurrency else []
+                running.update((executor.submit(execute, job.pk), job) for job in jobs)
+
+                if burst and not running:
+                    break
+                if running:
+                    finished, _ = wait(running, timeout=0 if jobs else self.poll_interval,
+                                       return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        del running[future]
+                    done += len(finished)
+                else:
+                    self.stopping.wait(self.poll_interval)
+            done += len(running)
+        return done
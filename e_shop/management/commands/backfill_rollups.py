@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from e_shop.analytics import backfill
+from e_shop.exports import parse_moment
+
+
+class Command(BaseCommand):
+    help = "Rebuild the hourly and daily sales rollups of whole days from the purchases, " \
+           "refunds recorded in the rollups are kept"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--from", dest="date_from", help="First day, by default the first sale")
+        parser.add_argument("--to", dest="date_to", help="Last day, by default today")
+
+    def handle(self, *args, **options):
+        try:
+            date_from = parse_moment(options["date_from"]) if options["date_from"] else None
+            date_to = parse_moment(options["date_to"]) if options["date_to"] else None
+        except ValueError as exc:
+            raise CommandError(exc)
+
+        written = backfill(date_from, date_to,
+                           stdout=self.stdout if options["verbosity"] > 1 else None)
+        self.stdout.write(self.style.SUCCESS(f"{written} rollups written"))
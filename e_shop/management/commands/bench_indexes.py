@@ -0,0 +1,120 @@
+import statistics
+import time
+from contextlib import contextmanager, nullcontext
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from e_shop.benchmarks import throwaway_databases
+from e_shop.models import Product, Purchase, PurchaseReturns
+from e_shop.seed import seed_shop
+
+INDEXED_MODELS = (Product, Purchase, PurchaseReturns)
+PLANNER_INDEX_SETTINGS = ("enable_indexscan", "enable_indexonlyscan", "enable_bitmapscan")
+
+
+class Command(BaseCommand):
+    help = "Seed a large shop into a throwaway test database and compare plans and latencies " \
+           "of the hot queries without and with indexes. With --skip-seed the configured " \
+           "PostgreSQL database keeps its indexes, its planner is told not to use any"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--categories", type=int, default=50)
+        parser.add_argument("--products", type=int, default=100000)
+        parser.add_argument("--customers", type=int, default=10000)
+        parser.add_argument("--purchases", type=int, default=1000000)
+        parser.add_argument("--refunds", type=int, default=10000)
+        parser.add_argument("--repeat", type=int, default=20)
+        parser.add_argument("--skip-seed", action="store_true",
+                            help="Measure the data that is already in the database")
+
+    def handle(self, *args, **options):
+        if options["skip_seed"] and connection.vendor != "postgresql":
+            raise CommandError("--skip-seed needs PostgreSQL, the indexes of the configured "
+                               "database are never dropped")
+        # a seeded shop goes to a throwaway test database, --skip-seed measures the configured one
+        databases = nullcontext() if options["skip_seed"] else throwaway_databases(options["verbosity"])
+        with databases:
+            self._benchmark(options)
+
+    def _benchmark(self, options):
+        if not options["skip_seed"]:
+            seed_shop(categories=options["categories"], products=options["products"],
+                      customers=options["customers"], purchases=options["purchases"],
+                      refunds=options["refunds"], seed=0, stdout=self.stdout)
+        self._analyze()
+
+        queries = self._queries()
+        self.stdout.write(self.style.MIGRATE_HEADING("Without indexes"))
+        with self._without_indexes(drop=not options["skip_seed"]):
+            before = self._measure(queries, options["repeat"])
+
+        self.stdout.write(self.style.MIGRATE_HEADING("With indexes"))
+        after = self._measure(queries, options["repeat"])
+
+        self.stdout.write(self.style.MIGRATE_HEADING("Median latency, ms"))
+        for name in queries:
+            self.stdout.write(f"{name:<24} {before[name]:>10.3f} {after[name]:>10.3f}"
+                              f" {before[name] / max(after[name], 1e-6):>8.1f}x")
+
+    def _queries(self):
+        product = list(Product.objects.filter(is_available=True).order_by("name", "id")[:1001])[-1]
+        customer_id = Purchase.objects.values_list("customer_id", flat=True).first()
+        return {
+            "storefront": Product.objects.filter(is_available=True).order_by("name", "id")[:5],
+            "storefront deep page": Product.objects.filter(is_available=True, name__gt=product.name)
+                                                   .order_by("name", "id")[:5],
+            "category": Product.objects.filter(category_id=product.category_id, is_available=True)
+                                       .order_by("name", "id")[:5],
+            "customer purchases": Purchase.objects.filter(customer_id=customer_id)
+                                                  .order_by("-time_purchase", "-id")[:11],
+            "all purchases": Purchase.objects.order_by("-time_purchase", "-id")[:4],
+            "refund queue": PurchaseReturns.objects.order_by("-time_request_return", "-id")[:4],
+        }
+
+    def _measure(self, queries, repeat):
+        medians = {}
+        for name, queryset in queries.items():
+            self.stdout.write(self.style.SQL_KEYWORD(name))
+            analyze = connection.vendor == "postgresql"
+            self.stdout.write(queryset.explain(analyze=analyze) if analyze else queryset.explain())
+
+            timings = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                list(queryset.all())
+                timings.append((time.perf_counter() - start) * 1000)
+            medians[name] = statistics.median(timings)
+        return medians
+
+    @contextmanager
+    def _without_indexes(self, drop):
+        if drop:
+            self._toggle_indexes(enabled=False)
+            try:
+                yield
+            finally:
+                self._toggle_indexes(enabled=True)
+            return
+
+        # no DDL on a live database: the settings only last for this transaction, which
+        # locks nothing, but primary keys are not used either
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                for setting in PLANNER_INDEX_SETTINGS:
+                    cursor.execute(f"SET LOCAL {setting} = off")
+            yield
+
+    def _toggle_indexes(self, enabled):
+        with connection.schema_editor() as schema_editor:
+            for model in INDEXED_MODELS:
+                for index in model._meta.indexes:
+                    if enabled:
+                        schema_editor.add_index(model, index)
+                    else:
+                        schema_editor.remove_index(model, index)
+        self._analyze()
+
+    def _analyze(self):
+        with connection.cursor() as cursor:
+            cursor.execute("ANALYZE")
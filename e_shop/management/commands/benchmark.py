@@ -0,0 +1,46 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from e_shop.benchmarks import run_benchmarks, throwaway_databases, compare_reports
+
+
+class Command(BaseCommand):
+    help = "Seed a shop into a throwaway test database, drive the storefront and the API " \
+           "in process and report latencies and query counts per endpoint as JSON"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--categories", type=int, default=10)
+        parser.add_argument("--products", type=int, default=1000)
+        parser.add_argument("--customers", type=int, default=100)
+        parser.add_argument("--purchases", type=int, default=10000)
+        parser.add_argument("--refunds", type=int, default=100)
+        parser.add_argument("--iterations", type=int, default=100)
+        parser.add_argument("--warmup", type=int, default=5)
+        parser.add_argument("--only", nargs="*", help="Names of the endpoints to drive")
+        parser.add_argument("--output", help="Write the report to this file")
+        parser.add_argument("--compare", help="A report of an earlier commit to compare with")
+        parser.add_argument("--tolerance", type=float, default=0.2,
+                            help="Allowed growth of p95 latency before it counts as a regression")
+
+    def handle(self, *args, **options):
+        with throwaway_databases(options["verbosity"]):
+            report = run_benchmarks(categories=options["categories"], products=options["products"],
+                                    customers=options["customers"], purchases=options["purchases"],
+                                    refunds=options["refunds"], iterations=options["iterations"],
+                                    warmup=options["warmup"], only=options["only"],
+                                    stdout=self.stdout if options["verbosity"] > 1 else None)
+
+        if options["compare"]:
+            with open(options["compare"]) as baseline:
+                report["regressions"] = compare_reports(json.load(baseline), report,
+                                                        options["tolerance"])
+
+        output = json.dumps(report, indent=2)
+        if options["output"]:
+            with open(options["output"], "w") as file:
+                file.write(output)
+        self.stdout.write(output)
+
+        if report.get("regressions"):
+            self.stderr.write(self.style.ERROR(f"Regressions: {', '.join(report['regressions'])}"))
@@ -0,0 +1,43 @@
+import json
+from contextlib import nullcontext
+
+from django.core.management.base import BaseCommand, CommandError
+
+from e_shop.benchmarks import run_server_benchmarks, throwaway_databases
+
+
+class Command(BaseCommand):
+    help = "Seed a shop into a throwaway test database and compare the throughput of the " \
+           "catalog pages under ASGI and WSGI, for the sync views and their async versions. " \
+           "Running servers are benchmarked on the products of their own database instead"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--requests", type=int, default=500, help="Requests per endpoint")
+        parser.add_argument("--concurrency", type=int, default=16)
+        parser.add_argument("--categories", type=int, default=10)
+        parser.add_argument("--products", type=int, default=1000)
+        parser.add_argument("--asgi-url", help="Base URL of a running ASGI server, e.g. uvicorn, "
+                                               "it must use the configured database")
+        parser.add_argument("--wsgi-url", help="Base URL of a running WSGI server, e.g. gunicorn, "
+                                               "it must use the configured database")
+        parser.add_argument("--output", help="Write the report to this file")
+
+    def handle(self, *args, **options):
+        # a running server never sees a throwaway database, its own catalog is read
+        external = options["asgi_url"] or options["wsgi_url"]
+        with nullcontext() if external else throwaway_databases(options["verbosity"]):
+            try:
+                report = run_server_benchmarks(requests=options["requests"],
+                                               concurrency=options["concurrency"],
+                                               asgi_url=options["asgi_url"], wsgi_url=options["wsgi_url"],
+                                               categories=options["categories"],
+                                               products=options["products"],
+                                               stdout=self.stdout if options["verbosity"] > 1 else None)
+            except ValueError as exc:
+                raise CommandError(exc)
+
+        output = json.dumps(report, indent=2)
+        if options["output"]:
+            with open(options["output"], "w") as file:
+                file.write(output)
+        self.stdout.write(output)
@@ -0,0 +1,27 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from e_shop.benchmarks import run_suggest_benchmarks
+
+
+class Command(BaseCommand):
+    help = "Build the typeahead index from generated names and report its memory, " \
+           "the latency of lookups and changes, and of the suggest view, as JSON"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--names", type=int, default=1000000)
+        parser.add_argument("--lookups", type=int, default=100000, help="Lookups per prefix length")
+        parser.add_argument("--changes", type=int, default=1000, help="Names added and removed")
+        parser.add_argument("--output", help="Write the report to this file")
+
+    def handle(self, *args, **options):
+        report = run_suggest_benchmarks(names=options["names"], lookups=options["lookups"],
+                                        changes=options["changes"],
+                                        stdout=self.stdout if options["verbosity"] > 1 else None)
+
+        output = json.dumps(report, indent=2)
+        if options["output"]:
+            with open(options["output"], "w") as file:
+                file.write(output)
+        self.stdout.write(output)
@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from e_shop.exports import purchase_rows, render, FORMATS, CHUNK_SIZE
+
+
+class Command(BaseCommand):
+    help = "Write the purchase history joined with products, categories and customers " \
+           "as CSV or JSON Lines, rows are streamed from a server-side cursor"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--format", choices=FORMATS, default="csv")
+        parser.add_argument("--output", help="Write to this file instead of stdout")
+        parser.add_argument("--from", dest="date_from", help="First date or datetime")
+        parser.add_argument("--to", dest="date_to", help="Last date or datetime")
+        parser.add_argument("--customer", type=int, help="Id of a customer")
+        parser.add_argument("--category", type=int, help="Id of a category")
+        parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+
+    def handle(self, *args, **options):
+        try:
+            rows = purchase_rows(date_from=options["date_from"], date_to=options["date_to"],
+                                 customer=options["customer"], category=options["category"])
+        except ValueError as exc:
+            raise CommandError(exc)
+
+        output = open(options["output"], "w", newline="") if options["output"] else self.stdout
+        try:
+            for chunk in render(rows, options["format"], options["chunk_size"]):
+                output.write(chunk)
+        finally:
+            if options["output"]:
+                output.close()
@@ -0,0 +1,39 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from e_shop.imports import import_products, FORMATS, CHUNK_SIZE
+
+
+class Command(BaseCommand):
+    help = "Create or update (by slug) products from a CSV or JSON Lines catalog, " \
+           "missing categories are created"
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="The catalog, with columns name, slug, description, "
+                                         "price, amount, category and is_available")
+        parser.add_argument("--format", choices=FORMATS,
+                            help="Format of the catalog, by default from the file extension")
+        parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+
+    def handle(self, *args, **options):
+        file_format = options["format"] or options["path"].rsplit(".", 1)[-1].lower()
+        if file_format not in FORMATS:
+            raise CommandError(f"Unknown format, use --format with one of: {', '.join(FORMATS)}")
+
+        started = time.perf_counter()
+
+        def progress(stats):
+            if options["verbosity"] > 0:
+                self.stdout.write(f"{stats.rows} rows: {stats.created} created, "
+                                  f"{stats.updated} updated, {stats.failed} failed "
+                                  f"({time.perf_counter() - started:.1f}s)")
+
+        with open(options["path"], newline="", encoding="utf-8-sig") as catalog:
+            stats = import_products(catalog, file_format, options["chunk_size"], progress)
+
+        for error in stats.errors:
+            self.stderr.write(f"line {error['line']}: {error['error']}")
+        self.stdout.write(self.style.SUCCESS(
+            f"{stats.created} products created, {stats.updated} updated, "
+            f"{stats.categories} categories created, {stats.failed} rows failed"))
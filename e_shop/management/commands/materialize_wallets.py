@@ -0,0 +1,25 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from e_shop.wallet import materialize, MATERIALIZE_MIN_TAIL, MATERIALIZE_BATCH_SIZE
+
+
+class Command(BaseCommand):
+    help = "Fold the recent wallet transactions into the balance snapshots, once or every --interval seconds"
+
+    def add_arguments(self, parser):
+        parser.add_argument("customers", nargs="*", type=int, help="Ids of customers, by default all of them")
+        parser.add_argument("--min-tail", type=int, default=MATERIALIZE_MIN_TAIL,
+                            help="Skip wallets with fewer transactions after their snapshot")
+        parser.add_argument("--batch-size", type=int, default=MATERIALIZE_BATCH_SIZE)
+        parser.add_argument("--interval", type=int, help="Keep materializing with this pause between runs")
+
+    def handle(self, *args, **options):
+        while True:
+            moved = materialize(options["customers"] or None, min_tail=options["min_tail"],
+                                batch_size=options["batch_size"])
+            self.stdout.write(self.style.SUCCESS(f"{moved} wallet snapshots materialized"))
+            if not options["interval"]:
+                return
+            time.sleep(options["interval"])
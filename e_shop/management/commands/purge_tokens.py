@@ -0,0 +1,22 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from e_shop.API.tokens import purge_expired_tokens, BATCH_SIZE
+
+
+class Command(BaseCommand):
+    help = "Delete expired JWT outstanding and blacklisted tokens in batches, run it from cron"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+        parser.add_argument("--pause", type=float, default=0,
+                            help="Seconds to sleep between batches")
+
+    def handle(self, *args, **options):
+        purged = 0
+        for purged in purge_expired_tokens(options["batch_size"]):
+            if options["verbosity"] > 1:
+                self.stdout.write(f"{purged} tokens purged")
+            time.sleep(options["pause"])
+        self.stdout.write(self.style.SUCCESS(f"{purged} expired tokens purged"))
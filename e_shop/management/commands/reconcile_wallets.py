@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+
+from e_shop.wallet import reconcile
+
+
+class Command(BaseCommand):
+    help = "Check the wallet snapshots against the sums of the ledger and optionally repair them"
+
+    def add_arguments(self, parser):
+        parser.add_argument("customers", nargs="*", type=int, help="Ids of customers, by default all of them")
+        parser.add_argument("--repair", action="store_true", help="Set the drifted snapshots to the ledger")
+
+    def handle(self, *args, **options):
+        drifted = reconcile(options["customers"] or None, repair=options["repair"])
+        for customer_id, balance, ledger in drifted:
+            self.stdout.write(f"{customer_id}: snapshot {balance}, ledger {ledger}")
+        if not drifted:
+            self.stdout.write(self.style.SUCCESS("Every wallet snapshot matches the ledger"))
+        elif options["repair"]:
+            self.stdout.write(self.style.SUCCESS(f"{len(drifted)} wallet snapshots repaired"))
+        else:
+            self.stdout.write(self.style.ERROR(f"{len(drifted)} wallet snapshots drifted"))
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from e_shop.cache import invalidate_sidebar
+from e_shop.counters import recount_categories
+from e_shop.models import Category
+
+
+class Command(BaseCommand):
+    help = "Count the products of the categories again and repair the denormalized counters"
+
+    def add_arguments(self, parser):
+        parser.add_argument("categories", nargs="*", type=int, help="Ids of categories, by default all of them")
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            drifted = recount_categories(options["categories"] or None)
+        if drifted:
+            invalidate_sidebar()
+        for category in Category.objects.filter(pk__in=drifted).order_by("pk"):
+            self.stdout.write(f"{category.pk} {category.name}: {category.product_count} products, "
+                              f"{category.available_count} available, {category.in_stock_count} in stock")
+        self.stdout.write(self.style.SUCCESS(f"{len(drifted)} categories repaired"))
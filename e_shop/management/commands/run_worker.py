@@ -0,0 +1,29 @@
+import signal
+
+from django.core.management.base import BaseCommand
+
+from e_shop.jobs import Worker, WORKERS, POLL_INTERVAL
+
+
+class Command(BaseCommand):
+    help = "Run the background jobs of the shop until it is stopped with SIGINT or SIGTERM"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--concurrency", type=int, default=WORKERS, help="Jobs run at the same time")
+        parser.add_argument("--processes", action="store_true",
+                            help="Run the jobs in a process pool instead of threads, e.g. for photos")
+        parser.add_argument("--poll-interval", type=float, default=POLL_INTERVAL,
+                            help="Seconds between looks at an empty queue")
+        parser.add_argument("--burst", action="store_true", help="Stop once no job is due")
+
+    def handle(self, *args, **options):
+        worker = Worker(options["concurrency"], processes=options["processes"],
+                        poll_interval=options["poll_interval"])
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            # the running jobs are finished first
+            signal.signal(signum, lambda *_: worker.stop())
+
+        self.stdout.write(f"Worker {worker.name} runs {worker.concurrency} "
+                          f"{'processes' if worker.processes else 'threads'}")
+        done = worker.run(burst=options["burst"])
+        self.stdout.write(self.style.SUCCESS(f"{done} jobs run"))
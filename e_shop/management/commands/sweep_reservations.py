@@ -0,0 +1,22 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from e_shop.reservations import sweep_expired, SWEEP_BATCH_SIZE
+
+
+class Command(BaseCommand):
+    help = "Delete expired stock reservations in batches, once or every --interval seconds"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=SWEEP_BATCH_SIZE)
+        parser.add_argument("--interval", type=int, help="Keep sweeping with this pause between runs")
+
+    def handle(self, *args, **options):
+        stdout = self.stdout if options["verbosity"] > 1 else None
+        while True:
+            deleted = sweep_expired(options["batch_size"], stdout=stdout)
+            self.stdout.write(self.style.SUCCESS(f"{deleted} expired reservations deleted"))
+            if not options["interval"]:
+                return
+            time.sleep(options["interval"])
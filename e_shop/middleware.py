@@ -0,0 +1,251 @@
+"""This is the request instrumentation of application E_SHOP"""
+
+import asyncio
+import contextvars
+import hashlib
+import random
+import re
+import time
+from bisect import bisect_left
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from threading import Lock
+
+from django.db import connections
+from django.db.backends.signals import connection_created
+
+from online_shop import settings
+
+INSTRUMENTATION = getattr(settings, "INSTRUMENTATION", {})
+
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERIES_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89)
+
+_current = contextvars.ContextVar("e_shop_request_metrics", default=None)
+
+
+def fingerprint(sql):
+    """The query with its literals replaced, equal fingerprints are the same query"""
+    sql = re.sub(r"'(?:[^']|'')*'", "?", sql)
+    sql = re.sub(r"\b\d+(\.\d+)?\b", "?", sql)
+    sql = re.sub(r"\(\s*\?(\s*,\s*\?)*\s*\)", "(?)", sql)
+    return re.sub(r"\s+", " ", sql).strip()
+
+
+class RequestMetrics:
+    def __init__(self, sample_queries):
+        self.queries = 0
+        self.timings = defaultdict(float)
+        self.sample_queries = sample_queries
+        self.fingerprints = Counter()
+
+    def record_query(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.timings["db"] += time.perf_counter() - start
+            self.queries += 1
+            if self.sample_queries:
+                self.fingerprints[fingerprint(sql)] += 1
+
+
+def _record_query(execute, sql, params, many, context):
+    # the request is found through the context, so queries that async views
+    # run in the threads of sync_to_async are counted as well
+    metrics = _current.get()
+    if metrics is None:
+        return execute(sql, params, many, context)
+    return metrics.record_query(execute, sql, params, many, context)
+
+
+def install_query_recorder(connection, **kwargs):
+    if _record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_record_query)
+
+
+connection_created.connect(install_query_recorder)
+
+
+@contextmanager
+def record_timing(name):
+    """Add the time spent in the block to the current request, e.g. "serializer" """
+    metrics = _current.get()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if metrics is not None:
+            metrics.timings[name] += time.perf_counter() - start
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", " ")
+
+
+class MetricsRegistry:
+    """In-memory metrics of this process, exported in the Prometheus text format"""
+
+    histograms = {
+        "eshop_request_duration_seconds": ("Total latency of a request", SECONDS_BUCKETS),
+        "eshop_db_duration_seconds": ("Time spent in database queries", SECONDS_BUCKETS),
+        "eshop_db_queries": ("Number of database queries", QUERIES_BUCKETS),
+        "eshop_template_render_seconds": ("Time spent rendering templates", SECONDS_BUCKETS),
+        "eshop_serializer_seconds": ("Time spent in REST serializers", SECONDS_BUCKETS),
+    }
+
+    def __init__(self, max_fingerprints=200):
+        self.max_fingerprints = max_fingerprints
+        self._lock = Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._histograms = {name: {} for name in self.histograms}
+            self._requests = Counter()
+            self._duplicates = Counter()
+            self._duplicate_sql = {}
+
+    def _observe(self, name, view, value):
+        histogram = self._histograms[name].get(view)
+        if histogram is None:
+            histogram = self._histograms[name][view] = Histogram(self.histograms[name][1])
+        histogram.observe(value)
+
+    def observe(self, view, status_code, duration, metrics, duplicate_threshold):
+        with self._lock:
+            self._requests[(view, status_code)] += 1
+            self._observe("eshop_request_duration_seconds", view, duration)
+            self._observe("eshop_db_duration_seconds", view, metrics.timings["db"])
+            self._observe("eshop_db_queries", view, metrics.queries)
+            if "template" in metrics.timings:
+                self._observe("eshop_template_render_seconds", view, metrics.timings["template"])
+            if "serializer" in metrics.timings:
+                self._observe("eshop_serializer_seconds", view, metrics.timings["serializer"])
+
+            for sql, repeated in metrics.fingerprints.items():
+                if repeated < duplicate_threshold:
+                    continue
+                key = hashlib.md5(sql.encode()).hexdigest()[:12]
+                if key not in self._duplicate_sql and len(self._duplicate_sql) >= self.max_fingerprints:
+                    continue
+                self._duplicate_sql[key] = sql[:200]
+                self._duplicates[(view, key)] += repeated
+
+    def export(self):
+        lines = ["# HELP eshop_requests_total Requests by view and status",
+                 "# TYPE eshop_requests_total counter"]
+        with self._lock:
+            for (view, status_code), value in sorted(self._requests.items()):
+                lines.append(f'eshop_requests_total{{view="{_escape(view)}",status="{status_code}"}} {value}')
+
+            for name, (description, buckets) in self.histograms.items():
+                lines += [f"# HELP {name} {description}", f"# TYPE {name} histogram"]
+                for view, histogram in sorted(self._histograms[name].items()):
+                    label = f'view="{_escape(view)}"'
+                    cumulative = 0
+                    for bound, count in zip(buckets, histogram.counts):
+                        cumulative += count
+                        lines.append(f'{name}_bucket{{{label},le="{bound}"}} {cumulative}')
+                    lines.append(f'{name}_bucket{{{label},le="+Inf"}} {histogram.count}')
+                    lines.append(f"{name}_sum{{{label}}} {histogram.sum}")
+                    lines.append(f"{name}_count{{{label}}} {histogram.count}")
+
+            lines += ["# HELP eshop_duplicate_queries_total Repeated queries of one request (N+1), sampled",
+                      "# TYPE eshop_duplicate_queries_total counter"]
+            for (view, key), value in sorted(self._duplicates.items()):
+                lines.append(f'eshop_duplicate_queries_total{{view="{_escape(view)}",fingerprint="{key}",'
+                             f'sql="{_escape(self._duplicate_sql[key])}"}} {value}')
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry(max_fingerprints=INSTRUMENTATION.get("MAX_FINGERPRINTS", 200))
+
+
+def view_name(request):
+    match = getattr(request, "resolver_match", None)
+    if match is None:
+        return "unresolved"
+    return match.view_name or match.route
+
+
+class InstrumentationMiddleware:
+    """
+    Measures every request: queries and their time, template rendering, REST
+    serialization and total latency. They are sent back in the Server-Timing header
+    and aggregated per view into REGISTRY, which the metrics view exports.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.sample_rate = INSTRUMENTATION.get("DUPLICATE_QUERY_SAMPLE_RATE", 0.1)
+        self.duplicate_threshold = INSTRUMENTATION.get("DUPLICATE_QUERY_THRESHOLD", 3)
+        if asyncio.iscoroutinefunction(self.get_response):
+            # the handler recognizes async middleware by this marker, like MiddlewareMixin
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def _start(self):
+        # connections opened before this module was imported have no recorder yet
+        for connection in connections.all():
+            install_query_recorder(connection)
+        metrics = RequestMetrics(sample_queries=random.random() < self.sample_rate)
+        return metrics, _current.set(metrics), time.perf_counter()
+
+    def _finish(self, request, response, metrics, start):
+        duration = time.perf_counter() - start
+
+        REGISTRY.observe(view_name(request), response.status_code, duration, metrics,
+                         self.duplicate_threshold)
+
+        timings = [f'db;dur={metrics.timings["db"] * 1000:.2f};desc="{metrics.queries} queries"']
+        for name in ("template", "serializer"):
+            if name in metrics.timings:
+                timings.append(f"{name};dur={metrics.timings[name] * 1000:.2f}")
+        timings.append(f"total;dur={duration * 1000:.2f}")
+        response["Server-Timing"] = ", ".join(timings)
+        return response
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        metrics, token, start = self._start()
+        try:
+            response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self._finish(request, response, metrics, start)
+
+    async def __acall__(self, request):
+        metrics, token, start = self._start()
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self._finish(request, response, metrics, start)
+
+    def process_template_response(self, request, response):
+        metrics = _current.get()
+        if metrics is not None:
+            start = time.perf_counter()
+
+            def rendered(response):
+                metrics.timings["template"] += time.perf_counter() - start
+
+            response.add_post_render_callback(rendered)
+        return response
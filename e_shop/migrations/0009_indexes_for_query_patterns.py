@@ -0,0 +1,37 @@
+# Generated by Django 4.0.5 on 2026-10-17 20:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('e_shop', '0008_alter_purchase_customer'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(condition=models.Q(('is_available', True)), fields=['name', 'id'], name='product_available_name_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(condition=models.Q(('is_available', True)), fields=['category', 'name', 'id'], name='product_available_cat_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['category', 'name', 'id'], name='product_cat_name_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='purchase',
+            index=models.Index(fields=['customer', '-time_purchase', '-id'], name='purchase_customer_time_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='purchase',
+            index=models.Index(fields=['-time_purchase', '-id'], name='purchase_time_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='purchasereturns',
+            index=models.Index(fields=['-time_request_return', '-id'], name='purchasereturns_time_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.0.5 on 2026-10-17 20:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('e_shop', '0009_indexes_for_query_patterns'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='photo_variants',
+            field=models.JSONField(blank=True, default=dict, editable=False, verbose_name='Resized copies of the photo'),
+        ),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 4.0.5 on 2026-10-17 20:47
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('e_shop', '0010_product_photo_variants'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SalesRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('period', models.CharField(choices=[('hour', 'Hour'), ('day', 'Day')], max_length=4, verbose_name='Period')),
+                ('bucket', models.DateTimeField(verbose_name='Start of the period')),
+                ('orders', models.PositiveIntegerField(default=0, verbose_name='Purchases')),
+                ('units_sold', models.PositiveIntegerField(default=0, verbose_name='Units sold')),
+                ('revenue', models.DecimalField(decimal_places=2, default=0, max_digits=14, verbose_name='Revenue')),
+                ('refunds', models.PositiveIntegerField(default=0, verbose_name='Refunds')),
+                ('units_refunded', models.PositiveIntegerField(default=0, verbose_name='Units refunded')),
+                ('refunded', models.DecimalField(decimal_places=2, default=0, max_digits=14, verbose_name='Refunded')),
+                ('category', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='e_shop.category', verbose_name='Product category')),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='e_shop.product', verbose_name='Product')),
+            ],
+            options={
+                'verbose_name': 'Sales rollup',
+                'verbose_name_plural': 'Sales rollups',
+                'ordering': ['-bucket'],
+            },
+        ),
+        migrations.AddIndex(
+            model_name='salesrollup',
+            index=models.Index(fields=['period', 'bucket'], name='salesrollup_period_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='salesrollup',
+            constraint=models.UniqueConstraint(fields=('period', 'bucket', 'product'), name='salesrollup_unique_bucket'),
+        ),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 4.0.5 on 2026-10-17 20:51
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Q, Subquery, Value
+from django.db.models.functions import Coalesce
+
+
+def count_products(apps, schema_editor):
+    Category = apps.get_model('e_shop', 'Category')
+    Product = apps.get_model('e_shop', 'Product')
+
+    def count(condition):
+        return Coalesce(Subquery(Product.objects.filter(condition, category=OuterRef('pk'))
+                                 .order_by().values('category')
+                                 .annotate(count=Count('pk')).values('count')), Value(0))
+
+    Category.objects.update(product_count=count(Q()),
+                            available_count=count(Q(is_available=True)),
+                            in_stock_count=count(Q(is_available=True, amount__gt=0)))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('e_shop', '0011_salesrollup'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='category',
+            name='available_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='Available products'),
+        ),
+        migrations.AddField(
+            model_name='category',
+            name='in_stock_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='Available products in stock'),
+        ),
+        migrations.AddField(
+            model_name='category',
+            name='product_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='Products'),
+        ),
+        migrations.RunPython(count_products, migrations.RunPython.noop),
+    ]
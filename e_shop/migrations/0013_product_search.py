@@ -0,0 +1,22 @@
+from django.db import migrations
+
+from e_shop.search import install_search_index, drop_search_index
+
+
+def install(apps, schema_editor):
+    install_search_index(schema_editor.connection)
+
+
+def uninstall(apps, schema_editor):
+    drop_search_index(schema_editor.connection)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('e_shop', '0012_category_counters'),
+    ]
+
+    operations = [
+        migrations.RunPython(install, uninstall),
+    ]
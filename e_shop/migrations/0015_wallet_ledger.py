@@ -0,0 +1,91 @@
+# Generated by Django 4.0.5 on 2026-10-17 21:08
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery, Sum
+import django.db.models.deletion
+
+CHUNK_SIZE = 10000
+
+
+def open_ledger(apps, schema_editor):
+    """Every balance becomes an opening deposit and a snapshot that includes it"""
+    Customer = apps.get_model('e_shop', 'Customer')
+    WalletTransaction = apps.get_model('e_shop', 'WalletTransaction')
+    WalletSnapshot = apps.get_model('e_shop', 'WalletSnapshot')
+
+    balances = Customer.objects.exclude(wallet=None).exclude(wallet=0) \
+        .order_by('pk').values_list('pk', 'wallet')
+    chunk = []
+    for row in balances.iterator(chunk_size=CHUNK_SIZE):
+        chunk.append(row)
+        if len(chunk) == CHUNK_SIZE:
+            _open(WalletTransaction, WalletSnapshot, chunk)
+            chunk = []
+    _open(WalletTransaction, WalletSnapshot, chunk)
+
+
+def _open(WalletTransaction, WalletSnapshot, balances):
+    WalletTransaction.objects.bulk_create([
+        WalletTransaction(customer_id=pk, amount=wallet, kind='deposit') for pk, wallet in balances])
+    opened = WalletTransaction.objects.filter(customer_id__in=[pk for pk, _ in balances]) \
+        .values_list('customer_id', 'pk', 'amount')
+    WalletSnapshot.objects.bulk_create([
+        WalletSnapshot(customer_id=customer_id, balance=amount, last_transaction_id=pk)
+        for customer_id, pk, amount in opened])
+
+
+def close_ledger(apps, schema_editor):
+    Customer = apps.get_model('e_shop', 'Customer')
+    WalletTransaction = apps.get_model('e_shop', 'WalletTransaction')
+
+    Customer.objects.update(wallet=Subquery(
+        WalletTransaction.objects.filter(customer=OuterRef('pk')).order_by().values('customer')
+        .annotate(total=Sum('amount')).values('total')))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('e_shop', '0014_stockreservation'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WalletSnapshot',
+            fields=[
+                ('customer', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='wallet_snapshot', serialize=False, to=settings.AUTH_USER_MODEL, verbose_name='Customer')),
+                ('balance', models.DecimalField(decimal_places=2, default=0, max_digits=14, verbose_name='Balance')),
+                ('last_transaction_id', models.BigIntegerField(default=0, verbose_name='Last transaction')),
+                ('time_update', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name': 'Wallet snapshot',
+                'verbose_name_plural': 'Wallet snapshots',
+            },
+        ),
+        migrations.CreateModel(
+            name='WalletTransaction',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('amount', models.DecimalField(decimal_places=2, max_digits=12, verbose_name='Amount')),
+                ('kind', models.CharField(choices=[('deposit', 'Deposit'), ('purchase', 'Purchase'), ('refund', 'Refund')], max_length=8, verbose_name='Kind')),
+                ('time_create', models.DateTimeField(auto_now_add=True)),
+                ('customer', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='wallet_transactions', to=settings.AUTH_USER_MODEL, verbose_name='Customer')),
+            ],
+            options={
+                'verbose_name': 'Wallet transaction',
+                'verbose_name_plural': 'Wallet transactions',
+                'ordering': ['-id'],
+            },
+        ),
+        migrations.AddIndex(
+            model_name='wallettransaction',
+            index=models.Index(fields=['customer', 'id'], name='wallet_tx_customer_idx'),
+        ),
+        migrations.RunPython(open_ledger, close_ledger),
+        migrations.RemoveField(
+            model_name='customer',
+            name='wallet',
+        ),
+    ]
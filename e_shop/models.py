@@ -1,6 +1,8 @@
 from django.contrib.auth.models import AbstractUser
+from django.core.files.storage import default_storage
 from django.core.validators import MinValueValidator, MaxValueValidator
-from django.db import models
+from django.db import models, router, transaction
+from django.db.models import Q
 from django.urls import reverse
 from django.utils.translation import gettext as _
 
@@ -8,8 +10,6 @@ from online_shop import settings
 
 
 class Customer(AbstractUser):
-    wallet = models.DecimalField(max_digits=9, decimal_places=2, null=True, blank=True)
-
     class Meta:
         verbose_name = _("Customer")
         verbose_name_plural = _("Customers")
@@ -18,6 +18,34 @@ class Customer(AbstractUser):
     def __str__(self):
         return self.username
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+
+        # remember the loaded state, signal handlers compare against it
+        instance._loaded_values = dict(zip(field_names, values))
+        return instance
+
+    @property
+    def wallet(self):
+        """
+        The balance of the wallet, read from the ledger once per instance. Money
+        is moved with the functions of e_shop.wallet, never by saving the customer.
+        """
+        if "_wallet" not in self.__dict__:
+            from .wallet import balance_of
+
+            self._wallet = balance_of(self) if self.pk else self.__dict__.get("_opening_deposit") or 0
+        return self._wallet
+
+    @wallet.setter
+    def wallet(self, value):
+        # only a new customer takes a balance, it becomes the opening deposit when saved
+        if not self._state.adding:
+            raise AttributeError("The wallet of a saved customer is changed with e_shop.wallet")
+        self._opening_deposit = value
+        self._wallet = value
+
 
 class Product(models.Model):
     name = models.CharField(max_length=100, unique=True, db_index=True, verbose_name=_("Name of product"))
@@ -25,6 +53,8 @@ class Product(models.Model):
     description = models.TextField(blank=True, verbose_name=_("Description"))
     price = models.DecimalField(max_digits=9, decimal_places=2, verbose_name=_("Price"))
     photo = models.ImageField(blank=True, upload_to="photos/%Y/%m/%d/", verbose_name=_("Photo"))
+    photo_variants = models.JSONField(default=dict, blank=True, editable=False,
+                                      verbose_name=_("Resized copies of the photo"))
     amount = models.PositiveSmallIntegerField(verbose_name=_("Quantity in stock"))
     category = models.ForeignKey("Category", on_delete=models.PROTECT, verbose_name=_("Product category"))
     is_available = models.BooleanField(default=True, verbose_name=_("Available"))
@@ -33,13 +63,45 @@ class Product(models.Model):
         verbose_name = _("Product")
         verbose_name_plural = _("Products")
         ordering = ["name"]
+        indexes = [
+            models.Index(fields=["name", "id"], condition=Q(is_available=True),
+                         name="product_available_name_idx"),
+            models.Index(fields=["category", "name", "id"], condition=Q(is_available=True),
+                         name="product_available_cat_idx"),
+            models.Index(fields=["category", "name", "id"], name="product_cat_name_idx"),
+        ]
 
     def __str__(self):
         return self.name[:30]
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+
+        # remember the loaded state, signal handlers compare against it
+        instance._loaded_values = dict(zip(field_names, values))
+        return instance
+
+    def save(self, *args, **kwargs):
+        # the signal handlers move the counters of the categories, in the transaction of the row
+        using = kwargs.get("using") or router.db_for_write(type(self), instance=self)
+        with transaction.atomic(using=using):
+            super().save(*args, **kwargs)
+
     def get_absolute_url(self):
         return reverse("product", kwargs={"prod_slug": self.slug})
 
+    @property
+    def photo_urls(self):
+        """URLs of the resized photos as {variant: {extension: url}}, None until they are ready"""
+        if not self.photo or not self.photo_variants:
+            return None
+        urls = {}
+        for key, name in self.photo_variants.items():
+            variant, extension = key.split(".")
+            urls.setdefault(variant, {})[extension] = default_storage.url(name)
+        return urls
+
 
 class Purchase(models.Model):
     customer = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.PROTECT, related_name='purchases')
@@ -53,6 +115,10 @@ class Purchase(models.Model):
         verbose_name = _("Purchase")
         verbose_name_plural = _("Purchases")
         ordering = ["-time_purchase"]
+        indexes = [
+            models.Index(fields=["customer", "-time_purchase", "-id"], name="purchase_customer_time_idx"),
+            models.Index(fields=["-time_purchase", "-id"], name="purchase_time_idx"),
+        ]
 
     def __str__(self):
         return f"Invoice #{self.pk}"
@@ -66,6 +132,9 @@ class PurchaseReturns(models.Model):
         verbose_name = _("Purchase returns")
         verbose_name_plural = _("Purchase returns")
         ordering = ["-time_request_return"]
+        indexes = [
+            models.Index(fields=["-time_request_return", "-id"], name="purchasereturns_time_idx"),
+        ]
 
     def __str__(self):
         return f"Return invoice #{self.to_purchase.pk}"
@@ -75,6 +144,14 @@ class Category(models.Model):
     name = models.CharField(max_length=50, unique=True, db_index=True, verbose_name=_("Product category"))
     slug = models.SlugField(max_length=100, unique=True, db_index=True, verbose_name="URL")
 
+    # maintained by e_shop.counters, the recount command repairs them
+    product_count = models.PositiveIntegerField(default=0, editable=False,
+                                                verbose_name=_("Products"))
+    available_count = models.PositiveIntegerField(default=0, editable=False,
+                                                  verbose_name=_("Available products"))
+    in_stock_count = models.PositiveIntegerField(default=0, editable=False,
+                                                 verbose_name=_("Available products in stock"))
+
     class Meta:
         verbose_name = _("Category")
         verbose_name_plural = _("Categories")
@@ -85,3 +162,161 @@ class Category(models.Model):
 
     def get_absolute_url(self):
         return reverse("category", kwargs={"cat_slug": self.slug})
+
+
+class SalesRollup(models.Model):
+    """
+    Sales of a product in an hour or a day, kept up to date by the checkout and the
+    refunds. Refunds are counted in the bucket of the refunded sale.
+    """
+    HOUR = "hour"
+    DAY = "day"
+    PERIODS = [(HOUR, _("Hour")), (DAY, _("Day"))]
+
+    period = models.CharField(max_length=4, choices=PERIODS, verbose_name=_("Period"))
+    bucket = models.DateTimeField(verbose_name=_("Start of the period"))
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, verbose_name=_("Product"))
+    category = models.ForeignKey(Category, on_delete=models.CASCADE, verbose_name=_("Product category"))
+    orders = models.PositiveIntegerField(default=0, verbose_name=_("Purchases"))
+    units_sold = models.PositiveIntegerField(default=0, verbose_name=_("Units sold"))
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0, verbose_name=_("Revenue"))
+    refunds = models.PositiveIntegerField(default=0, verbose_name=_("Refunds"))
+    units_refunded = models.PositiveIntegerField(default=0, verbose_name=_("Units refunded"))
+    refunded = models.DecimalField(max_digits=14, decimal_places=2, default=0, verbose_name=_("Refunded"))
+
+    class Meta:
+        verbose_name = _("Sales rollup")
+        verbose_name_plural = _("Sales rollups")
+        ordering = ["-bucket"]
+        constraints = [
+            models.UniqueConstraint(fields=["period", "bucket", "product"], name="salesrollup_unique_bucket"),
+        ]
+        indexes = [
+            models.Index(fields=["period", "bucket"], name="salesrollup_period_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.product_id} {self.period} {self.bucket:%Y-%m-%d %H:%M}"
+
+
+class StockReservation(models.Model):
+    """
+    Units of a product held for a customer until `expires_at`, they can't be sold
+    to anybody else meanwhile. A customer has at most one hold per product, the
+    checkout consumes it and the sweeper deletes the expired ones.
+    """
+    customer = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE,
+                                 related_name="reservations", verbose_name=_("Customer"))
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name="reservations",
+                                verbose_name=_("Product"))
+    amount = models.PositiveSmallIntegerField(validators=[MinValueValidator(1), MaxValueValidator(1000)],
+                                              verbose_name=_("Units held"))
+    time_create = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField(verbose_name=_("Held until"))
+
+    class Meta:
+        verbose_name = _("Stock reservation")
+        verbose_name_plural = _("Stock reservations")
+        ordering = ["expires_at"]
+        constraints = [
+            models.UniqueConstraint(fields=["customer", "product"], name="reservation_unique_hold"),
+        ]
+        indexes = [
+            models.Index(fields=["product", "expires_at"], name="reservation_product_idx"),
+            models.Index(fields=["expires_at"], name="reservation_expires_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.amount} of {self.product_id} for {self.customer_id}"
+
+
+class WalletTransaction(models.Model):
+    """
+    An entry of the append-only wallet ledger, negative amounts are debits.
+    The balance of a customer is the sum of the entries.
+    """
+    DEPOSIT = "deposit"
+    PURCHASE = "purchase"
+    REFUND = "refund"
+    KINDS = [(DEPOSIT, _("Deposit")), (PURCHASE, _("Purchase")), (REFUND, _("Refund"))]
+
+    id = models.BigAutoField(primary_key=True)
+    customer = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE,
+                                 related_name="wallet_transactions", verbose_name=_("Customer"))
+    amount = models.DecimalField(max_digits=12, decimal_places=2, verbose_name=_("Amount"))
+    kind = models.CharField(max_length=8, choices=KINDS, verbose_name=_("Kind"))
+    time_create = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name = _("Wallet transaction")
+        verbose_name_plural = _("Wallet transactions")
+        ordering = ["-id"]
+        indexes = [
+            models.Index(fields=["customer", "id"], name="wallet_tx_customer_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.kind} {self.amount} for {self.customer_id}"
+
+
+class WalletSnapshot(models.Model):
+    """
+    The balance of a customer up to `last_transaction_id`, moved forward by the
+    materialize_wallets command. Appends to the ledger lock this row.
+    """
+    customer = models.OneToOneField(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, primary_key=True,
+                                    related_name="wallet_snapshot", verbose_name=_("Customer"))
+    balance = models.DecimalField(max_digits=14, decimal_places=2, default=0, verbose_name=_("Balance"))
+    last_transaction_id = models.BigIntegerField(default=0, verbose_name=_("Last transaction"))
+    time_update = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = _("Wallet snapshot")
+        verbose_name_plural = _("Wallet snapshots")
+
+    def __str__(self):
+        return f"{self.balance} for {self.customer_id} up to {self.last_transaction_id}"
+
+
+class Job(models.Model):
+    """
+    A side effect to run outside of the request, see e_shop.jobs. Workers claim
+    queued jobs that are due with SELECT ... FOR UPDATE SKIP LOCKED.
+    """
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    STATUSES = [(QUEUED, _("Queued")), (RUNNING, _("Running")), (DONE, _("Done")), (FAILED, _("Failed"))]
+
+    id = models.BigAutoField(primary_key=True)
+    name = models.CharField(max_length=100, verbose_name=_("Task"))
+    kwargs = models.JSONField(default=dict, blank=True, verbose_name=_("Arguments"))
+    key = models.CharField(max_length=100, null=True, blank=True,
+                           verbose_name=_("At most one queued or running job has this key"))
+    status = models.CharField(max_length=7, choices=STATUSES, default=QUEUED, verbose_name=_("Status"))
+    attempts = models.PositiveSmallIntegerField(default=0, verbose_name=_("Attempts"))
+    max_attempts = models.PositiveSmallIntegerField(default=5, verbose_name=_("Max attempts"))
+    run_at = models.DateTimeField(verbose_name=_("Due at"))
+    locked_by = models.CharField(max_length=100, blank=True, verbose_name=_("Worker"))
+    locked_at = models.DateTimeField(null=True, blank=True, verbose_name=_("Claimed at"))
+    last_error = models.TextField(blank=True, verbose_name=_("Last error"))
+    time_create = models.DateTimeField(auto_now_add=True)
+    time_done = models.DateTimeField(null=True, blank=True, verbose_name=_("Finished at"))
+
+    class Meta:
+        verbose_name = _("Job")
+        verbose_name_plural = _("Jobs")
+        ordering = ["-id"]
+        constraints = [
+            models.UniqueConstraint(fields=["key"], condition=Q(status__in=["queued", "running"]),
+                                    name="job_unique_key"),
+        ]
+        indexes = [
+            models.Index(fields=["run_at", "id"], condition=Q(status="queued"), name="job_queued_idx"),
+            models.Index(fields=["locked_at"], condition=Q(status="running"), name="job_running_idx"),
+            models.Index(fields=["time_done"], name="job_done_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.name} #{self.pk} {self.status}"
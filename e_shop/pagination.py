@@ -0,0 +1,155 @@
+"""This is the keyset (cursor) pagination of application E_SHOP"""
+
+import base64
+import binascii
+import json
+
+from django.core.exceptions import FieldDoesNotExist
+from django.db.models import Q, FloatField
+from django.http import Http404
+
+from .asyncorm import alist
+
+
+def encode_cursor(values, reverse=False):
+    data = json.dumps({"k": values, "r": reverse}, default=str, separators=(",", ":"))
+    return base64.urlsafe_b64encode(data.encode()).decode()
+
+
+def _ordering_field(model, name):
+    try:
+        return model._meta.get_field(name)
+    except FieldDoesNotExist:
+        # an annotation, e.g. the rank of a search
+        return FloatField()
+
+
+def decode_cursor(cursor, model, ordering):
+    """Return the key values and the direction of a cursor, raise ValueError if it is broken"""
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        values, reverse = data["k"], bool(data["r"])
+    except (binascii.Error, ValueError, TypeError, KeyError):
+        raise ValueError("Invalid cursor")
+    if not isinstance(values, list) or len(values) != len(ordering):
+        raise ValueError("Invalid cursor")
+
+    fields = [_ordering_field(model, name.lstrip("-")) for name in ordering]
+    try:
+        return [field.to_python(value) for field, value in zip(fields, values)], reverse
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+
+def keyset_filter(ordering, values):
+    """
+    Rows that come after `values` in `ordering`, for ("-time_purchase", "-id"):
+    time_purchase < t OR (time_purchase = t AND id < i)
+    """
+    condition = Q()
+    equal = {}
+    for name, value in zip(ordering, values):
+        field = name.lstrip("-")
+        lookup = "lt" if name.startswith("-") else "gt"
+        condition |= Q(**equal, **{f"{field}__{lookup}": value})
+        equal[field] = value
+    return condition
+
+
+def reverse_ordering(ordering):
+    return [name[1:] if name.startswith("-") else f"-{name}" for name in ordering]
+
+
+class KeysetPage:
+    """A page of a keyset paginated queryset, it never counts the whole queryset"""
+
+    def __init__(self, object_list, ordering, has_next, has_previous):
+        self.object_list = object_list
+        self.ordering = ordering
+        self._has_next = has_next
+        self._has_previous = has_previous
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_next(self):
+        return self._has_next
+
+    def has_previous(self):
+        return self._has_previous
+
+    def has_other_pages(self):
+        return self._has_next or self._has_previous
+
+    def _key(self, obj):
+        return [getattr(obj, name.lstrip("-")) for name in self.ordering]
+
+    # an empty page has no key to continue from, e.g. the page before the first row
+    @property
+    def next_cursor(self):
+        if self._has_next and self.object_list:
+            return encode_cursor(self._key(self.object_list[-1]))
+
+    @property
+    def previous_cursor(self):
+        if self._has_previous and self.object_list:
+            return encode_cursor(self._key(self.object_list[0]), reverse=True)
+
+
+def _keyset_queryset(queryset, ordering, page_size, cursor):
+    reverse = False
+    if cursor:
+        values, reverse = decode_cursor(cursor, queryset.model, ordering)
+        if reverse:
+            queryset = queryset.filter(keyset_filter(reverse_ordering(ordering), values))
+        else:
+            queryset = queryset.filter(keyset_filter(ordering, values))
+
+    queryset = queryset.order_by(*(reverse_ordering(ordering) if reverse else ordering))
+
+    # one extra row tells whether there is a page after this one
+    return queryset[:page_size + 1], reverse
+
+
+def _keyset_page(rows, ordering, page_size, cursor, reverse):
+    has_more = len(rows) > page_size
+    rows = rows[:page_size]
+
+    if reverse:
+        rows.reverse()
+        return KeysetPage(rows, ordering, has_next=True, has_previous=has_more)
+    return KeysetPage(rows, ordering, has_next=has_more, has_previous=bool(cursor))
+
+
+def paginate_keyset(queryset, ordering, page_size, cursor=None):
+    """
+    Take one page of `queryset` after (or before) the cursor.
+    `ordering` must be unique, so it always ends with the primary key.
+    """
+    ordering = list(ordering)
+    queryset, reverse = _keyset_queryset(queryset, ordering, page_size, cursor)
+    return _keyset_page(list(queryset), ordering, page_size, cursor, reverse)
+
+
+async def apaginate_keyset(queryset, ordering, page_size, cursor=None):
+    """paginate_keyset for async views"""
+    ordering = list(ordering)
+    queryset, reverse = _keyset_queryset(queryset, ordering, page_size, cursor)
+    return _keyset_page(await alist(queryset), ordering, page_size, cursor, reverse)
+
+
+class KeysetPaginationMixin:
+    """Keyset pagination for a ListView, the position is passed in the `cursor` parameter"""
+    keyset_ordering = ("id", )
+    cursor_kwarg = "cursor"
+
+    def paginate_queryset(self, queryset, page_size):
+        cursor = self.request.GET.get(self.cursor_kwarg)
+        try:
+            page = paginate_keyset(queryset, self.keyset_ordering, page_size, cursor)
+        except ValueError:
+            raise Http404("Invalid cursor")
+        return None, page, page.object_list, page.has_other_pages()
@@ -0,0 +1,137 @@
+"""This is the stock reservations (holds) of application E_SHOP"""
+
+import time
+from datetime import timedelta
+
+from django.core.cache import caches
+from django.db.models import Sum, Min
+from django.utils import timezone
+
+from online_shop import settings
+from .models import StockReservation
+
+RESERVATIONS = getattr(settings, "STOCK_RESERVATIONS", {})
+RESERVATION_TTL = timedelta(seconds=RESERVATIONS.get("TTL", 60 * 10))
+SWEEP_BATCH_SIZE = RESERVATIONS.get("SWEEP_BATCH_SIZE", 1000)
+
+
+def _cache():
+    return caches[RESERVATIONS.get("CACHE_ALIAS", "default")]
+
+
+def _version_key(product_id):
+    return f"e_shop:held-version:{product_id}"
+
+
+def _held_key(product_id, version):
+    return f"e_shop:held:{product_id}:{version}"
+
+
+def _held_versions(cache, product_ids):
+    keys = {product_id: _version_key(product_id) for product_id in product_ids}
+    versions = cache.get_many(keys.values())
+    for key in keys.values():
+        if key not in versions:
+            # a fresh start, never the version of counts written before an eviction
+            cache.add(key, time.time_ns(), timeout=None)
+            versions[key] = cache.get(key, 0)
+    return {product_id: versions[key] for product_id, key in keys.items()}
+
+
+def active_reservations(now=None):
+    return StockReservation.objects.filter(expires_at__gt=now or timezone.now())
+
+
+def held_by_others(product_ids, customer_id):
+    """
+    Units held for other customers per product, read from the table. The checkout
+    calls it with the products locked, holds are only created under that lock.
+    """
+    rows = active_reservations().filter(product_id__in=product_ids) \
+        .exclude(customer_id=customer_id) \
+        .values("product_id").annotate(held=Sum("amount")).order_by()
+    return {row["product_id"]: row["held"] for row in rows}
+
+
+def held_units(product_ids):
+    """
+    Units held by active reservations per product, for the pages. A cached
+    count is used until a reservation of the product changes or its earliest
+    hold expires, so page views don't aggregate the reservations. Counts are
+    kept under the version of the product read before aggregating, a count
+    aggregated before a change is stored under a version nobody reads anymore.
+    """
+    cache = _cache()
+    product_ids = list(product_ids)
+    versions = _held_versions(cache, product_ids)
+    cached = cache.get_many([_held_key(product_id, versions[product_id]) for product_id in product_ids])
+    now = time.time()
+
+    held, missing = {}, []
+    for product_id in product_ids:
+        entry = cached.get(_held_key(product_id, versions[product_id]))
+        if entry is None or (entry[1] is not None and entry[1] <= now):
+            missing.append(product_id)
+        else:
+            held[product_id] = entry[0]
+
+    if missing:
+        rows = {row["product_id"]: row for row in active_reservations()
+                .filter(product_id__in=missing).values("product_id")
+                .annotate(held=Sum("amount"), next_expiry=Min("expires_at")).order_by()}
+        entries = {}
+        for product_id in missing:
+            row = rows.get(product_id)
+            key = _held_key(product_id, versions[product_id])
+            entries[key] = (row["held"], row["next_expiry"].timestamp()) if row else (0, None)
+            held[product_id] = entries[key][0]
+        cache.set_many(entries, RESERVATIONS.get("CACHE_TIMEOUT", 60 * 10))
+    return held
+
+
+def forget_held(product_ids):
+    """Move the versions of the cached counts on, call it once a change of reservations is committed"""
+    cache = _cache()
+    for product_id in product_ids:
+        try:
+            cache.incr(_version_key(product_id))
+        except ValueError:
+            cache.add(_version_key(product_id), time.time_ns(), timeout=None)
+
+
+def available_to_sell(product, reservation=None):
+    """
+    Units of `product` that can be sold now: the stock minus the active holds.
+    The units of `reservation`, the hold of the viewing customer, stay available to them.
+    """
+    available = product.amount - held_units([product.pk])[product.pk]
+    if reservation is not None:
+        available += reservation.amount
+    return max(available, 0)
+
+
+def own_reservation(customer, product):
+    """The active hold of a customer on a product, None without one"""
+    if not customer.is_authenticated:
+        return None
+    return active_reservations().filter(customer_id=customer.pk, product_id=product.pk).first()
+
+
+def sweep_expired(batch_size=SWEEP_BATCH_SIZE, stdout=None):
+    """
+    Delete the expired holds in batches of `batch_size` and return how many were
+    deleted. Expired holds count for nothing already, the cached counts notice
+    it by themselves, sweeping keeps the table and its indexes small.
+    """
+    deleted = 0
+    while True:
+        now = timezone.now()
+        batch = list(StockReservation.objects.filter(expires_at__lte=now)
+                     .order_by("expires_at").values_list("pk", flat=True)[:batch_size])
+        if not batch:
+            return deleted
+        # a hold renewed since the batch was read is kept
+        count, _ = StockReservation.objects.filter(pk__in=batch, expires_at__lte=now).delete()
+        deleted += count
+        if stdout:
+            stdout.write(f"{deleted} expired reservations deleted")
@@ -0,0 +1,188 @@
+"""This is the read replica routing of application E_SHOP"""
+
+import asyncio
+import contextvars
+import random
+import time
+
+from asgiref.sync import sync_to_async
+from django.core.cache import caches
+from django.db import connections, DEFAULT_DB_ALIAS
+
+from online_shop import settings
+
+READ_REPLICAS = getattr(settings, "READ_REPLICAS", {})
+REPLICAS = tuple(READ_REPLICAS.get("ALIASES", ()))
+ROUTED_MODELS = frozenset(READ_REPLICAS.get("MODELS", ("e_shop.product", "e_shop.category",
+                                                       "e_shop.purchase", "e_shop.purchasereturns")))
+PIN_SECONDS = READ_REPLICAS.get("PIN", 5)
+SAFE_METHODS = ("GET", "HEAD", "OPTIONS")
+PIN_SESSION_KEY = "e_shop_primary_until"
+
+_routing = contextvars.ContextVar("e_shop_replica_routing", default=None)
+
+
+def _pins():
+    return caches[READ_REPLICAS.get("CACHE_ALIAS", "default")]
+
+
+def _pin_key(user_id):
+    return f"e_shop:replica-pin:{user_id}"
+
+
+class RequestRouting:
+    """What the router may do for one request"""
+    __slots__ = ("request", "replica_allowed", "wrote", "pinned", "alias")
+
+    def __init__(self, request):
+        self.request = request
+        self.replica_allowed = False
+        self.wrote = False
+        self.pinned = None
+        self.alias = None
+
+    def session(self):
+        # only a session the client already has, token clients send no cookie and a
+        # new session would be a row per write
+        session = getattr(self.request, "session", None)
+        return session if session is not None and session.session_key else None
+
+    def user_id(self):
+        user = getattr(self.request, "user", None)
+        return user.pk if user is not None and user.is_authenticated else None
+
+    def is_pinned(self):
+        # read lazily: API clients are authenticated by the view, after the middleware
+        if self.pinned is None:
+            session = self.session()
+            if session is not None:
+                self.pinned = session.get(PIN_SESSION_KEY, 0) > time.time()
+            else:
+                user_id = self.user_id()
+                self.pinned = user_id is not None and bool(_pins().get(_pin_key(user_id)))
+        return self.pinned
+
+    def pin(self, seconds=PIN_SECONDS):
+        """Pin the client to the primary by its session, or by its user without a session cookie"""
+        session = self.session()
+        user_id = self.user_id()
+        if session is not None:
+            pin_to_primary(session, seconds)
+        elif user_id is not None:
+            pin_user_to_primary(user_id, seconds)
+
+
+def pin_to_primary(session, seconds=PIN_SECONDS):
+    """Read from the primary for a while, the replicas may not have the last writes of the session yet"""
+    session[PIN_SESSION_KEY] = time.time() + seconds
+
+
+def pin_user_to_primary(user_id, seconds=PIN_SECONDS):
+    """pin_to_primary for the clients without a session, e.g. of the token API, in the shared cache"""
+    _pins().set(_pin_key(user_id), True, seconds)
+
+
+def read_from_primary():
+    """The rest of the current request reads from the primary"""
+    routing = _routing.get()
+    if routing is not None:
+        routing.replica_allowed = False
+
+
+class ReplicaRouter:
+    """
+    Reads of the catalog and of the purchase history go to a replica in the
+    requests that allow it, everything else stays on the primary: writes, reads
+    in a transaction, reads after a write of the request and, for PIN seconds,
+    the reads of a session that has just written.
+    """
+
+    def __init__(self, replicas=REPLICAS, models=ROUTED_MODELS):
+        self.replicas = tuple(replicas)
+        self.models = frozenset(models)
+
+    def _routed(self, model):
+        return model._meta.label_lower in self.models
+
+    def db_for_read(self, model, **hints):
+        routing = _routing.get()
+        if (not self.replicas or routing is None or not routing.replica_allowed or routing.wrote
+                or not self._routed(model) or connections[DEFAULT_DB_ALIAS].in_atomic_block
+                or routing.is_pinned()):
+            return DEFAULT_DB_ALIAS
+
+        instance = hints.get("instance")
+        if instance is not None and instance._state.db in self.replicas:
+            return instance._state.db
+        # one replica per request, so that its reads see the same moment
+        if routing.alias is None:
+            routing.alias = random.choice(self.replicas)
+        return routing.alias
+
+    def db_for_write(self, model, **hints):
+        routing = _routing.get()
+        if routing is not None and self._routed(model):
+            routing.wrote = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = {DEFAULT_DB_ALIAS, *self.replicas}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # the replicas get the schema from the primary
+        if db in self.replicas:
+            return False
+        return None
+
+
+class ReplicaRoutingMiddleware:
+    """
+    Lets the router use the replicas in the safe requests of views that set
+    `read_replica = True`, and pins a session that wrote catalog or history rows
+    to the primary. Put it after SessionMiddleware and AuthenticationMiddleware.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(self.get_response):
+            # the handler recognizes async middleware by this marker, like MiddlewareMixin
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def _finish(self, routing):
+        if routing.wrote:
+            routing.pin()
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        routing = RequestRouting(request)
+        token = _routing.set(routing)
+        try:
+            return self.get_response(request)
+        finally:
+            _routing.reset(token)
+            self._finish(routing)
+
+    async def __acall__(self, request):
+        routing = RequestRouting(request)
+        token = _routing.set(routing)
+        try:
+            return await self.get_response(request)
+        finally:
+            _routing.reset(token)
+            if routing.wrote:
+                await sync_to_async(self._finish)(routing)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        routing = _routing.get()
+        view_class = getattr(view_func, "view_class", None) or getattr(view_func, "cls", None)
+        if routing is not None and request.method in SAFE_METHODS \
+                and getattr(view_class, "read_replica", False):
+            routing.replica_allowed = True
+        return None
@@ -0,0 +1,160 @@
+"""This is the full-text product search of application E_SHOP"""
+
+from decimal import Decimal, InvalidOperation
+
+from django.contrib.postgres.search import SearchQuery, SearchRank, SearchVectorExact, SearchVectorField
+from django.db import connections
+from django.db.models import Q, FloatField, Value
+from django.db.models.expressions import RawSQL
+from django.db.models.functions import Cast
+
+from .models import Product
+
+# The index lives in the database, not in the model: a tsvector column kept by a
+# trigger on PostgreSQL and an FTS5 table kept by triggers on SQLite (development).
+# Names weigh more than descriptions in the rank.
+SEARCH_CONFIG = "english"
+SEARCH_COLUMN = "search_vector"
+SEARCH_INDEX = "product_search_idx"
+SEARCH_TRIGGER = "e_shop_product_search"
+FTS_TABLE = "e_shop_product_fts"
+FTS_TRIGGERS = (f"{FTS_TABLE}_ai", f"{FTS_TABLE}_ad", f"{FTS_TABLE}_au")
+
+SEARCH_ORDERING = ("-rank", "id")
+MAX_QUERY_LENGTH = 200
+
+
+def _postgresql_ddl(table):
+    vector = (f"setweight(to_tsvector('{SEARCH_CONFIG}', coalesce(NEW.name, '')), 'A') || "
+              f"setweight(to_tsvector('{SEARCH_CONFIG}', coalesce(NEW.description, '')), 'B')")
+    return [
+        f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {SEARCH_COLUMN} tsvector",
+        f"CREATE OR REPLACE FUNCTION {SEARCH_TRIGGER}() RETURNS trigger AS $$ "
+        f"BEGIN NEW.{SEARCH_COLUMN} := {vector}; RETURN NEW; END $$ LANGUAGE plpgsql",
+        f"DROP TRIGGER IF EXISTS {SEARCH_TRIGGER} ON {table}",
+        f"CREATE TRIGGER {SEARCH_TRIGGER} BEFORE INSERT OR UPDATE OF name, description ON {table} "
+        f"FOR EACH ROW EXECUTE FUNCTION {SEARCH_TRIGGER}()",
+        f"CREATE INDEX IF NOT EXISTS {SEARCH_INDEX} ON {table} USING gin ({SEARCH_COLUMN})",
+    ]
+
+
+def _sqlite_ddl(table):
+    insert = f"INSERT INTO {FTS_TABLE}(rowid, name, description) VALUES (new.id, new.name, new.description);"
+    delete = (f"INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, name, description) "
+              f"VALUES ('delete', old.id, old.name, old.description);")
+    return [
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5(name, description, "
+        f"content='{table}', content_rowid='id', tokenize='porter unicode61')",
+        f"CREATE TRIGGER IF NOT EXISTS {FTS_TRIGGERS[0]} AFTER INSERT ON {table} BEGIN {insert} END",
+        f"CREATE TRIGGER IF NOT EXISTS {FTS_TRIGGERS[1]} AFTER DELETE ON {table} BEGIN {delete} END",
+        f"CREATE TRIGGER IF NOT EXISTS {FTS_TRIGGERS[2]} AFTER UPDATE OF name, description ON {table} "
+        f"BEGIN {delete} {insert} END",
+    ]
+
+
+def install_search_index(connection):
+    """
+    Create the search index of the products where it is missing and fill it.
+    Other databases have no index, search falls back to LIKE there.
+    """
+    table = Product._meta.db_table
+    with connection.cursor() as cursor:
+        if connection.vendor == "postgresql":
+            for statement in _postgresql_ddl(table):
+                cursor.execute(statement)
+            # the trigger computes the vectors of the existing rows
+            cursor.execute(f"UPDATE {table} SET name = name WHERE {SEARCH_COLUMN} IS NULL")
+        elif connection.vendor == "sqlite":
+            cursor.execute("SELECT count(*) FROM sqlite_master WHERE type = 'trigger' AND name IN (%s, %s, %s)",
+                           FTS_TRIGGERS)
+            complete = cursor.fetchone()[0] == len(FTS_TRIGGERS)
+            for statement in _sqlite_ddl(table):
+                cursor.execute(statement)
+            if not complete:
+                cursor.execute(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')")
+
+
+def drop_search_index(connection):
+    table = Product._meta.db_table
+    with connection.cursor() as cursor:
+        if connection.vendor == "postgresql":
+            cursor.execute(f"DROP TRIGGER IF EXISTS {SEARCH_TRIGGER} ON {table}")
+            cursor.execute(f"DROP FUNCTION IF EXISTS {SEARCH_TRIGGER}()")
+            cursor.execute(f"ALTER TABLE {table} DROP COLUMN IF EXISTS {SEARCH_COLUMN}")
+        elif connection.vendor == "sqlite":
+            for trigger in FTS_TRIGGERS:
+                cursor.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+            cursor.execute(f"DROP TABLE IF EXISTS {FTS_TABLE}")
+
+
+def _fts_query(query):
+    # every word becomes an FTS5 string, so operators typed by users are plain text
+    return " ".join('"{}"'.format(word.replace('"', '""')) for word in query.split())
+
+
+def _match(queryset, query):
+    connection = connections[queryset.db]
+    table = connection.ops.quote_name(Product._meta.db_table)
+
+    if connection.vendor == "postgresql":
+        vector = RawSQL(f"{table}.{SEARCH_COLUMN}", [], output_field=SearchVectorField())
+        search_query = SearchQuery(query, config=SEARCH_CONFIG, search_type="websearch")
+        # @@ on the indexed column is served by the GIN index, the rank is cast from
+        # real to double so that it survives the round trip through a page cursor
+        return queryset.filter(SearchVectorExact(vector, search_query)) \
+            .annotate(rank=Cast(SearchRank(vector, search_query), FloatField()))
+
+    if connection.vendor == "sqlite":
+        fts_query = _fts_query(query)
+        matches = RawSQL(f"SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s", [fts_query])
+        # bm25 is lower for better matches
+        rank = RawSQL(f"SELECT -bm25({FTS_TABLE}, 10.0, 1.0) FROM {FTS_TABLE} "
+                      f"WHERE {FTS_TABLE} MATCH %s AND rowid = {table}.id", [fts_query],
+                      output_field=FloatField())
+        return queryset.filter(pk__in=matches).annotate(rank=rank)
+
+    condition = Q()
+    for word in query.split():
+        condition &= Q(name__icontains=word) | Q(description__icontains=word)
+    return queryset.filter(condition).annotate(rank=Value(1.0, output_field=FloatField()))
+
+
+def search_products(queryset, query=None, category=None, price_min=None, price_max=None):
+    """
+    Products of `queryset` in the category and the price range. With a `query`
+    only the matching products are kept, annotated with `rank` (higher is better),
+    order them by SEARCH_ORDERING.
+    """
+    if category:
+        queryset = queryset.filter(category_id=category)
+    if price_min is not None:
+        queryset = queryset.filter(price__gte=price_min)
+    if price_max is not None:
+        queryset = queryset.filter(price__lte=price_max)
+    if query:
+        queryset = _match(queryset, query)
+    return queryset
+
+
+def _price(value, name):
+    try:
+        price = Decimal(value)
+    except InvalidOperation:
+        raise ValueError(f"Invalid {name}: {value}")
+    if not price.is_finite() or price < 0:
+        raise ValueError(f"Invalid {name}: {value}")
+    return price
+
+
+def search_arguments(params):
+    """Arguments of search_products from query parameters, ValueError if they are invalid"""
+    query = " ".join((params.get("q") or "").split())[:MAX_QUERY_LENGTH]
+    category = params.get("category")
+    if category and not category.isdigit():
+        raise ValueError(f"Invalid category: {category}")
+    return {
+        "query": query or None,
+        "category": int(category) if category else None,
+        "price_min": _price(params["price_min"], "price_min") if params.get("price_min") else None,
+        "price_max": _price(params["price_max"], "price_max") if params.get("price_max") else None,
+    }
@@ -0,0 +1,98 @@
+"""This is the dataset generator of application E_SHOP, used by the benchmarks"""
+
+import random
+import uuid
+from decimal import Decimal
+
+from django.contrib.auth.hashers import make_password
+
+from .counters import recount_categories
+from .models import Category, Product, Customer, Purchase, PurchaseReturns
+from .suggest import SUGGEST_INDEX
+from .wallet import open_wallets
+
+BATCH_SIZE = 10000
+
+
+def _batches(objects, batch_size=BATCH_SIZE):
+    batch = []
+    for obj in objects:
+        batch.append(obj)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _create(model, objects):
+    for batch in _batches(objects):
+        model.objects.bulk_create(batch)
+
+
+def seed_shop(categories=10, products=1000, customers=100, purchases=10000, refunds=0,
+              available_ratio=0.9, seed=None, stdout=None):
+    """
+    Fill the database with a generated shop and return the primary keys of the new rows.
+    Every run uses its own tag in names and slugs, so it can be repeated on the same database.
+    """
+    rand = random.Random(seed)
+    tag = uuid.uuid4().hex[:8]
+
+    def log(message):
+        if stdout:
+            stdout.write(message)
+
+    _create(Category, (Category(name=f"{tag} category {i}", slug=f"{tag}-category-{i}")
+                       for i in range(categories)))
+    category_ids = list(Category.objects.filter(slug__startswith=f"{tag}-")
+                        .values_list("id", flat=True))
+    log(f"{len(category_ids)} categories")
+
+    _create(Product, (Product(name=f"{tag} product {i}",
+                              slug=f"{tag}-product-{i}",
+                              description=f"Generated product {i}",
+                              price=Decimal(rand.randint(100, 100000)) / 100,
+                              amount=rand.randint(0, 1000),
+                              category_id=rand.choice(category_ids),
+                              is_available=rand.random() < available_ratio)
+                      for i in range(products)))
+    product_ids = list(Product.objects.filter(slug__startswith=f"{tag}-")
+                       .values_list("id", flat=True))
+    # bulk_create sends no signals, the counters and the suggest index are updated here
+    recount_categories(category_ids)
+    SUGGEST_INDEX.invalidate()
+    log(f"{len(product_ids)} products")
+
+    password = make_password(None)
+    _create(Customer, (Customer(username=f"{tag}-customer-{i}", password=password)
+                       for i in range(customers)))
+    customer_ids = list(Customer.objects.filter(username__startswith=f"{tag}-")
+                        .values_list("id", flat=True))
+    for batch in _batches(customer_ids):
+        open_wallets({customer_id: Decimal("1000000.00") for customer_id in batch})
+    log(f"{len(customer_ids)} customers")
+
+    prices = dict(Product.objects.filter(id__in=product_ids).values_list("id", "price"))
+    done = 0
+    for batch in _batches(range(purchases)):
+        Purchase.objects.bulk_create(
+            Purchase(customer_id=rand.choice(customer_ids),
+                     product_id=product_id,
+                     amount=rand.randint(1, 5),
+                     price_at_time_purchase=prices[product_id])
+            for product_id in (rand.choice(product_ids) for _ in batch))
+        done += len(batch)
+        log(f"{done} purchases")
+
+    if refunds:
+        purchase_ids = list(Purchase.objects.filter(customer_id__in=customer_ids)
+                            .values_list("id", flat=True))
+        _create(PurchaseReturns, (PurchaseReturns(to_purchase_id=purchase_id) for purchase_id
+                                  in rand.sample(purchase_ids, min(refunds, len(purchase_ids)))))
+        log(f"{min(refunds, len(purchase_ids))} refund requests")
+
+    return {"tag": tag,
+            "categories": category_ids,
+            "products": product_ids,
+            "customers": customer_ids}
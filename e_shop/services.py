@@ -0,0 +1,277 @@
+"""This is the business operations of application E_SHOP"""
+
+import time
+
+from django.db import transaction, OperationalError
+from django.db.models import F, Q, Case, When, PositiveSmallIntegerField
+from django.utils import timezone
+
+from online_shop import settings
+from .analytics import record_sales, record_refunds
+from .cache import bump_model_version
+from .counters import apply_deltas
+from .jobs import enqueue
+from .models import Product, Purchase, PurchaseReturns, StockReservation, WalletTransaction
+from .reservations import RESERVATION_TTL, held_by_others, forget_held
+from .wallet import lock_wallet, lock_wallets, append, append_many
+
+CHECKOUT_RETRY = getattr(settings, "CHECKOUT_RETRY", {})
+REFUND_INLINE_LIMIT = getattr(settings, "REFUND_INLINE_LIMIT", 100)
+
+# serialization_failure and deadlock_detected of PostgreSQL
+RETRYABLE_PGCODES = ("40001", "40P01")
+
+
+class CheckoutError(Exception):
+    pass
+
+
+class InsufficientFunds(CheckoutError):
+    def __init__(self, lack):
+        super().__init__("Insufficient funds to pay")
+        self.lack = lack
+
+
+class OutOfStock(CheckoutError):
+    def __init__(self, products=()):
+        super().__init__("This quantity is out of stock")
+        self.products = set(products)
+
+
+class UnknownProduct(CheckoutError):
+    def __init__(self, products=()):
+        super().__init__("Product does not exist")
+        self.products = set(products)
+
+
+class RefundError(Exception):
+    pass
+
+
+def _is_retryable(exc):
+    pgcode = getattr(exc.__cause__, "pgcode", None)
+    if pgcode in RETRYABLE_PGCODES:
+        return True
+
+    # SQLite in local development reports lock contention only by the message
+    return "database is locked" in str(exc)
+
+
+def retry_on_conflict(func):
+    """Rerun the whole transaction when the database aborts it because of a conflict"""
+    def wrapper(*args, **kwargs):
+        attempts = CHECKOUT_RETRY.get("ATTEMPTS", 5)
+        backoff = CHECKOUT_RETRY.get("BACKOFF", 0.01)
+        for attempt in range(1, attempts + 1):
+            try:
+                return func(*args, **kwargs)
+            except OperationalError as exc:
+                if attempt == attempts or not _is_retryable(exc):
+                    raise
+                time.sleep(backoff * 2 ** (attempt - 1))
+    return wrapper
+
+
+def buy_product(customer, product, amount):
+    """Sell `amount` of `product` to `customer` and return the created Purchase"""
+    purchase, = buy_basket(customer, [(product, amount)])
+    product.amount -= amount
+    purchase.product = product
+    return purchase
+
+
+@retry_on_conflict
+def buy_basket(customer, lines):
+    """
+    Sell every `(product, amount)` line to `customer` in one transaction and
+    return the created purchases in the order of the lines. Products may be
+    given as instances or primary keys.
+
+    Rows are always locked in the same order, the wallet of the customer first and
+    then the products by primary key, so concurrent checkouts can't deadlock each other.
+    """
+    lines = [(getattr(product, "pk", product), amount) for product, amount in lines]
+    ordered = {}
+    for product_id, amount in lines:
+        ordered[product_id] = ordered.get(product_id, 0) + amount
+
+    with transaction.atomic():
+        wallet = lock_wallet(customer)
+        # hidden products are not for sale, they are as unknown as missing ones
+        products = {pk: (price, in_stock, category_id)
+                    for pk, price, in_stock, category_id
+                    in Product.objects.select_for_update().filter(pk__in=ordered, is_available=True)
+                    .order_by("pk").values_list("pk", "price", "amount", "category_id")}
+
+        unknown = ordered.keys() - products.keys()
+        if unknown:
+            raise UnknownProduct(products=unknown)
+
+        # units held for other customers can't be sold, the customer's own holds can
+        held = held_by_others(ordered, customer.pk)
+        lacking = [pk for pk, amount in ordered.items() if amount > products[pk][1] - held.get(pk, 0)]
+        if lacking:
+            raise OutOfStock(products=lacking)
+
+        purchase_total = sum(products[pk][0] * amount for pk, amount in ordered.items())
+        if purchase_total > wallet:
+            raise InsufficientFunds(lack=purchase_total - wallet)
+        append(customer, -purchase_total, WalletTransaction.PURCHASE, lock=False)
+
+        # conditional updates stay correct even where row locks are not supported
+        in_stock = Q()
+        for pk, amount in ordered.items():
+            in_stock |= Q(pk=pk, amount__gte=amount)
+        taken = Product.objects.filter(in_stock).update(
+            amount=Case(*[When(pk=pk, then=F("amount") - amount) for pk, amount in ordered.items()],
+                        output_field=PositiveSmallIntegerField()))
+        if taken != len(ordered):
+            raise OutOfStock(products=ordered)
+
+        purchases = Purchase.objects.bulk_create([
+            Purchase(customer_id=customer.pk,
+                     product_id=product_id,
+                     amount=amount,
+                     price_at_time_purchase=products[product_id][0])
+            for product_id, amount in lines])
+        record_sales(purchases, {pk: product[2] for pk, product in products.items()})
+
+        # the holds of the customer on these products are consumed by the purchase
+        consumed, _ = StockReservation.objects.filter(customer_id=customer.pk,
+                                                      product_id__in=ordered).delete()
+        if consumed:
+            transaction.on_commit(lambda: forget_held(ordered))
+
+        sold_out = {}
+        for pk, amount in ordered.items():
+            _, in_stock, category_id = products[pk]
+            if in_stock == amount:
+                sold_out[category_id] = sold_out.get(category_id, 0) - 1
+        apply_deltas({category_id: {"in_stock_count": delta} for category_id, delta in sold_out.items()})
+
+        # bulk queries send no signals, versions of cached pages and ETags are bumped here
+        transaction.on_commit(lambda: bump_model_version(Product, Purchase))
+
+    # keep the caller's instances in line with the database
+    customer._wallet = wallet - purchase_total
+    for purchase in purchases:
+        purchase.customer = customer
+    return purchases
+
+
+@retry_on_conflict
+def reserve_stock(customer, product, amount):
+    """
+    Hold `amount` units of `product` for `customer` for RESERVATION_TTL and return
+    the reservation. A new hold replaces the customer's previous hold on the product.
+    """
+    product_id = getattr(product, "pk", product)
+    with transaction.atomic():
+        # holds are created under the lock of the product, like the checkout sells
+        in_stock = Product.objects.select_for_update().filter(pk=product_id, is_available=True) \
+            .values_list("amount", flat=True).first()
+        if in_stock is None:
+            raise UnknownProduct(products=[product_id])
+        if amount > in_stock - held_by_others([product_id], customer.pk).get(product_id, 0):
+            raise OutOfStock(products=[product_id])
+
+        reservation, _ = StockReservation.objects.update_or_create(
+            customer_id=customer.pk, product_id=product_id,
+            defaults={"amount": amount, "expires_at": timezone.now() + RESERVATION_TTL})
+        transaction.on_commit(lambda: forget_held([product_id]))
+    return reservation
+
+
+def release_reservation(customer, product):
+    """Give the units held for `customer` back, return whether there was a hold"""
+    product_id = getattr(product, "pk", product)
+    deleted, _ = StockReservation.objects.filter(customer_id=customer.pk, product_id=product_id).delete()
+    if deleted:
+        transaction.on_commit(lambda: forget_held([product_id]))
+    return bool(deleted)
+
+
+def refund_purchase(refund):
+    """
+    Approve a refund request: the money goes back to the wallet, the units back
+    to stock, and the purchase with its request is deleted.
+    """
+    if not refund_purchases([refund.pk]):
+        # a concurrent approval of the same request has deleted it already
+        raise RefundError("The refund has already been processed")
+
+
+def _refund_rows(refund_ids, lock=False):
+    refunds = PurchaseReturns.objects.filter(pk__in=refund_ids).order_by("pk")
+    if lock:
+        refunds = refunds.select_for_update(of=("self",))
+    return {pk: Purchase(pk=purchase_id, customer_id=customer_id, product_id=product_id, amount=amount,
+                         price_at_time_purchase=price, time_purchase=time_purchase)
+            for pk, purchase_id, customer_id, product_id, amount, price, time_purchase
+            in refunds.values_list("pk", "to_purchase_id", "to_purchase__customer_id",
+                                   "to_purchase__product_id", "to_purchase__amount",
+                                   "to_purchase__price_at_time_purchase", "to_purchase__time_purchase")}
+
+
+@retry_on_conflict
+def refund_purchases(refund_ids):
+    """
+    Approve many refund requests in one transaction and return the ids of the
+    approved ones, requests processed in the meantime are skipped. Credits are
+    summed per customer and returned units per product, so the cost is a few
+    statements whatever the number of requests. Rows are locked in the order
+    of the checkout, the wallets first and then the products by primary key.
+    """
+    with transaction.atomic():
+        purchases = _refund_rows(refund_ids)
+        if not purchases:
+            return []
+        lock_wallets(purchase.customer_id for purchase in purchases.values())
+        products = {pk: (category_id, in_stock, is_available)
+                    for pk, category_id, in_stock, is_available
+                    in Product.objects.select_for_update()
+                    .filter(pk__in={purchase.product_id for purchase in purchases.values()}).order_by("pk")
+                    .values_list("pk", "category_id", "amount", "is_available")}
+
+        # requests deleted by a concurrent approval or rejection are gone once locked
+        purchases = _refund_rows(list(purchases), lock=True)
+        if not purchases:
+            return []
+
+        credits, units = {}, {}
+        for purchase in purchases.values():
+            credits[purchase.customer_id] = credits.get(purchase.customer_id, 0) \
+                + purchase.amount * purchase.price_at_time_purchase
+            units[purchase.product_id] = units.get(purchase.product_id, 0) + purchase.amount
+
+        PurchaseReturns.objects.filter(pk__in=purchases).delete()
+        Purchase.objects.filter(pk__in=[purchase.pk for purchase in purchases.values()]).delete()
+
+        append_many(credits, WalletTransaction.REFUND, lock=False)
+        Product.objects.filter(pk__in=units).update(
+            amount=Case(*[When(pk=pk, then=F("amount") + amount) for pk, amount in units.items()],
+                        output_field=PositiveSmallIntegerField()))
+        record_refunds(purchases.values(), {pk: product[0] for pk, product in products.items()})
+
+        restocked = {}
+        for pk in units:
+            category_id, in_stock, is_available = products[pk]
+            if is_available and not in_stock:
+                restocked[category_id] = restocked.get(category_id, 0) + 1
+        apply_deltas({category_id: {"in_stock_count": delta} for category_id, delta in restocked.items()})
+
+        transaction.on_commit(lambda: bump_model_version(Product))
+    return list(purchases)
+
+
+def queue_refunds(refund_ids, chunk_size=REFUND_INLINE_LIMIT):
+    """Approve refund requests in background jobs of `chunk_size` requests, return the jobs"""
+    refund_ids = sorted(refund_ids)
+    return [enqueue("refund_purchases", refund_ids=refund_ids[start:start + chunk_size])
+            for start in range(0, len(refund_ids), chunk_size)]
+
+
+def reject_refunds(refund_ids):
+    """Reject refund requests, the purchases stay. Return the number of rejected requests"""
+    deleted, _ = PurchaseReturns.objects.filter(pk__in=refund_ids).delete()
+    return deleted
@@ -0,0 +1,191 @@
+"""This is the signal handlers of application E_SHOP"""
+
+from django.contrib.auth.signals import user_logged_out
+from django.db import transaction
+from django.db.models.signals import pre_save, post_save, pre_delete, post_delete
+from django.dispatch import receiver
+from rest_framework.authtoken.models import Token
+
+from .API.authentication import forget_token, forget_user_tokens
+from .cache import invalidate_sidebar, bump_model_version
+from .counters import STATE_FIELDS, state_deltas, apply_deltas
+from .images import delete_variants
+from .models import Product, Category, Purchase, PurchaseReturns, Customer
+from .suggest import SUGGEST_INDEX, PRODUCT, CATEGORY
+from .wallet import open_wallets
+
+SIDEBAR_PRODUCT_FIELDS = ("category_id", "is_available")
+
+
+def _product_changed(instance, fields):
+    loaded = getattr(instance, "_loaded_values", None)
+    if loaded is None:
+        return True
+    return any(field not in loaded or loaded[field] != getattr(instance, field)
+               for field in fields)
+
+
+@receiver(post_save, sender=Product)
+def product_saved(sender, instance, created, **kwargs):
+    if created or _product_changed(instance, SIDEBAR_PRODUCT_FIELDS):
+        transaction.on_commit(invalidate_sidebar)
+
+
+@receiver(post_delete, sender=Product)
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def catalog_changed(sender, **kwargs):
+    transaction.on_commit(invalidate_sidebar)
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+@receiver(post_save, sender=Purchase)
+@receiver(post_delete, sender=Purchase)
+@receiver(post_save, sender=PurchaseReturns)
+@receiver(post_delete, sender=PurchaseReturns)
+def model_changed(sender, **kwargs):
+    transaction.on_commit(lambda: bump_model_version(sender))
+
+
+def _stored_row(product_id):
+    # read from the table, a checkout may have changed the amount since the instance was loaded
+    return Product.objects.filter(pk=product_id).values_list(*STATE_FIELDS, "name", "slug").first()
+
+
+def _listing(is_available, name, slug):
+    # what the suggest index holds for a product
+    return (name, slug) if is_available else None
+
+
+@receiver(pre_save, sender=Product)
+def product_saving(sender, instance, raw, update_fields, **kwargs):
+    if raw:
+        return
+    stored = None if instance._state.adding else _stored_row(instance.pk)
+    before = stored[:len(STATE_FIELDS)] if stored else None
+    after = tuple(getattr(instance, field) for field in STATE_FIELDS)
+    if before is not None and update_fields is not None:
+        # fields that are not saved keep their stored values
+        after = tuple(value if field in update_fields or field.removesuffix("_id") in update_fields
+                      else stored for field, value, stored in zip(STATE_FIELDS, after, before))
+    instance._counter_states = (before, after)
+    instance._listings = (_listing(stored[1], *stored[3:]) if stored else None,
+                          _listing(after[1], instance.name, instance.slug))
+
+
+@receiver(post_save, sender=Product)
+def product_counted(sender, instance, **kwargs):
+    before, after = instance.__dict__.pop("_counter_states", (None, None))
+    if before != after:
+        apply_deltas(state_deltas(before, after))
+
+
+@receiver(post_save, sender=Product)
+def product_listed(sender, instance, **kwargs):
+    before, after = instance.__dict__.pop("_listings", (None, None))
+    if before != after:
+        _suggest_changed(PRODUCT, instance.pk, before, after)
+
+
+@receiver(pre_delete, sender=Product)
+def product_deleting(sender, instance, **kwargs):
+    stored = _stored_row(instance.pk)
+    instance._counter_states = (stored[:len(STATE_FIELDS)] if stored else None, None)
+    instance._listings = (_listing(stored[1], *stored[3:]) if stored else None, None)
+
+
+@receiver(post_delete, sender=Product)
+def product_uncounted(sender, instance, **kwargs):
+    before, _ = instance.__dict__.pop("_counter_states", (None, None))
+    if before is not None:
+        apply_deltas(state_deltas(before, None))
+    before, _ = instance.__dict__.pop("_listings", (None, None))
+    if before is not None:
+        _suggest_changed(PRODUCT, instance.pk, before, None)
+
+
+@receiver(pre_save, sender=Product)
+def product_photo_saving(sender, instance, raw, update_fields, **kwargs):
+    if raw or instance._state.adding or (update_fields is not None and "photo" not in update_fields):
+        return
+    if not _product_changed(instance, ("photo", )):
+        return
+    # locked, a worker storing the variants of the old photo waits and then finds it replaced
+    stored = Product.objects.select_for_update().filter(pk=instance.pk) \
+        .values_list("photo", "photo_variants").first()
+    if stored and stored[0] != instance.photo.name and stored[1]:
+        instance._stale_variants = list(stored[1].values())
+
+
+@receiver(post_save, sender=Product)
+def product_photo_replaced(sender, instance, **kwargs):
+    names = instance.__dict__.pop("_stale_variants", None)
+    if names:
+        transaction.on_commit(lambda: delete_variants(names))
+
+
+@receiver(post_delete, sender=Product)
+def product_photo_deleted(sender, instance, **kwargs):
+    names = list(instance.photo_variants.values())
+    if names:
+        transaction.on_commit(lambda: delete_variants(names))
+
+
+def _suggest_changed(kind, pk, before, after):
+    old_name = before[0] if before else None
+    name, slug = after or (None, None)
+    transaction.on_commit(lambda: SUGGEST_INDEX.changed(kind, pk, old_name, name, slug))
+
+
+@receiver(pre_save, sender=Category)
+def category_saving(sender, instance, raw, **kwargs):
+    if raw:
+        return
+    stored = None if instance._state.adding else \
+        Category.objects.filter(pk=instance.pk).values_list("name", "slug").first()
+    instance._listings = (stored, (instance.name, instance.slug))
+
+
+@receiver(post_save, sender=Category)
+def category_listed(sender, instance, **kwargs):
+    before, after = instance.__dict__.pop("_listings", (None, None))
+    if before != after:
+        _suggest_changed(CATEGORY, instance.pk, before, after)
+
+
+@receiver(post_delete, sender=Category)
+def category_unlisted(sender, instance, **kwargs):
+    _suggest_changed(CATEGORY, instance.pk, (instance.name, instance.slug), None)
+
+
+@receiver(post_delete, sender=Token)
+def token_deleted(sender, instance, **kwargs):
+    forget_token(instance.key)
+    forget_user_tokens(instance.user_id)
+
+
+@receiver(post_save, sender=Customer)
+def customer_saved(sender, instance, created, update_fields, **kwargs):
+    # only a deactivation or a new password revokes the tokens, not e.g. the last_login of a login
+    if created or (update_fields is not None and not {"is_active", "password"} & set(update_fields)):
+        return
+    loaded = getattr(instance, "_loaded_values", None)
+    if loaded is None or any(field not in loaded or loaded[field] != getattr(instance, field)
+                             for field in ("is_active", "password")):
+        forget_user_tokens(instance.pk)
+
+
+@receiver(post_save, sender=Customer)
+def customer_created(sender, instance, created, raw, **kwargs):
+    opening = instance.__dict__.pop("_opening_deposit", None)
+    if created and not raw and opening:
+        open_wallets({instance.pk: opening})
+
+
+@receiver(user_logged_out)
+def customer_logged_out(sender, user, **kwargs):
+    if user is not None:
+        forget_user_tokens(user.pk)
@@ -0,0 +1,303 @@
+"""This is the in-memory typeahead index of application E_SHOP"""
+
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left, bisect_right
+
+from django.core.cache import caches
+from django.db import connection
+
+from online_shop import settings
+from .models import Product, Category
+
+logger = logging.getLogger(__name__)
+
+SUGGEST = getattr(settings, "PRODUCT_SUGGEST", {})
+MAX_ENTRIES = SUGGEST.get("MAX_ENTRIES", 1000000)
+LIMIT = SUGGEST.get("LIMIT", 10)
+MAX_LIMIT = 50
+MAX_PREFIX_LENGTH = 100
+LOAD_CHUNK_SIZE = 10000
+LOG_TIMEOUT = SUGGEST.get("LOG_TIMEOUT", 60 * 10)
+MAX_REPLAY = 1000
+GENERATION_KEY = "e_shop:suggest:generation"
+
+PRODUCT = "product"
+CATEGORY = "category"
+
+
+def _change_key(generation):
+    return f"e_shop:suggest:change:{generation}"
+
+
+def normalize(name):
+    return " ".join(name.casefold().split())
+
+
+class Suggestion:
+    """One name of the index, slots keep a million of them small"""
+    __slots__ = ("kind", "pk", "name", "slug")
+
+    def __init__(self, kind, pk, name, slug):
+        self.kind = kind
+        self.pk = pk
+        self.name = name
+        self.slug = slug
+
+    def as_dict(self):
+        return {"type": self.kind, "id": self.pk, "name": self.name, "slug": self.slug}
+
+
+class PrefixIndex:
+    """
+    Names sorted by their normalized form in two parallel arrays, a prefix is
+    found with bisect and the matches are the run of keys that start with it.
+    Lookups cost O(log n + limit), adding or removing a name O(n) memmove.
+    At most `max_entries` names are held, the ones over the bound are counted in `dropped`.
+    """
+
+    def __init__(self, max_entries=MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.dropped = 0
+        self._keys = []
+        self._entries = []
+        self._lock = threading.Lock()
+        self._pending = None
+
+    def __len__(self):
+        return len(self._keys)
+
+    def load(self, suggestions):
+        """Replace the contents, changes made while `suggestions` is consumed are replayed"""
+        with self._lock:
+            self._pending = []
+        rows, dropped = [], 0
+        for suggestion in suggestions:
+            if len(rows) < self.max_entries:
+                rows.append((normalize(suggestion.name), suggestion))
+            else:
+                dropped += 1
+        rows.sort(key=lambda row: row[0])
+
+        with self._lock:
+            pending, self._pending = self._pending, None
+            self._keys = [key for key, _ in rows]
+            self._entries = [suggestion for _, suggestion in rows]
+            self.dropped = dropped
+            for change in pending:
+                self._apply(*change)
+
+    def add(self, suggestion):
+        with self._lock:
+            self._apply(None, suggestion)
+
+    def remove(self, kind, pk, name):
+        with self._lock:
+            self._apply((kind, pk, name), None)
+
+    def replace(self, kind, pk, old_name, suggestion):
+        with self._lock:
+            self._apply((kind, pk, old_name) if old_name is not None else None, suggestion)
+
+    def _find(self, key, kind, pk):
+        position = bisect_left(self._keys, key)
+        while position < len(self._keys) and self._keys[position] == key:
+            entry = self._entries[position]
+            if entry.kind == kind and entry.pk == pk:
+                return position
+            position += 1
+        return None
+
+    def _apply(self, old, new):
+        if self._pending is not None:
+            self._pending.append((old, new))
+        if old is not None:
+            kind, pk, name = old
+            position = self._find(normalize(name), kind, pk)
+            if position is not None:
+                del self._keys[position]
+                del self._entries[position]
+        if new is not None:
+            key = normalize(new.name)
+            # a replayed change may be in the loaded names already
+            position = self._find(key, new.kind, new.pk)
+            if position is not None:
+                self._entries[position] = new
+                return
+            if len(self._keys) >= self.max_entries:
+                self.dropped += 1
+                return
+            position = bisect_right(self._keys, key)
+            self._keys.insert(position, key)
+            self._entries.insert(position, new)
+
+    def lookup(self, prefix, limit=LIMIT):
+        """Up to `limit` suggestions whose names start with `prefix`, in alphabetical order"""
+        prefix = normalize(prefix)
+        if not prefix:
+            return []
+        with self._lock:
+            keys, entries = self._keys, self._entries
+            position = bisect_left(keys, prefix)
+            end = min(position + limit, len(keys))
+            found = []
+            while position < end and keys[position].startswith(prefix):
+                found.append(entries[position])
+                position += 1
+            return found
+
+
+def _suggestions():
+    for pk, name, slug in Category.objects.values_list("pk", "name", "slug").iterator():
+        yield Suggestion(CATEGORY, pk, name, slug)
+    products = Product.objects.filter(is_available=True).values_list("pk", "name", "slug")
+    for pk, name, slug in products.iterator(chunk_size=LOAD_CHUNK_SIZE):
+        yield Suggestion(PRODUCT, pk, name, slug)
+
+
+class SuggestIndex:
+    """
+    The index of the catalog in this process. Signals keep it in line with the
+    changes made here, other processes publish theirs in the shared cache: every
+    change bumps a generation and is kept under it for LOG_TIMEOUT seconds. The
+    generation is read at most every `refresh` seconds, the changes since the
+    last look are replayed and only a gap in them reloads the whole index.
+    """
+
+    def __init__(self, max_entries=MAX_ENTRIES, refresh=SUGGEST.get("REFRESH", 30),
+                 cache_alias=SUGGEST.get("CACHE_ALIAS", "default")):
+        self.index = PrefixIndex(max_entries)
+        self.refresh = refresh
+        self.cache_alias = cache_alias
+        self.ready = False
+        self._generation = None
+        self._next_check = 0
+        self._retry_at = 0
+        self._warmed_pid = None
+        self._loading = threading.Lock()
+        self._replaying = threading.Lock()
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self._forked)
+
+    def _forked(self):
+        # a loader thread of the parent doesn't exist here, its lock may be held forever
+        self._loading = threading.Lock()
+        self._replaying = threading.Lock()
+        if not self.ready:
+            self._generation = None
+            self._retry_at = 0
+
+    def _shared(self):
+        return caches[self.cache_alias] if self.cache_alias else None
+
+    def load(self):
+        """Read the names from the database, it takes seconds for a million products"""
+        if not self._loading.acquire(blocking=False):
+            return
+        try:
+            shared = self._shared()
+            generation = shared.get(GENERATION_KEY, 0) if shared else 0
+            started = time.perf_counter()
+            self.index.load(_suggestions())
+            self._generation = generation
+            self.ready = True
+            logger.info("Suggest index loaded %s names in %.1fs", len(self.index),
+                        time.perf_counter() - started)
+        except Exception:
+            logger.exception("Suggest index was not loaded")
+            if not self.ready:
+                # the next lookup after `refresh` seconds tries again
+                self._generation = None
+                self._retry_at = time.monotonic() + self.refresh
+        finally:
+            self._loading.release()
+            connection.close()
+
+    def warm_up(self):
+        """Load the index in a daemon thread"""
+        threading.Thread(target=self.load, name="suggest-warm-up", daemon=True).start()
+
+    def warm_up_process(self, **kwargs):
+        """
+        Load the index once in every process, connected to request_started: a
+        preforking server imports the application before it forks the workers.
+        """
+        if self._warmed_pid != os.getpid():
+            self._warmed_pid = os.getpid()
+            self.warm_up()
+
+    def _check_generation(self):
+        now = time.monotonic()
+        if now < self._next_check:
+            return
+        self._next_check = now + self.refresh
+        shared = self._shared()
+        if not shared or self._generation is None or not self._replaying.acquire(blocking=False):
+            return
+        try:
+            generation = shared.get(GENERATION_KEY, 0)
+            if generation != self._generation:
+                self._replay(shared, self._generation, generation)
+        finally:
+            self._replaying.release()
+
+    def _replay(self, shared, seen, generation):
+        # an expired change, an invalidation or a reset of the cache leaves a gap
+        if not 0 < generation - seen <= MAX_REPLAY:
+            self.warm_up()
+            return
+        keys = [_change_key(number) for number in range(seen + 1, generation + 1)]
+        changes = shared.get_many(keys)
+        if len(changes) < len(keys):
+            self.warm_up()
+            return
+        # in the order of the generations, a change of this process is applied again harmlessly
+        for key in keys:
+            kind, pk, old_name, name, slug = changes[key]
+            self.index.replace(kind, pk, old_name, Suggestion(kind, pk, name, slug) if name is not None else None)
+        if self._generation == seen:
+            self._generation = generation
+
+    def suggest(self, prefix, limit=LIMIT):
+        """Suggestions for a prefix, empty until the index is loaded"""
+        if not self.ready and self._generation is None and time.monotonic() >= self._retry_at:
+            # the first lookup of a process that was not warmed up, or after a failed load
+            self._generation = 0
+            self.warm_up()
+        self._check_generation()
+        return self.index.lookup(prefix[:MAX_PREFIX_LENGTH], limit)
+
+    def changed(self, kind, pk, old_name, name=None, slug=None):
+        """
+        Apply a change of this process: `old_name` is the indexed name or None
+        for a new one, `name` is None when the object leaves the index.
+        """
+        suggestion = Suggestion(kind, pk, name, slug) if name is not None else None
+        self.index.replace(kind, pk, old_name, suggestion)
+
+        shared = self._shared()
+        if shared:
+            shared.add(GENERATION_KEY, 0, timeout=None)
+            generation = shared.incr(GENERATION_KEY)
+            shared.set(_change_key(generation), (kind, pk, old_name, name, slug), LOG_TIMEOUT)
+            # nobody else changed the catalog since the last look, nothing to replay
+            if self._generation is not None and generation == self._generation + 1:
+                self._generation = generation
+
+    def invalidate(self):
+        """Make every process reload, e.g. after bulk changes that send no signals"""
+        shared = self._shared()
+        if shared:
+            # a generation without a logged change is a gap, the others reload
+            shared.add(GENERATION_KEY, 0, timeout=None)
+            shared.incr(GENERATION_KEY)
+        self._next_check = 0
+
+    def stats(self):
+        return {"ready": self.ready, "names": len(self.index), "dropped": self.index.dropped,
+                "max_entries": self.index.max_entries}
+
+
+SUGGEST_INDEX = SuggestIndex()
@@ -0,0 +1,40 @@
+"""This is the background tasks of application E_SHOP, run by the workers of e_shop.jobs"""
+
+from .API.tokens import purge_expired_tokens
+from .images import generate_variants
+from .imports import import_stored
+from .jobs import task
+from .reservations import sweep_expired
+from .services import refund_purchases
+from .wallet import materialize
+
+
+@task("photo_variants")
+def photo_variants(product_id):
+    generate_variants(product_id)
+
+
+@task("purge_tokens")
+def purge_tokens():
+    for _ in purge_expired_tokens():
+        pass
+
+
+@task("sweep_reservations")
+def sweep_reservations():
+    sweep_expired()
+
+
+@task("materialize_wallets")
+def materialize_wallets():
+    materialize()
+
+
+@task("refund_purchases")
+def approve_refunds(refund_ids):
+    refund_purchases(refund_ids)
+
+
+@task("import_products")
+def import_catalog(path, file_format):
+    import_stored(path, file_format)
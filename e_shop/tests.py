@@ -1,3 +1,1796 @@
-from django.test import TestCase
+import io
+import json
+import math
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from datetime import datetime, timedelta
+from decimal import Decimal
+from tempfile import TemporaryDirectory
+from unittest import skipUnless
+from unittest.mock import Mock, patch
 
-# Create your tests here.
+from django.contrib.auth.models import AnonymousUser, update_last_login
+from django.contrib.sessions.backends.db import SessionStore
+from django.core.cache import caches
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection, connections, transaction, OperationalError
+from django.db.migrations.executor import MigrationExecutor
+from django.db.models import Sum
+from django.http import HttpResponse, StreamingHttpResponse
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, RequestFactory, skipUnlessDBFeature
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django.utils.text import slugify
+from PIL import Image
+from rest_framework.authtoken.models import Token
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.token_blacklist.models import OutstandingToken, BlacklistedToken
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from .API.authentication import TokenWithTimeToLiveAuthentication, TOKEN_TIME_TO_LIVE, _token_cache
+from .API.serializers import ProductWriteSerializer
+from .API.tokens import blacklist_user_tokens, purge_expired_tokens
+
+from .analytics import COUNTERS, bucket_of, sales_report, _rebuild
+from .benchmarks import run_benchmarks, run_server_benchmarks, compare_reports
+from .cache import bump_model_version, get_sidebar_categories, invalidate_sidebar, model_versions, _version_key, \
+    SIDEBAR_CACHE, SIDEBAR_GENERATION_KEY
+from .exports import purchase_rows, parse_moment, COLUMNS
+from .images import VARIANTS, render_variants, variant_name
+from .imports import import_products, NATIVE_UPSERT, ON_CONFLICT_VENDORS, _insert_on_conflict
+from .jobs import TASKS, PERIODIC, Worker, backoff, claim, enqueue, renew_leases, requeue_stale, schedule_periodic, \
+    _finish
+from .models import Customer, Product, Category, Purchase, PurchaseReturns, StockReservation, WalletTransaction, \
+    WalletSnapshot, Job, SalesRollup
+from .routers import ReplicaRouter, ReplicaRoutingMiddleware, REPLICAS, PIN_SECONDS, PIN_SESSION_KEY
+from .pagination import encode_cursor
+from .search import search_products, SEARCH_ORDERING
+from .reservations import held_by_others, held_units, forget_held, sweep_expired
+from .services import buy_product, refund_purchase, refund_purchases, reject_refunds, reserve_stock, CheckoutError, \
+    InsufficientFunds, OutOfStock
+from .suggest import SuggestIndex, Suggestion, GENERATION_KEY, MAX_REPLAY, PRODUCT, _change_key
+from .wallet import balance_of, deposit, materialize, reconcile, WalletError
+
+
+@skipUnlessDBFeature("has_select_for_update")
+class CheckoutConcurrencyTest(TransactionTestCase):
+    customers_count = 20
+    purchases_count = 300
+    stock = 200
+    price = Decimal("10.00")
+    wallet = Decimal("120.00")
+
+    def setUp(self):
+        category = Category.objects.create(name="Hot", slug="hot")
+        self.product = Product.objects.create(name="Hot product", slug="hot-product",
+                                              price=self.price, amount=self.stock,
+                                              category=category)
+        self.customers = [Customer.objects.create(username=f"buyer{i}", wallet=self.wallet)
+                          for i in range(self.customers_count)]
+
+    def _buy(self, number):
+        customer = self.customers[number % self.customers_count]
+        try:
+            buy_product(customer, self.product, 1)
+            return True
+        except CheckoutError:
+            return False
+        finally:
+            connection.close()
+
+    def test_parallel_purchases_of_one_product(self):
+        with ThreadPoolExecutor(max_workers=16) as pool:
+            results = list(pool.map(self._buy, range(self.purchases_count)))
+
+        sold = sum(results)
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.amount, self.stock - sold)
+        self.assertEqual(Purchase.objects.aggregate(total=Sum("amount"))["total"], sold)
+
+        # every customer can afford 12 units, so 240 buyers compete for 200 units
+        self.assertEqual(sold, self.stock)
+        for customer in Customer.objects.all():
+            bought = Purchase.objects.filter(customer=customer).count()
+            self.assertEqual(customer.wallet, self.wallet - bought * self.price)
+            self.assertGreaterEqual(customer.wallet, 0)
+
+
+class ReadQueryCountTest(TestCase):
+    """The number of queries of a read endpoint doesn't depend on the size of a page"""
+
+    def setUp(self):
+        self.client = APIClient()
+        self.admin = Customer.objects.create(username="admin", is_staff=True, is_superuser=True)
+        self.customer = Customer.objects.create(username="customer", wallet=Decimal("1000.00"))
+        self.categories = [Category.objects.create(name=f"Category {i}", slug=f"category-{i}")
+                           for i in range(3)]
+
+    def _add_rows(self, number):
+        for i in range(number):
+            product = Product.objects.create(name=f"Product {Product.objects.count()}",
+                                             slug=f"product-{Product.objects.count()}",
+                                             price=Decimal("1.00"), amount=10,
+                                             category=self.categories[i % 3])
+            purchase = Purchase.objects.create(customer=self.customer, product=product, amount=1,
+                                               price_at_time_purchase=product.price)
+            PurchaseReturns.objects.create(to_purchase=purchase)
+
+    def _count_queries(self, user, url):
+        self.client.force_authenticate(user)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def assertQueriesCapped(self, user, url, cap):
+        self._add_rows(1)
+        few = self._count_queries(user, url)
+        self._add_rows(5)
+        many = self._count_queries(user, url)
+        self.assertEqual(few, many)
+        self.assertLessEqual(many, cap)
+
+    def test_product_list(self):
+        self.assertQueriesCapped(self.customer, "/api/shop-home/", cap=1)
+
+    def test_category_list(self):
+        self.assertQueriesCapped(self.admin, "/api/category/", cap=2)
+
+    def test_purchase_list(self):
+        self.assertQueriesCapped(self.customer, "/api/purchase/", cap=1)
+        self.assertQueriesCapped(self.admin, "/api/purchase/", cap=1)
+
+    def test_refund_list(self):
+        self.assertQueriesCapped(self.customer, "/api/refund/", cap=1)
+        self.assertQueriesCapped(self.admin, "/api/refund/", cap=1)
+
+    def test_details(self):
+        self._add_rows(1)
+        purchase = Purchase.objects.get()
+        refund = PurchaseReturns.objects.get()
+        self.assertLessEqual(self._count_queries(self.customer, f"/api/shop-home/{purchase.product_id}/"), 1)
+        self.assertLessEqual(self._count_queries(self.customer, f"/api/purchase/{purchase.pk}/"), 1)
+        self.assertLessEqual(self._count_queries(self.customer, f"/api/refund/{refund.pk}/"), 1)
+
+
+class BenchmarkSuiteTest(TestCase):
+    """A short run of the benchmark suite, every endpoint answers and gets measured"""
+
+    def test_every_endpoint_is_measured(self):
+        report = run_benchmarks(categories=2, products=20, customers=3, purchases=50, refunds=5,
+                                iterations=5, warmup=1)
+
+        self.assertEqual(len(report["endpoints"]), 12)
+        for name, result in report["endpoints"].items():
+            with self.subTest(endpoint=name):
+                self.assertEqual(result["requests"], 5)
+                self.assertEqual(result["errors"], 0)
+                self.assertLessEqual(result["p50_ms"], result["p95_ms"])
+                self.assertLessEqual(result["p95_ms"], result["p99_ms"])
+
+        self.assertEqual(compare_reports(report, report), {})
+
+    def test_running_servers_are_timed_on_their_own_catalog(self):
+        with patch("e_shop.benchmarks._http_request", return_value=200):
+            self.assertRaises(ValueError, run_server_benchmarks, asgi_url="http://asgi", wsgi_url="http://wsgi")
+
+        category = Category.objects.create(name="Served", slug="served")
+        product = Product.objects.create(name="Served product", slug="served-product", price=Decimal("1.00"),
+                                         amount=1, category=category)
+        with patch("e_shop.benchmarks._http_request", return_value=200) as http, \
+                patch("e_shop.benchmarks.seed_shop") as seed:
+            report = run_server_benchmarks(requests=2, concurrency=1, asgi_url="http://asgi",
+                                           wsgi_url="http://wsgi")
+
+        seed.assert_not_called()
+        self.assertIn(("http://asgi", f"/api/async/shop-home/{product.pk}/"), [call.args for call in http.mock_calls])
+        self.assertEqual(report["endpoints"]["product detail"]["wsgi sync"]["requests"], 2)
+        self.assertFalse(report["in_process"])
+
+
+class ReplicaRouterTest(TransactionTestCase):
+    """Which database the router picks, the replica alias needn't exist for it"""
+
+    def setUp(self):
+        self.router = ReplicaRouter(replicas=("replica",))
+        self.factory = RequestFactory()
+        self.customer = Customer.objects.create(username="reader")
+        caches["default"].delete(f"e_shop:replica-pin:{self.customer.pk}")
+        # the session of a client that sends its cookie
+        self.session = SessionStore()
+        self.session.create()
+
+    def _route(self, method, read_replica=True, user=None, write=False, session=None, versions=False):
+        class Page:
+            pass
+        Page.read_replica = read_replica
+
+        def view(request):
+            pass
+        view.view_class = Page
+
+        routed = {}
+
+        def get_response(request):
+            middleware.process_view(request, view, (), {})
+            if versions:
+                model_versions(Product, Category)
+            routed["catalog"] = self.router.db_for_read(Product)
+            routed["other"] = self.router.db_for_read(WalletTransaction)
+            with transaction.atomic():
+                routed["atomic"] = self.router.db_for_read(Purchase)
+            if write:
+                routed["write"] = self.router.db_for_write(Purchase)
+                routed["after_write"] = self.router.db_for_read(Purchase)
+            return HttpResponse()
+
+        middleware = ReplicaRoutingMiddleware(get_response)
+        request = getattr(self.factory, method)("/")
+        request.user = user or AnonymousUser()
+        request.session = session or SessionStore()
+        middleware(request)
+        return routed
+
+    def test_safe_requests_of_marked_views_read_from_the_replica(self):
+        routed = self._route("get")
+        self.assertEqual(routed["catalog"], "replica")
+        self.assertEqual(routed["other"], "default")
+        self.assertEqual(routed["atomic"], "default")
+
+    def test_other_requests_stay_on_the_primary(self):
+        self.assertEqual(self._route("get", read_replica=False)["catalog"], "default")
+        self.assertEqual(self._route("post")["catalog"], "default")
+        self.assertEqual(self.router.db_for_read(Product), "default")
+
+    def test_reads_after_a_write_stay_on_the_primary(self):
+        routed = self._route("get", user=self.customer, write=True, session=self.session)
+        self.assertEqual(routed["write"], "default")
+        self.assertEqual(routed["after_write"], "default")
+
+        # the next requests of the session read their own writes too, the pin is not per process
+        self.assertIn(PIN_SESSION_KEY, self.session)
+        self.assertEqual(self._route("get", user=self.customer, session=self.session)["catalog"], "default")
+        self.assertEqual(self._route("get", user=self.customer)["catalog"], "replica")
+
+        with patch("e_shop.routers.time.time", return_value=time.time() + PIN_SECONDS + 1):
+            self.assertEqual(self._route("get", session=self.session)["catalog"], "replica")
+
+    def test_clients_without_a_session_are_pinned_by_user(self):
+        cookieless = SessionStore()
+        self._route("post", user=self.customer, write=True, session=cookieless)
+        self.assertNotIn(PIN_SESSION_KEY, cookieless)
+        self.assertIsNone(cookieless.session_key)
+
+        self.assertEqual(self._route("get", user=self.customer)["catalog"], "default")
+        self.assertEqual(self._route("get", user=Customer.objects.create(username="other"))["catalog"],
+                         "replica")
+
+    def test_pages_of_fresh_versions_read_from_the_primary(self):
+        caches["default"].set_many({_version_key(model): math.ceil(time.time()) - PIN_SECONDS - 1
+                                    for model in (Product, Category)}, None)
+        self.assertEqual(self._route("get", versions=True)["catalog"], "replica")
+
+        # a replica that lags behind the bump would cache its old rows under the new version
+        bump_model_version(Product)
+        self.assertEqual(self._route("get", versions=True)["catalog"], "default")
+        self.assertEqual(self._route("get")["catalog"], "replica")
+
+
+@skipUnless(REPLICAS, "set DATABASE_REPLICAS to test with a replica")
+class ReplicaReadTest(TransactionTestCase):
+    """Storefront reads reach the replica, run it with DATABASE_REPLICAS='{"replica": {}}'"""
+    databases = {"default", *REPLICAS}
+
+    def setUp(self):
+        category = Category.objects.create(name="Replicated", slug="replicated")
+        self.product = Product.objects.create(name="Replicated product", slug="replicated-product",
+                                              price=Decimal("1.00"), amount=10, category=category)
+        self.customer = Customer.objects.create(username="replica-buyer", wallet=Decimal("10.00"))
+        # the catalog changed long ago, its pages can be built from the replica
+        self._age_versions()
+
+    def _age_versions(self):
+        caches["default"].set_many({_version_key(model): math.ceil(time.time()) - PIN_SECONDS - 1
+                                    for model in (Product, Category, Purchase)}, None)
+
+    def _replica_queries(self, method, url, client=None, **data):
+        with ExitStack() as stack:
+            captured = [stack.enter_context(CaptureQueriesContext(connections[alias])) for alias in REPLICAS]
+            getattr(client or self.client, method)(url, data)
+        return sum(len(queries) for queries in captured)
+
+    def test_storefront_reads_from_the_replica_until_the_user_writes(self):
+        self.client.force_login(self.customer)
+        self.assertGreater(self._replica_queries("get", "/"), 0)
+        self.assertGreater(self._replica_queries("get", "/customer/purchase/"), 0)
+
+        self.assertEqual(self._replica_queries("post", f"/product/buy/{self.product.slug}/", amount=1), 0)
+        self.assertEqual(self._replica_queries("get", "/customer/purchase/"), 0)
+
+    def test_pages_and_etags_of_a_fresh_catalog_are_built_from_the_primary(self):
+        self.assertGreater(self._replica_queries("get", "/"), 0)
+        self.assertGreater(self._replica_queries("get", "/api/shop-home/"), 0)
+
+        bump_model_version(Product)
+        self.assertEqual(self._replica_queries("get", "/"), 0)
+        self.assertEqual(self._replica_queries("get", "/api/shop-home/"), 0)
+
+    def test_token_clients_read_their_writes(self):
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f"Token {Token.objects.create(user=self.customer).key}")
+        self.assertGreater(self._replica_queries("get", "/api/purchase/", client), 0)
+
+        self.assertEqual(client.post("/api/purchase/", {"product": self.product.pk, "amount": 1}).status_code, 201)
+        self._age_versions()
+        self.assertEqual(self._replica_queries("get", "/api/purchase/", client), 0)
+        # no session was started for the pin
+        self.assertFalse(client.cookies)
+
+
+class PageVersionTest(TestCase):
+    """Every bump moves Last-Modified, clients revalidating by date see each change"""
+
+    def setUp(self):
+        caches["default"].clear()
+
+    def test_bumps_in_one_second_change_last_modified(self):
+        first = self.client.get("/")
+        self.assertEqual(first.status_code, 200)
+
+        bump_model_version(Product)
+        revalidated = self.client.get("/", HTTP_IF_MODIFIED_SINCE=first.headers["Last-Modified"])
+        self.assertEqual(revalidated.status_code, 200)
+        self.assertNotEqual(revalidated.headers["Last-Modified"], first.headers["Last-Modified"])
+
+        bump_model_version(Product)
+        again = self.client.get("/", HTTP_IF_MODIFIED_SINCE=revalidated.headers["Last-Modified"])
+        self.assertEqual(again.status_code, 200)
+
+        unchanged = self.client.get("/", HTTP_IF_MODIFIED_SINCE=again.headers["Last-Modified"])
+        self.assertEqual(unchanged.status_code, 304)
+
+
+class TokenAuthenticationTest(TestCase):
+    """Validated DRF tokens are cached, the cache never outlives the token"""
+
+    def setUp(self):
+        _token_cache.clear()
+        self.customer = Customer.objects.create(username="token-holder")
+        self.token = Token.objects.create(user=self.customer)
+        self.authentication = TokenWithTimeToLiveAuthentication()
+
+    def test_cached_token_needs_no_query(self):
+        user, token = self.authentication.authenticate_credentials(self.token.key)
+        self.assertEqual((user.pk, token.key), (self.customer.pk, self.token.key))
+
+        with self.assertNumQueries(0):
+            user, _ = self.authentication.authenticate_credentials(self.token.key)
+        self.assertEqual(user.pk, self.customer.pk)
+
+    def test_expired_token_is_refused_even_when_cached(self):
+        self.authentication.authenticate_credentials(self.token.key)
+
+        later = timezone.now() + TOKEN_TIME_TO_LIVE
+        with patch("e_shop.API.authentication.timezone.now", return_value=later), \
+                self.assertNumQueries(0):
+            with self.assertRaises(AuthenticationFailed):
+                self.authentication.authenticate_credentials(self.token.key)
+        self.assertIsNone(_token_cache.get(self.token.key))
+
+    def test_logout_evicts_the_cached_token(self):
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f"Token {self.token.key}")
+        self.assertEqual(client.get("/api/purchase/").status_code, 200)
+        self.assertIsNotNone(_token_cache.get(self.token.key))
+
+        self.assertEqual(client.post("/api/logout/").status_code, 205)
+        self.assertIsNone(_token_cache.get(self.token.key))
+        self.assertEqual(client.get("/api/purchase/").status_code, 401)
+
+    def test_deleted_token_is_evicted(self):
+        self.authentication.authenticate_credentials(self.token.key)
+        Token.objects.filter(pk=self.token.pk).delete()
+
+        self.assertIsNone(_token_cache.get(self.token.key))
+        with self.assertRaises(AuthenticationFailed):
+            self.authentication.authenticate_credentials(self.token.key)
+
+    def test_revocations_reach_the_caches_of_other_processes(self):
+        self.authentication.authenticate_credentials(self.token.key)
+        cached = _token_cache.get(self.token.key)
+        with self.captureOnCommitCallbacks(execute=True):
+            Token.objects.filter(pk=self.token.pk).delete()
+
+        # the entry another worker validated before the deletion
+        _token_cache.set(self.token.key, cached)
+        with self.assertRaises(AuthenticationFailed):
+            self.authentication.authenticate_credentials(self.token.key)
+
+    def test_deactivated_user_is_refused(self):
+        self.authentication.authenticate_credentials(self.token.key)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.customer.is_active = False
+            self.customer.save()
+
+        with self.assertRaises(AuthenticationFailed):
+            self.authentication.authenticate_credentials(self.token.key)
+
+    def test_unrelated_saves_keep_the_cached_token(self):
+        self.authentication.authenticate_credentials(self.token.key)
+        customer = Customer.objects.get(pk=self.customer.pk)
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            update_last_login(None, customer)
+            customer.first_name = "Renamed"
+            customer.save()
+        self.assertEqual(callbacks, [])
+
+        with self.assertNumQueries(0):
+            self.authentication.authenticate_credentials(self.token.key)
+
+
+class MetricsAccessTest(TestCase):
+    """The metrics carry SQL fingerprints, a local address isn't enough to read them"""
+
+    def test_only_superusers_read_the_metrics(self):
+        self.assertEqual(self.client.get("/metrics", REMOTE_ADDR="127.0.0.1").status_code, 403)
+
+        self.client.force_login(Customer.objects.create(username="customer"))
+        self.assertEqual(self.client.get("/metrics").status_code, 403)
+
+        self.client.force_login(Customer.objects.create(username="root", is_staff=True, is_superuser=True))
+        self.assertEqual(self.client.get("/metrics").status_code, 200)
+
+
+class AsyncCategoryListTest(TestCase):
+    """The async category list is for staff only, like the sync one"""
+
+    def _get(self, user=None):
+        headers = {}
+        if user is not None:
+            headers["HTTP_AUTHORIZATION"] = f"Token {Token.objects.create(user=user).key}"
+        return self.client.get("/api/async/category/", **headers)
+
+    def test_anonymous_and_customers_are_refused(self):
+        Category.objects.create(name="Hidden", slug="hidden")
+        _token_cache.clear()
+
+        anonymous = self._get()
+        self.assertEqual(anonymous.status_code, 401)
+        self.assertEqual(self.client.get("/api/category/").status_code, 401)
+        self.assertNotIn("Hidden", anonymous.content.decode())
+
+        self.assertEqual(self._get(Customer.objects.create(username="customer")).status_code, 403)
+        self.assertEqual(self.client.get("/api/async/category/", HTTP_AUTHORIZATION="Token wrong").status_code, 401)
+
+        staff = self._get(Customer.objects.create(username="staff", is_staff=True))
+        self.assertEqual(staff.status_code, 200)
+        self.assertEqual([category["name"] for category in staff.json()], ["Hidden"])
+
+
+class ProductImportTest(TestCase):
+    """Catalog rows are upserted by slug, the counters, the search and the typeahead follow"""
+
+    catalog = ("name,slug,description,price,amount,category,is_available\n"
+               "Old lamp,old-lamp,Brighter bulb,7.50,0,Lighting,true\n"
+               "Desk fan,,Quiet blades,12.00,4,Lighting,yes\n"
+               "Free fan,,,0,1,Lighting,true\n")
+
+    def setUp(self):
+        self.old_category = Category.objects.create(name="Misc", slug="misc")
+        self.lamp = Product.objects.create(name="Old lamp", slug="old-lamp", price=Decimal("5.00"),
+                                           amount=3, category=self.old_category)
+
+    def assertUpserted(self):
+        caches["default"].set(GENERATION_KEY, 7, timeout=None)
+        version, = model_versions(Product)
+
+        stats = import_products(io.StringIO(self.catalog), "csv")
+
+        self.assertEqual((stats.rows, stats.created, stats.updated, stats.failed, stats.categories),
+                         (3, 1, 1, 1, 1))
+        self.assertEqual(stats.errors[0]["line"], 4)
+        self.assertIn("price", stats.errors[0]["error"])
+        self.assertFalse(Product.objects.filter(name="Free fan").exists())
+
+        lighting = Category.objects.get(name="Lighting")
+        self.lamp.refresh_from_db()
+        self.assertEqual(self.lamp.pk, Product.objects.get(slug="old-lamp").pk)
+        self.assertEqual((self.lamp.price, self.lamp.amount, self.lamp.category_id),
+                         (Decimal("7.50"), 0, lighting.pk))
+        self.assertEqual(Product.objects.get(name="Desk fan").slug, "desk-fan")
+
+        # the moved product left the counters of its old category
+        self.old_category.refresh_from_db()
+        self.assertEqual((self.old_category.product_count, self.old_category.in_stock_count), (0, 0))
+        self.assertEqual((lighting.product_count, lighting.available_count, lighting.in_stock_count), (2, 2, 1))
+
+        found = search_products(Product.objects.all(), query="quiet").values_list("name", flat=True)
+        self.assertEqual(list(found), ["Desk fan"])
+        self.assertEqual(list(search_products(Product.objects.all(), query="brighter")), [self.lamp])
+
+        self.assertEqual(caches["default"].get(GENERATION_KEY), 8)
+        self.assertGreater(model_versions(Product)[0], version)
+
+    def test_rows_are_upserted_by_slug(self):
+        self.assertUpserted()
+
+    def test_rows_are_upserted_by_slug_without_on_conflict(self):
+        # other databases update the known slugs and insert the rest
+        with patch("e_shop.imports.NATIVE_UPSERT", False), patch("e_shop.imports.ON_CONFLICT_VENDORS", ()), \
+                patch("e_shop.imports._insert_on_conflict") as insert_on_conflict:
+            self.assertUpserted()
+        insert_on_conflict.assert_not_called()
+
+    @skipUnless(not NATIVE_UPSERT and connection.vendor in ON_CONFLICT_VENDORS,
+                "the hand-written INSERT ... ON CONFLICT is used by PostgreSQL and SQLite on Django 4.0")
+    def test_on_conflict_is_written_by_hand(self):
+        with patch("e_shop.imports._insert_on_conflict", wraps=_insert_on_conflict) as insert_on_conflict, \
+                CaptureQueriesContext(connection) as queries:
+            self.assertUpserted()
+        insert_on_conflict.assert_called_once()
+        upserts = [query["sql"] for query in queries if "ON CONFLICT" in query["sql"]]
+        self.assertEqual(len(upserts), 1)
+        self.assertIn("DO UPDATE SET", upserts[0])
+
+    def test_big_catalogs_are_imported_by_a_job(self):
+        admin = Customer.objects.create(username="admin", is_staff=True, is_superuser=True)
+        client = APIClient()
+        client.force_authenticate(admin)
+
+        with TemporaryDirectory() as media, self.settings(MEDIA_ROOT=media), \
+                patch("e_shop.API.resources.IMPORT_INLINE_LIMIT", 10):
+            upload = SimpleUploadedFile("catalog.csv", self.catalog.encode())
+            response = client.post("/api/shop-home/import/", {"file": upload}, format="multipart")
+            self.assertEqual(response.status_code, 202)
+            self.assertFalse(Product.objects.filter(name="Desk fan").exists())
+
+            job = Job.objects.get(pk=response.data["queued"])
+            TASKS[job.name](**job.kwargs)
+            self.assertTrue(Product.objects.filter(name="Desk fan").exists())
+            self.assertFalse(default_storage.exists(job.kwargs["path"]))
+
+
+class CategoryCounterTest(TestCase):
+    """The denormalized counters follow every change of the products, in their transaction"""
+
+    def setUp(self):
+        self.first = Category.objects.create(name="First", slug="first")
+        self.second = Category.objects.create(name="Second", slug="second")
+        self.customer = Customer.objects.create(username="counter-buyer", wallet=Decimal("100.00"))
+
+    def assertCounters(self, category, counters):
+        category.refresh_from_db()
+        self.assertEqual((category.product_count, category.available_count, category.in_stock_count), counters)
+
+    def _product(self, amount=2, category=None):
+        return Product.objects.create(name=f"Counted {amount}", slug=f"counted-{amount}", price=Decimal("10.00"),
+                                      amount=amount, category=category or self.first)
+
+    def test_create_move_toggle_and_delete(self):
+        product = self._product()
+        self.assertCounters(self.first, (1, 1, 1))
+
+        product.category = self.second
+        product.save()
+        self.assertCounters(self.first, (0, 0, 0))
+        self.assertCounters(self.second, (1, 1, 1))
+
+        product.is_available = False
+        product.save()
+        self.assertCounters(self.second, (1, 0, 0))
+
+        product.delete()
+        self.assertCounters(self.second, (0, 0, 0))
+
+    def test_sell_out_and_refund(self):
+        product = self._product(amount=1)
+        purchase = buy_product(self.customer, product, 1)
+        self.assertCounters(self.first, (1, 1, 0))
+
+        refund_purchase(PurchaseReturns.objects.create(to_purchase=purchase))
+        self.assertCounters(self.first, (1, 1, 1))
+
+    def test_a_failed_count_rolls_the_save_back(self):
+        product = self._product()
+        with patch("e_shop.signals.apply_deltas", side_effect=RuntimeError("crash")):
+            with self.assertRaises(RuntimeError):
+                self._product(amount=3)
+            product.category = self.second
+            with self.assertRaises(RuntimeError):
+                product.save()
+
+        self.assertFalse(Product.objects.filter(slug="counted-3").exists())
+        self.assertEqual(Product.objects.get(pk=product.pk).category_id, self.first.pk)
+        self.assertCounters(self.first, (1, 1, 1))
+        self.assertCounters(self.second, (0, 0, 0))
+
+    def test_counter_changes_expire_the_category_etag(self):
+        product = self._product(amount=1)
+        client = APIClient()
+        client.force_authenticate(Customer.objects.create(username="admin", is_staff=True, is_superuser=True))
+        etag = client.get("/api/category/").headers["ETag"]
+
+        with self.captureOnCommitCallbacks(execute=True):
+            buy_product(self.customer, product, 1)
+
+        response = client.get("/api/category/", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        counts = {category["slug"]: category["in_stock_count"] for category in response.json()["results"]}
+        self.assertEqual(counts["first"], 0)
+
+
+class SuggestIndexLoadTest(SimpleTestCase):
+    """Every process gets a loaded index, after a fork or a failed load too"""
+
+    names = [Suggestion(PRODUCT, 1, "Lamp", "lamp")]
+
+    def setUp(self):
+        self.index = SuggestIndex(max_entries=10, refresh=60, cache_alias=None)
+
+    def test_a_fork_during_a_load_loads_again(self):
+        # the loader thread of the parent held the lock when the worker was forked
+        self.index._loading.acquire()
+        self.index._forked()
+
+        with patch("e_shop.suggest._suggestions", return_value=self.names):
+            self.index.load()
+        self.assertTrue(self.index.ready)
+        self.assertEqual([suggestion.name for suggestion in self.index.suggest("la")], ["Lamp"])
+
+    def test_a_failed_load_is_retried(self):
+        with patch("e_shop.suggest._suggestions", side_effect=OperationalError("gone")), \
+                self.assertLogs("e_shop.suggest", "ERROR"):
+            self.index.load()
+        self.assertFalse(self.index.ready)
+
+        with patch.object(self.index, "warm_up") as warm_up:
+            self.index.suggest("la")
+            warm_up.assert_not_called()
+
+            self.index._retry_at = 0
+            self.index.suggest("la")
+            warm_up.assert_called_once()
+
+    def test_every_process_warms_up_once(self):
+        with patch.object(self.index, "warm_up") as warm_up:
+            self.index.warm_up_process()
+            self.index.warm_up_process()
+            self.assertEqual(warm_up.call_count, 1)
+
+            self.index._warmed_pid = -1
+            self.index.warm_up_process()
+            self.assertEqual(warm_up.call_count, 2)
+
+
+class SuggestIndexReplayTest(SimpleTestCase):
+    """The processes replay the changes published by the others, only a gap in them reloads the index"""
+
+    names = [Suggestion(PRODUCT, 1, "Lamp", "lamp"), Suggestion(PRODUCT, 2, "Fan", "fan")]
+
+    def setUp(self):
+        caches["default"].clear()
+        self.first, self.second = (SuggestIndex(max_entries=10, refresh=0, cache_alias="default")
+                                   for _ in range(2))
+        with patch("e_shop.suggest._suggestions", return_value=self.names):
+            self.first.load()
+            self.second.load()
+
+    def _names(self, index, prefix):
+        return [suggestion.name for suggestion in index.suggest(prefix)]
+
+    def test_changes_of_other_processes_are_replayed(self):
+        self.first.changed(PRODUCT, 3, None, "Lamp shade", "lamp-shade")
+        self.first.changed(PRODUCT, 1, "Lamp", "Desk lamp", "desk-lamp")
+        self.first.changed(PRODUCT, 2, "Fan", None)
+
+        with patch.object(self.second, "warm_up") as warm_up:
+            self.assertEqual(self._names(self.second, "lamp"), ["Lamp shade"])
+            self.assertEqual(self._names(self.second, "desk"), ["Desk lamp"])
+            self.assertEqual(self._names(self.second, "fan"), [])
+        warm_up.assert_not_called()
+        self.assertEqual(self.second._generation, caches["default"].get(GENERATION_KEY))
+
+    def test_interleaved_changes_end_in_the_same_index(self):
+        self.first.changed(PRODUCT, 1, "Lamp", "Desk lamp", "desk-lamp")
+        self.second.changed(PRODUCT, 1, "Desk lamp", "Floor lamp", "floor-lamp")
+        self.first.changed(PRODUCT, 2, "Fan", "Desk fan", "desk-fan")
+
+        with patch.object(self.first, "warm_up") as first_warm_up, \
+                patch.object(self.second, "warm_up") as second_warm_up:
+            # a process replays its own changes in their place among the others
+            for index in (self.first, self.second):
+                self.assertEqual(self._names(index, "desk"), ["Desk fan"])
+                self.assertEqual(self._names(index, "floor"), ["Floor lamp"])
+                self.assertEqual(self._names(index, "lamp"), [])
+        first_warm_up.assert_not_called()
+        second_warm_up.assert_not_called()
+
+    def test_a_gap_reloads_the_index(self):
+        self.first.changed(PRODUCT, 3, None, "Lamp shade", "lamp-shade")
+        self.first.changed(PRODUCT, 4, None, "Lamp post", "lamp-post")
+        caches["default"].delete(_change_key(1))
+        with patch.object(self.second, "warm_up") as warm_up:
+            self.second.suggest("lamp")
+        warm_up.assert_called_once()
+        self.assertEqual(self._names(self.second, "lamp"), ["Lamp"])
+
+        for bump in (lambda: self.first.invalidate(),
+                     lambda: caches["default"].incr(GENERATION_KEY, MAX_REPLAY + 1)):
+            second = SuggestIndex(max_entries=10, refresh=0, cache_alias="default")
+            with patch("e_shop.suggest._suggestions", return_value=self.names):
+                second.load()
+            bump()
+            with patch.object(second, "warm_up") as warm_up:
+                second.suggest("lamp")
+            warm_up.assert_called_once()
+
+
+class StockReservationTest(TestCase):
+    """Held units can't be sold to other customers until the hold is consumed or expires"""
+
+    def setUp(self):
+        caches["default"].clear()
+        category = Category.objects.create(name="Flash sale", slug="flash-sale")
+        self.product = Product.objects.create(name="Console", slug="console", price=Decimal("10.00"),
+                                              amount=5, category=category)
+        self.holder = Customer.objects.create(username="holder", wallet=Decimal("100.00"))
+        self.other = Customer.objects.create(username="other", wallet=Decimal("100.00"))
+
+    def _reserve(self, customer, amount):
+        with self.captureOnCommitCallbacks(execute=True):
+            return reserve_stock(customer, self.product, amount)
+
+    def test_holds_keep_units_from_other_customers(self):
+        self._reserve(self.holder, 3)
+        self.assertEqual(held_by_others([self.product.pk], self.other.pk), {self.product.pk: 3})
+        self.assertEqual(held_by_others([self.product.pk], self.holder.pk), {})
+
+        with self.assertRaises(OutOfStock):
+            buy_product(self.other, self.product, 3)
+        buy_product(self.other, self.product, 2)
+        with self.assertRaises(OutOfStock):
+            self._reserve(self.other, 1)
+
+        # a new hold of the same customer replaces the previous one
+        self._reserve(self.holder, 1)
+        self.assertEqual(StockReservation.objects.get(customer=self.holder).amount, 1)
+
+    def test_a_count_read_before_a_hold_is_not_cached_after_it(self):
+        cache = caches["default"]
+        product = self.product
+
+        class Racing:
+            # a hold is committed between the aggregation of a reader and its cache write
+            def __getattr__(self, name):
+                return getattr(cache, name)
+
+            def set_many(self, entries, timeout=None):
+                StockReservation.objects.create(customer=Customer.objects.get(username="holder"),
+                                                product=product, amount=2,
+                                                expires_at=timezone.now() + timedelta(minutes=5))
+                forget_held([product.pk])
+                return cache.set_many(entries, timeout)
+
+        with patch("e_shop.reservations._cache", return_value=Racing()):
+            self.assertEqual(held_units([product.pk]), {product.pk: 0})
+        self.assertEqual(held_units([product.pk]), {product.pk: 2})
+
+        with self.assertNumQueries(0):
+            self.assertEqual(held_units([product.pk]), {product.pk: 2})
+        cache.clear()
+        self.assertEqual(held_units([product.pk]), {product.pk: 2})
+
+    def test_the_checkout_consumes_the_own_hold(self):
+        self._reserve(self.holder, 3)
+        self._reserve(self.other, 2)
+        with self.captureOnCommitCallbacks(execute=True):
+            buy_product(self.holder, Product.objects.get(pk=self.product.pk), 3)
+
+        self.assertFalse(StockReservation.objects.filter(customer=self.holder).exists())
+        self.assertEqual(held_units([self.product.pk]), {self.product.pk: 2})
+        self.assertEqual(Product.objects.get(pk=self.product.pk).amount, 2)
+
+    def test_the_sweep_deletes_expired_holds_only(self):
+        self._reserve(self.holder, 1)
+        expired = [StockReservation(customer=Customer.objects.create(username=f"late{i}"), product=self.product,
+                                    amount=1, expires_at=timezone.now() - timedelta(minutes=1))
+                   for i in range(3)]
+        StockReservation.objects.bulk_create(expired)
+
+        self.assertEqual(sweep_expired(batch_size=2), 3)
+        self.assertEqual(list(StockReservation.objects.values_list("customer", flat=True)), [self.holder.pk])
+
+    def test_anonymous_product_page_shows_the_holds(self):
+        url = self.product.get_absolute_url()
+        page = self.client.get(url)
+        self.assertContains(page, "Quantity in stock: 5")
+
+        self._reserve(self.holder, 5)
+        held = self.client.get(url, HTTP_IF_NONE_MATCH=page.headers["ETag"])
+        self.assertContains(held, "held by other customers")
+        self.assertNotIn("Last-Modified", held.headers)
+
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=held.headers["ETag"]).status_code, 304)
+
+
+class WalletLedgerTest(TestCase):
+    """Balances are the snapshot plus the ledger after it, every movement is a transaction"""
+
+    def setUp(self):
+        category = Category.objects.create(name="Ledger", slug="ledger")
+        self.product = Product.objects.create(name="Ledger product", slug="ledger-product",
+                                              price=Decimal("15.00"), amount=10, category=category)
+        self.customer = Customer.objects.create(username="saver", wallet=Decimal("100.00"))
+
+    def _kinds(self):
+        return list(self.customer.wallet_transactions.order_by("id").values_list("kind", "amount"))
+
+    def test_deposit_checkout_and_refund(self):
+        deposit(self.customer, Decimal("25.00"))
+        with self.assertRaises(WalletError):
+            deposit(self.customer, Decimal("0"))
+        self.assertEqual(balance_of(self.customer), Decimal("125.00"))
+
+        purchase = buy_product(self.customer, self.product, 2)
+        self.assertEqual(self.customer.wallet, Decimal("95.00"))
+        refund_purchase(PurchaseReturns.objects.create(to_purchase=purchase))
+
+        self.assertEqual(balance_of(self.customer), Decimal("125.00"))
+        self.assertEqual(self._kinds(), [(WalletTransaction.DEPOSIT, Decimal("100.00")),
+                                         (WalletTransaction.DEPOSIT, Decimal("25.00")),
+                                         (WalletTransaction.PURCHASE, Decimal("-30.00")),
+                                         (WalletTransaction.REFUND, Decimal("30.00"))])
+        with self.assertRaises(InsufficientFunds):
+            buy_product(self.customer, self.product, 9)
+
+    def test_materialize_folds_the_tail_into_the_snapshot(self):
+        for _ in range(4):
+            deposit(self.customer, Decimal("1.10"))
+        before = balance_of(self.customer)
+
+        self.assertEqual(materialize([self.customer.pk], min_tail=5), 1)
+        snapshot = WalletSnapshot.objects.get(customer=self.customer)
+        self.assertEqual(snapshot.last_transaction_id, self.customer.wallet_transactions.latest("id").pk)
+        self.assertEqual(snapshot.balance, before)
+        self.assertEqual(balance_of(self.customer), before)
+
+        # nothing is left to fold, later transactions are added on top of the snapshot
+        self.assertEqual(materialize([self.customer.pk], min_tail=1), 0)
+        deposit(self.customer, Decimal("2.00"))
+        self.assertEqual(balance_of(self.customer), before + Decimal("2.00"))
+
+    def test_reconcile_repairs_drifted_snapshots(self):
+        materialize([self.customer.pk], min_tail=1)
+        WalletSnapshot.objects.filter(customer=self.customer).update(balance=Decimal("7.00"))
+
+        self.assertEqual(reconcile(), [(self.customer.pk, Decimal("7.00"), Decimal("100.00"))])
+        output = io.StringIO()
+        call_command("reconcile_wallets", stdout=output)
+        self.assertIn("1 wallet snapshots drifted", output.getvalue())
+        self.assertEqual(balance_of(self.customer), Decimal("7.00"))
+
+        call_command("reconcile_wallets", "--repair", stdout=io.StringIO())
+        self.assertEqual(reconcile(), [])
+        self.assertEqual(balance_of(self.customer), Decimal("100.00"))
+
+
+class WalletLedgerMigrationTest(TransactionTestCase):
+    """0015 turns the balances of the wallet column into opening deposits"""
+
+    before = [("e_shop", "0014_stockreservation")]
+    after = [("e_shop", "0015_wallet_ledger")]
+
+    def _migrate(self, targets):
+        executor = MigrationExecutor(connection)
+        executor.migrate(targets)
+        return executor.loader.project_state(targets).apps
+
+    def tearDown(self):
+        executor = MigrationExecutor(connection)
+        executor.migrate(executor.loader.graph.leaf_nodes())
+
+    def test_balances_become_opening_deposits(self):
+        apps = self._migrate(self.before)
+        OldCustomer = apps.get_model("e_shop", "Customer")
+        rich = OldCustomer.objects.create(username="rich", wallet=Decimal("12.50")).pk
+        broke = OldCustomer.objects.create(username="broke", wallet=Decimal("0.00")).pk
+
+        apps = self._migrate(self.after)
+        deposits = apps.get_model("e_shop", "WalletTransaction").objects
+        snapshots = apps.get_model("e_shop", "WalletSnapshot").objects
+        self.assertEqual(list(deposits.values_list("customer_id", "kind", "amount")),
+                         [(rich, "deposit", Decimal("12.50"))])
+        self.assertEqual(list(snapshots.values_list("customer_id", "balance", "last_transaction_id")),
+                         [(rich, Decimal("12.50"), deposits.get().pk)])
+        self.assertFalse(deposits.filter(customer_id=broke).exists())
+
+
+class RefundBatchTest(TestCase):
+    """Refund requests are approved and rejected in batches, with statements per product, not per request"""
+
+    def setUp(self):
+        self.lamps = Category.objects.create(name="Lamps", slug="lamps")
+        self.fans = Category.objects.create(name="Fans", slug="fans")
+        self.lamp = Product.objects.create(name="Lamp", slug="lamp", price=Decimal("10.00"), amount=2,
+                                           category=self.lamps)
+        self.fan = Product.objects.create(name="Fan", slug="fan", price=Decimal("4.00"), amount=10,
+                                          category=self.fans)
+        self.customers = [Customer.objects.create(username=f"refunded{i}", wallet=Decimal("50.00"))
+                          for i in range(3)]
+        self.admin = Customer.objects.create(username="admin", is_staff=True, is_superuser=True)
+
+    def _request(self, customer, product, amount):
+        purchase = buy_product(customer, Product.objects.get(pk=product.pk), amount)
+        return PurchaseReturns.objects.create(to_purchase=purchase).pk
+
+    def _rollup(self, product):
+        return SalesRollup.objects.filter(period=SalesRollup.DAY, product=product) \
+            .values_list("refunds", "units_refunded", "refunded").get()
+
+    def test_mixed_batch(self):
+        first, second, third = self.customers
+        requests = [self._request(first, self.lamp, 1), self._request(second, self.lamp, 1),
+                    self._request(first, self.fan, 2), self._request(third, self.fan, 1)]
+        self.assertEqual(Category.objects.get(pk=self.lamps.pk).in_stock_count, 0)
+
+        self.assertEqual(reject_refunds([requests[3]]), 1)
+        approved = refund_purchases(requests)
+
+        self.assertEqual(sorted(approved), requests[:3])
+        self.assertFalse(PurchaseReturns.objects.exists())
+        self.assertEqual(list(Purchase.objects.values_list("customer", flat=True)), [third.pk])
+
+        self.assertEqual([balance_of(customer) for customer in self.customers],
+                         [Decimal("50.00"), Decimal("50.00"), Decimal("46.00")])
+        self.assertEqual(WalletTransaction.objects.filter(kind=WalletTransaction.REFUND).count(), 2)
+
+        self.assertEqual(Product.objects.get(pk=self.lamp.pk).amount, 2)
+        self.assertEqual(Product.objects.get(pk=self.fan.pk).amount, 9)
+        self.assertEqual(Category.objects.get(pk=self.lamps.pk).in_stock_count, 1)
+        self.assertEqual(Category.objects.get(pk=self.fans.pk).in_stock_count, 1)
+
+        self.assertEqual(self._rollup(self.lamp), (2, 2, Decimal("20.00")))
+        self.assertEqual(self._rollup(self.fan), (1, 2, Decimal("8.00")))
+
+        # processed requests are skipped
+        self.assertEqual(refund_purchases(requests), [])
+
+    def test_statements_do_not_grow_with_the_batch(self):
+        def approve(number):
+            requests = [self._request(self.customers[i % 3], self.fan, 1) for i in range(number)]
+            with CaptureQueriesContext(connection) as queries:
+                self.assertEqual(len(refund_purchases(requests)), number)
+            return len(queries)
+
+        self.assertEqual(approve(3), approve(9))
+
+    def test_refund_queue_runs_a_fixed_number_of_queries(self):
+        self.client.force_login(self.admin)
+
+        def render(number):
+            for i in range(number):
+                self._request(self.customers[i % 3], self.fan, 1)
+            with CaptureQueriesContext(connection) as queries:
+                self.assertEqual(self.client.get("/admin-refund/").status_code, 200)
+            return len(queries)
+
+        render(0)  # fills the cached category menu
+        self.assertEqual(render(1), render(5))
+
+    def test_api(self):
+        client = APIClient()
+        client.force_authenticate(self.admin)
+        requests = [self._request(self.customers[0], self.fan, 1) for _ in range(3)]
+
+        response = client.delete(f"/api/refund/{requests[0]}/confirm/")
+        self.assertEqual(response.status_code, 207)
+
+        response = client.post("/api/refund/bulk-approve/", {"ids": requests[1:2] + [10 ** 6]},
+                               format="json")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, {"approved": requests[1:2], "skipped": [10 ** 6]})
+
+        with patch("e_shop.API.resources.REFUND_INLINE_LIMIT", 0):
+            response = client.post("/api/refund/bulk-approve/", {"ids": requests[2:]}, format="json")
+        self.assertEqual(response.status_code, 202)
+        job = Job.objects.get(pk=response.data["jobs"][0])
+        self.assertEqual((job.name, job.kwargs), ("refund_purchases", {"refund_ids": requests[2:]}))
+        self.assertTrue(PurchaseReturns.objects.filter(pk=requests[2]).exists())
+
+        TASKS[job.name](**job.kwargs)
+        self.assertFalse(PurchaseReturns.objects.exists())
+        self.assertEqual(balance_of(self.customers[0]), Decimal("50.00"))
+
+
+@skipUnlessDBFeature("has_select_for_update")
+class JobClaimTest(TransactionTestCase):
+    jobs_count = 60
+
+    def setUp(self):
+        for _ in range(self.jobs_count):
+            enqueue("purge_tokens")
+
+    def _drain(self, number):
+        claimed = []
+        try:
+            while jobs := claim(4, f"worker{number}"):
+                claimed.extend(job.pk for job in jobs)
+            return claimed
+        finally:
+            connection.close()
+
+    def test_parallel_workers_never_share_a_job(self):
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            claimed = [pk for jobs in pool.map(self._drain, range(8)) for pk in jobs]
+
+        self.assertEqual(len(claimed), self.jobs_count)
+        self.assertEqual(set(claimed), set(Job.objects.values_list("pk", flat=True)))
+        self.assertFalse(Job.objects.exclude(status=Job.RUNNING, attempts=1).exists())
+
+
+@skipUnlessDBFeature("has_select_for_update")
+class JobLeaseTest(TransactionTestCase):
+
+    def test_running_jobs_keep_their_lease(self):
+        started, release = threading.Event(), threading.Event()
+
+        def slow():
+            started.set()
+            release.wait(10)
+
+        with patch.dict(TASKS, {"slow": slow}), patch.dict(PERIODIC, clear=True), \
+                patch("e_shop.jobs.LEASE", timedelta(seconds=1)), ThreadPoolExecutor(max_workers=1) as pool:
+            job = enqueue("slow")
+            worker = Worker(concurrency=1, poll_interval=0.05, name="heartbeat")
+            done = pool.submit(worker.run, burst=True)
+            try:
+                self.assertTrue(started.wait(10))
+                time.sleep(0.5)
+                # longer than the lease, but the worker is alive
+                self.assertEqual(requeue_stale(timedelta(seconds=0.3)), 0)
+            finally:
+                connection.close()
+                release.set()
+            self.assertEqual(done.result(timeout=10), 1)
+
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), (Job.DONE, 1))
+
+
+class JobQueueTest(TestCase):
+
+    def _claim(self):
+        Job.objects.filter(status=Job.QUEUED).update(run_at=timezone.now())
+        return claim(10, "worker")
+
+    def test_retry_with_backoff(self):
+        job = enqueue("purge_tokens", max_attempts=2)
+        before = timezone.now()
+        _finish(self._claim()[0], error="boom")
+
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts, job.last_error, job.locked_by), (Job.QUEUED, 1, "boom", ""))
+        self.assertGreaterEqual(job.run_at, before + timedelta(seconds=backoff(1)))
+        self.assertEqual(claim(10, "worker"), [])  # not due before the backoff passed
+
+        _finish(self._claim()[0], error="boom again")
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts, job.last_error), (Job.FAILED, 2, "boom again"))
+        self.assertIsNotNone(job.time_done)
+        self.assertEqual(self._claim(), [])
+
+    def test_periodic_chain(self):
+        schedule_periodic()
+        schedule_periodic()
+        self.assertEqual(sorted(Job.objects.values_list("key", flat=True)), sorted(PERIODIC))
+
+        jobs = {job.name: job for job in self._claim()}
+        before = timezone.now()
+        _finish(jobs["sweep_reservations"])
+        _finish(jobs["purge_tokens"], error="boom")
+
+        queued = {job.name: job for job in Job.objects.filter(status=Job.QUEUED)}
+        self.assertEqual(set(queued), {"sweep_reservations", "purge_tokens"})
+        self.assertEqual(queued["purge_tokens"].pk, jobs["purge_tokens"].pk)  # the retry keeps the key
+        next_run = queued["sweep_reservations"]
+        self.assertNotEqual(next_run.pk, jobs["sweep_reservations"].pk)
+        self.assertEqual(next_run.key, "sweep_reservations")
+        self.assertGreaterEqual(next_run.run_at, before + timedelta(seconds=PERIODIC["sweep_reservations"]))
+
+    def test_requeue_after_the_lease(self):
+        lost = enqueue("purge_tokens")
+        periodic = enqueue("sweep_reservations", key="sweep_reservations", max_attempts=1)
+        alive = enqueue("materialize_wallets")
+        self._claim()
+        Job.objects.exclude(pk=alive.pk).update(locked_at=timezone.now() - timedelta(hours=1))
+
+        self.assertEqual(requeue_stale(timedelta(minutes=10)), 2)
+
+        statuses = dict(Job.objects.values_list("pk", "status"))
+        self.assertEqual(statuses.pop(lost.pk), Job.QUEUED)
+        self.assertEqual(statuses.pop(periodic.pk), Job.FAILED)
+        self.assertEqual(statuses.pop(alive.pk), Job.RUNNING)
+        # the periodic task that ran out of attempts still gets its next run
+        next_run = Job.objects.get(pk__in=statuses)
+        self.assertEqual((next_run.key, next_run.status), ("sweep_reservations", Job.QUEUED))
+
+    def test_leases_of_live_workers_are_renewed(self):
+        enqueue("purge_tokens")
+        enqueue("materialize_wallets")
+        jobs = self._claim()
+        Job.objects.update(locked_at=timezone.now() - timedelta(hours=1))
+
+        self.assertEqual(renew_leases(jobs[:1]), 1)
+        self.assertEqual(requeue_stale(timedelta(minutes=10)), 1)
+        self.assertEqual(dict(Job.objects.values_list("name", "status")),
+                         {jobs[0].name: Job.RUNNING, jobs[1].name: Job.QUEUED})
+        self.assertEqual(renew_leases(jobs[1:]), 0)
+
+    def test_admin_retry_skips_taken_keys(self):
+        failed = enqueue("purge_tokens", max_attempts=1)
+        periodic = enqueue("sweep_reservations", key="sweep_reservations", max_attempts=1)
+        for job in self._claim():
+            _finish(job, error="boom")
+        self.assertEqual(Job.objects.filter(status=Job.FAILED).count(), 2)
+
+        self.client.force_login(Customer.objects.create(username="admin", is_staff=True, is_superuser=True))
+        response = self.client.post("/admin/e_shop/job/", {"action": "retry_selected",
+                                                           "_selected_action": [failed.pk, periodic.pk]},
+                                    follow=True)
+        self.assertContains(response, "1 jobs queued again, 1 skipped")
+
+        statuses = dict(Job.objects.values_list("pk", "status"))
+        self.assertEqual((statuses[failed.pk], statuses[periodic.pk]), (Job.QUEUED, Job.FAILED))
+        self.assertEqual(Job.objects.filter(key="sweep_reservations", status=Job.QUEUED).count(), 1)
+
+
+class KeysetPaginationTest(TestCase):
+    """Pages of the API follow the cursor both ways, bad page sizes fall back to the default"""
+
+    def setUp(self):
+        category = Category.objects.create(name="Paged", slug="paged")
+        self.products = [Product.objects.create(name=f"Paged {i}", slug=f"paged-{i}", price=Decimal("1.00"),
+                                                amount=1, category=category) for i in range(5)]
+        self.client = APIClient()
+
+    def _names(self, response):
+        self.assertEqual(response.status_code, 200)
+        return [product["name"] for product in response.json()["results"]]
+
+    def test_pages_by_cursor(self):
+        for url in ("/api/shop-home/", "/api/async/shop-home/"):
+            with self.subTest(url=url):
+                first = self.client.get(url, {"page_size": 2})
+                self.assertEqual(self._names(first), ["Paged 0", "Paged 1"])
+                self.assertIsNone(first.json()["previous"])
+
+                second = self.client.get(first.json()["next"])
+                self.assertEqual(self._names(second), ["Paged 2", "Paged 3"])
+
+                back = self.client.get(second.json()["previous"])
+                self.assertEqual(self._names(back), ["Paged 0", "Paged 1"])
+                self.assertIsNone(back.json()["previous"])
+                self.assertEqual(back.json()["next"], first.json()["next"])
+
+                last = self.client.get(second.json()["next"])
+                self.assertEqual(self._names(last), ["Paged 4"])
+                self.assertIsNone(last.json()["next"])
+
+    def test_nothing_before_the_first_row(self):
+        first = self.products[0]
+        cursor = encode_cursor([first.name, first.pk], reverse=True)
+        for url in ("/api/shop-home/", "/api/async/shop-home/"):
+            with self.subTest(url=url):
+                response = self.client.get(url, {"cursor": cursor})
+                self.assertEqual(self._names(response), [])
+                self.assertEqual((response.json()["next"], response.json()["previous"]), (None, None))
+
+    def test_invalid_page_sizes_fall_back_to_the_default(self):
+        customer = Customer.objects.create(username="pager", wallet=Decimal("10.00"))
+        for product in self.products[:4]:
+            buy_product(customer, product, 1)
+        self.client.force_authenticate(customer)
+
+        for url in ("/api/shop-home/", "/api/async/shop-home/", "/api/purchase/"):
+            for page_size in ("0", "-1", "two", ""):
+                with self.subTest(url=url, page_size=page_size):
+                    response = self.client.get(url, {"page_size": page_size})
+                    self.assertEqual(response.status_code, 200)
+                    self.assertEqual(len(response.json()["results"]), 3)
+                    self.assertIsNotNone(response.json()["next"])
+
+        self.assertEqual(self.client.get("/api/shop-home/", {"cursor": "broken"}).status_code, 404)
+
+
+class BasketCheckoutTest(TestCase):
+    """POST /api/purchase/bulk/ buys the whole basket or nothing, and reports every line"""
+
+    def setUp(self):
+        category = Category.objects.create(name="Basket", slug="basket")
+        self.lamp = Product.objects.create(name="Lamp", slug="lamp", price=Decimal("10.00"), amount=5,
+                                           category=category)
+        self.fan = Product.objects.create(name="Fan", slug="fan", price=Decimal("4.00"), amount=1,
+                                          category=category)
+        self.hidden = Product.objects.create(name="Hidden", slug="hidden", price=Decimal("1.00"), amount=5,
+                                             category=category, is_available=False)
+        self.customer = Customer.objects.create(username="basket-buyer", wallet=Decimal("30.00"))
+        self.client = APIClient()
+        self.client.force_authenticate(self.customer)
+
+    def _buy(self, *lines):
+        return self.client.post("/api/purchase/bulk/", {"lines": [{"product": product.pk if hasattr(product, "pk")
+                                                                   else product, "amount": amount}
+                                                                  for product, amount in lines]}, format="json")
+
+    def _statuses(self, response):
+        return [(line["product"], line["status"]) for line in response.json()["lines"]]
+
+    def assertNothingBought(self):
+        self.assertFalse(Purchase.objects.exists())
+        self.assertEqual(balance_of(self.customer), Decimal("30.00"))
+        self.assertEqual(dict(Product.objects.values_list("slug", "amount")), {"lamp": 5, "fan": 1, "hidden": 5})
+
+    def test_basket_is_bought(self):
+        response = self._buy((self.lamp, 2), (self.fan, 1))
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(self._statuses(response), [(self.lamp.pk, "bought"), (self.fan.pk, "bought")])
+        self.assertEqual([line["price_at_time_purchase"] for line in response.json()["lines"]], ["10.00", "4.00"])
+        self.assertEqual(balance_of(self.customer), Decimal("6.00"))
+        self.assertEqual(dict(Product.objects.values_list("slug", "amount")), {"lamp": 3, "fan": 0, "hidden": 5})
+
+    def test_out_of_stock_line_fails_the_basket(self):
+        response = self._buy((self.lamp, 1), (self.fan, 2))
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self._statuses(response), [(self.lamp.pk, "rejected"), (self.fan.pk, "failed")])
+        self.assertEqual(response.json()["lines"][1]["detail"], "This quantity is out of stock")
+        self.assertNothingBought()
+
+    def test_insufficient_funds_reject_every_line(self):
+        response = self._buy((self.lamp, 3), (self.fan, 1))
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()["lack"], "4.00")
+        self.assertEqual(self._statuses(response), [(self.lamp.pk, "rejected"), (self.fan.pk, "rejected")])
+        self.assertNothingBought()
+
+    def test_hidden_and_unknown_products_are_not_sold(self):
+        response = self._buy((self.lamp, 1), (self.hidden, 1), (10 ** 6, 1))
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self._statuses(response), [(self.lamp.pk, "rejected"), (self.hidden.pk, "failed"),
+                                                    (10 ** 6, "failed")])
+        self.assertNothingBought()
+
+
+class ProductSearchTest(TestCase):
+    """Search with filters on the storefront, the API and its async twin, best matches first"""
+
+    def setUp(self):
+        self.lights = Category.objects.create(name="Lights", slug="lights")
+        self.fans = Category.objects.create(name="Fans", slug="fans")
+        for name, description, price, category, available in (
+                ("Desk lamp", "A bright lamp", "10.00", self.lights, True),
+                ("Floor lamp", "The lamp of lamps, a tall lamp", "30.00", self.lights, True),
+                ("Lamp fan", "A fan with a lamp", "20.00", self.fans, True),
+                ("Quiet fan", "Silent", "15.00", self.fans, True),
+                ("Hidden lamp", "A lamp", "5.00", self.lights, False)):
+            Product.objects.create(name=name, slug=slugify(name), description=description, price=Decimal(price),
+                                   amount=1, category=category, is_available=available)
+        self.client = APIClient()
+
+    def _names(self, response):
+        self.assertEqual(response.status_code, 200)
+        return [product["name"] for product in response.json()["results"]]
+
+    def _all_pages(self, url, **params):
+        names, response = [], self.client.get(url, {**params, "page_size": 1})
+        while True:
+            names += self._names(response)
+            if not response.json()["next"]:
+                return names
+            response = self.client.get(response.json()["next"])
+
+    def test_matches_come_best_first_page_by_page(self):
+        best_first = list(search_products(Product.objects.filter(is_available=True), query="lamp")
+                          .order_by(*SEARCH_ORDERING).values_list("name", flat=True))
+        self.assertEqual(sorted(best_first), ["Desk lamp", "Floor lamp", "Lamp fan"])
+
+        # the cursor carries the float rank of the last match
+        for url in ("/api/shop-home/", "/api/async/shop-home/"):
+            with self.subTest(url=url):
+                self.assertEqual(self._all_pages(url, q="lamp"), best_first)
+
+        response = self.client.get("/search/", {"q": "lamp"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([product.name for product in response.context["products"]], best_first)
+
+    def test_filters(self):
+        for url in ("/api/shop-home/", "/api/async/shop-home/"):
+            with self.subTest(url=url):
+                self.assertEqual(self._names(self.client.get(url, {"q": "lamp", "category": self.fans.pk})),
+                                 ["Lamp fan"])
+                self.assertEqual(self._names(self.client.get(url, {"price_min": "15", "price_max": "20"})),
+                                 ["Lamp fan", "Quiet fan"])
+                self.assertEqual(self._names(self.client.get(url, {"category": self.lights.pk})),
+                                 ["Desk lamp", "Floor lamp"])
+
+        response = self.client.get("/search/", {"category": self.fans.pk, "price_max": "18"})
+        self.assertEqual([product.name for product in response.context["products"]], ["Quiet fan"])
+
+    def test_invalid_filters_are_refused(self):
+        for url in ("/api/shop-home/", "/api/async/shop-home/", "/search/"):
+            for params in ({"price_min": "cheap"}, {"price_max": "-1"}, {"price_min": "NaN"},
+                           {"category": "lights"}):
+                with self.subTest(url=url, params=params):
+                    self.assertEqual(self.client.get(url, params).status_code, 400)
+
+
+class RefreshTokenTest(TestCase):
+    """Logging out everywhere blacklists the refresh tokens in bulk, the purge drops the expired ones"""
+
+    def setUp(self):
+        self.customer = Customer.objects.create(username="jwt-holder")
+        self.other = Customer.objects.create(username="jwt-other")
+
+    def _refresh_tokens(self, user, number):
+        return [RefreshToken.for_user(user) for _ in range(number)]
+
+    def _expired(self, user, number):
+        past = timezone.now() - timedelta(days=2)
+        return [OutstandingToken.objects.create(user=user, jti=f"expired-{user.pk}-{i}", token="expired",
+                                                created_at=past, expires_at=past + timedelta(days=1))
+                for i in range(number)]
+
+    def test_logout_all_blacklists_every_live_token(self):
+        self._refresh_tokens(self.customer, 3)
+        RefreshToken.for_user(self.customer).blacklist()
+        self._expired(self.customer, 1)
+        other, = self._refresh_tokens(self.other, 1)
+
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f"Bearer {RefreshToken.for_user(self.customer).access_token}")
+        self.assertEqual(client.post("/api/logout-all/").status_code, 205)
+
+        live = OutstandingToken.objects.filter(user=self.customer, expires_at__gt=timezone.now())
+        self.assertEqual(BlacklistedToken.objects.filter(token__in=live).count(), 5)
+        self.assertFalse(BlacklistedToken.objects.filter(token__jti=other["jti"]).exists())
+        self.assertFalse(BlacklistedToken.objects.filter(token__user=self.customer,
+                                                         token__expires_at__lte=timezone.now()).exists())
+
+        # a rerun finds nothing left to blacklist
+        self.assertEqual(blacklist_user_tokens(self.customer.pk), 0)
+        self.assertEqual(BlacklistedToken.objects.count(), 5)
+
+    def test_blacklisting_runs_a_fixed_number_of_queries(self):
+        def blacklist(user, number):
+            self._refresh_tokens(user, number)
+            with CaptureQueriesContext(connection) as queries:
+                self.assertEqual(blacklist_user_tokens(user.pk), number)
+            return len(queries)
+
+        self.assertEqual(blacklist(self.customer, 3), blacklist(self.other, 30))
+
+    def test_purge_deletes_only_expired_tokens_in_batches(self):
+        live = self._refresh_tokens(self.customer, 2)
+        expired = self._expired(self.customer, 3) + self._expired(self.other, 2)
+        BlacklistedToken.objects.create(token=expired[0])
+
+        self.assertEqual(list(purge_expired_tokens(batch_size=2)), [2, 4, 5])
+        self.assertEqual(set(OutstandingToken.objects.values_list("jti", flat=True)),
+                         {token["jti"] for token in live})
+        self.assertFalse(BlacklistedToken.objects.exists())
+
+        self._expired(self.other, 3)
+        out = io.StringIO()
+        call_command("purge_tokens", batch_size=2, stdout=out)
+        self.assertIn("3 expired tokens purged", out.getvalue())
+        self.assertEqual(OutstandingToken.objects.count(), 2)
+
+
+class PurchaseExportTest(TestCase):
+    """The purchase history is exported filtered, as CSV or JSON Lines, streamed from an iterator"""
+
+    def setUp(self):
+        self.lamps = Category.objects.create(name="Lamps", slug="lamps")
+        self.fans = Category.objects.create(name="Fans", slug="fans")
+        lamp = Product.objects.create(name="Lamp", slug="lamp", price=Decimal("10.00"), amount=10,
+                                      category=self.lamps)
+        fan = Product.objects.create(name="Fan", slug="fan", price=Decimal("4.00"), amount=10, category=self.fans)
+        self.first = Customer.objects.create(username="first-buyer")
+        self.second = Customer.objects.create(username="second-buyer")
+        self.purchases = {}
+        for name, customer, product, moment in (
+                ("new year", self.first, lamp, "2024-01-01T10:00"),
+                ("late", self.second, fan, "2024-01-02T23:30"),
+                ("after midnight", self.first, fan, "2024-01-03T00:30")):
+            purchase = Purchase.objects.create(customer=customer, product=product, amount=1,
+                                               price_at_time_purchase=product.price)
+            Purchase.objects.filter(pk=purchase.pk).update(time_purchase=parse_moment(moment))
+            self.purchases[name] = purchase.pk
+        self.client.force_login(Customer.objects.create(username="admin", is_staff=True, is_superuser=True))
+
+    def _ids(self, **filters):
+        return [row[0] for row in purchase_rows(**filters)]
+
+    def _export(self, **params):
+        response = self.client.get("/admin-export-purchases/", params)
+        self.assertEqual(response.status_code, 200)
+        return b"".join(response.streaming_content).decode()
+
+    def test_filters(self):
+        purchases = self.purchases
+        # the days are local and a date range includes both of its days
+        self.assertEqual(self._ids(date_from="2024-01-01", date_to="2024-01-02"),
+                         [purchases["new year"], purchases["late"]])
+        self.assertEqual(self._ids(date_from="2024-01-03"), [purchases["after midnight"]])
+        self.assertEqual(self._ids(date_from="2024-01-02T23:00", date_to="2024-01-03T00:00"), [purchases["late"]])
+        self.assertEqual(self._ids(customer=self.first.pk), [purchases["new year"], purchases["after midnight"]])
+        self.assertEqual(self._ids(category=self.fans.pk), [purchases["late"], purchases["after midnight"]])
+        self.assertEqual(self._ids(customer=self.first.pk, category=self.fans.pk, date_to="2024-01-03"),
+                         [purchases["after midnight"]])
+
+    def test_csv(self):
+        response = self.client.get("/admin-export-purchases/", {"category": self.lamps.pk})
+        self.assertEqual(response["Content-Type"], "text/csv")
+        self.assertEqual(response["Content-Disposition"], 'attachment; filename="purchases.csv"')
+
+        header, row, end = b"".join(response.streaming_content).decode().split("\r\n")
+        self.assertEqual(header.split(","), [name for name, _ in COLUMNS])
+        self.assertEqual(row.split(",")[2:], [str(self.first.pk), "first-buyer", str(Product.objects.get(
+            name="Lamp").pk), "Lamp", str(self.lamps.pk), "Lamps", "1", "10.00"])
+        self.assertEqual(end, "")
+
+    def test_jsonl(self):
+        response = self.client.get("/admin-export-purchases/", {"format": "jsonl", "customer": self.second.pk})
+        self.assertEqual(response["Content-Type"], "application/jsonl")
+
+        record, = [json.loads(line) for line in b"".join(response.streaming_content).decode().splitlines()]
+        self.assertEqual(record["id"], self.purchases["late"])
+        self.assertEqual((record["customer"], record["product"], record["category"], record["price"]),
+                         ("second-buyer", "Fan", "Fans", "4.00"))
+        self.assertEqual(datetime.fromisoformat(record["time_purchase"]), parse_moment("2024-01-02T23:30"))
+
+    def test_invalid_filters_are_refused(self):
+        for params in ({"from": "yesterday"}, {"to": "2024-02-30"}, {"from": "2024-01-01T25:00"},
+                       {"customer": "first-buyer"}, {"category": "lamps"}, {"format": "xml"}):
+            with self.subTest(params=params):
+                self.assertEqual(self.client.get("/admin-export-purchases/", params).status_code, 400)
+
+        with self.assertRaises(CommandError):
+            call_command("export_purchases", date_from="yesterday", stdout=io.StringIO())
+
+    def test_only_superusers_export(self):
+        self.client.force_login(self.first)
+        self.assertEqual(self.client.get("/admin-export-purchases/").status_code, 403)
+
+    def test_rows_are_streamed_without_loading_the_queryset(self):
+        def unloadable_rows(**filters):
+            # the rows are only read through iterator(), never cached as a whole
+            rows = purchase_rows(**filters)
+            rows._fetch_all = Mock(side_effect=AssertionError("the queryset was loaded"))
+            return rows
+
+        with patch("e_shop.views.purchase_rows", unloadable_rows):
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get("/admin-export-purchases/", {"format": "jsonl"})
+        self.assertIsInstance(response, StreamingHttpResponse)
+        self.assertFalse(any("e_shop_purchase" in query["sql"] for query in queries))
+
+        with CaptureQueriesContext(connection) as queries:
+            lines = b"".join(response.streaming_content).decode().splitlines()
+        self.assertEqual([json.loads(line)["id"] for line in lines], sorted(self.purchases.values()))
+        self.assertTrue(any("e_shop_purchase" in query["sql"] for query in queries))
+
+    def test_command(self):
+        out = io.StringIO()
+        call_command("export_purchases", format="jsonl", category=self.fans.pk, date_from="2024-01-03",
+                     chunk_size=1, stdout=out)
+        record, = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual(record["id"], self.purchases["after midnight"])
+
+        with TemporaryDirectory() as directory:
+            path = f"{directory}/purchases.csv"
+            call_command("export_purchases", output=path)
+            with open(path, newline="") as output:
+                self.assertEqual(len(output.read().split("\r\n")), 5)
+
+
+class SalesAnalyticsTest(TestCase):
+    """Sales and refunds are rolled up in local hours and days, the backfill rebuilds the same rows"""
+
+    def setUp(self):
+        self.lamps = Category.objects.create(name="Lamps", slug="lamps")
+        self.fans = Category.objects.create(name="Fans", slug="fans")
+        self.lamp = Product.objects.create(name="Lamp", slug="lamp", price=Decimal("10.00"), amount=10,
+                                           category=self.lamps)
+        self.fan = Product.objects.create(name="Fan", slug="fan", price=Decimal("4.00"), amount=10,
+                                          category=self.fans)
+        self.customer = Customer.objects.create(username="analysed", wallet=Decimal("100.00"))
+        # an hour before and just after midnight in Kyiv, the same day in UTC
+        self.late = self._buy(self.lamp, 2, self._local(2024, 1, 1, 23, 10))
+        self.later = self._buy(self.lamp, 1, self._local(2024, 1, 1, 23, 50))
+        self.after_midnight = self._buy(self.fan, 4, self._local(2024, 1, 2, 0, 20))
+
+    def _local(self, *moment):
+        return timezone.make_aware(datetime(*moment))
+
+    def _buy(self, product, amount, moment):
+        with patch("django.utils.timezone.now", return_value=moment):
+            return buy_product(self.customer, Product.objects.get(pk=product.pk), amount)
+
+    def _refund(self, *purchases):
+        refunds = [PurchaseReturns.objects.create(to_purchase=purchase).pk for purchase in purchases]
+        self.assertEqual(sorted(refund_purchases(refunds)), refunds)
+
+    def _rows(self):
+        return sorted(SalesRollup.objects.values_list("period", "bucket", "product_id", "category_id",
+                                                      *COUNTERS))
+
+    def test_sales_are_counted_in_local_buckets(self):
+        self.assertEqual(self._rows(), sorted([
+            ("hour", self._local(2024, 1, 1, 23), self.lamp.pk, self.lamps.pk, 2, 3, Decimal("30.00"), 0, 0, 0),
+            ("day", self._local(2024, 1, 1), self.lamp.pk, self.lamps.pk, 2, 3, Decimal("30.00"), 0, 0, 0),
+            ("hour", self._local(2024, 1, 2), self.fan.pk, self.fans.pk, 1, 4, Decimal("16.00"), 0, 0, 0),
+            ("day", self._local(2024, 1, 2), self.fan.pk, self.fans.pk, 1, 4, Decimal("16.00"), 0, 0, 0),
+        ]))
+        self.assertEqual(bucket_of(self._local(2024, 1, 2, 0, 20), SalesRollup.DAY).date().isoformat(),
+                         "2024-01-02")
+
+    def test_refunds_are_counted_in_the_buckets_of_the_sales(self):
+        self._refund(self.late)
+        lamp_rows = SalesRollup.objects.filter(product=self.lamp)
+        self.assertEqual(lamp_rows.count(), 2)
+        self.assertEqual(set(lamp_rows.values_list("orders", "units_sold", "revenue",
+                                                   "refunds", "units_refunded", "refunded")),
+                         {(2, 3, Decimal("30.00"), 1, 2, Decimal("20.00"))})
+
+        # record_refunds adds up, a second batch lands in the same rows
+        self._refund(self.later)
+        self.assertEqual(set(lamp_rows.values_list("refunds", "units_refunded", "refunded")),
+                         {(2, 3, Decimal("30.00"))})
+
+    def test_backfill_rebuilds_the_incremental_rows(self):
+        # the fan sale is refunded as a whole, its buckets have no purchase left
+        self._refund(self.late, self.after_midnight)
+        incremental = self._rows()
+
+        SalesRollup.objects.update(orders=99, units_sold=99, revenue=0)
+        SalesRollup.objects.filter(refunds=0).delete()
+        self.assertEqual(_rebuild(self._local(2024, 1, 1), self._local(2024, 1, 3)), 4)
+        self.assertEqual(self._rows(), incremental)
+
+        SalesRollup.objects.update(orders=0)
+        out = io.StringIO()
+        call_command("backfill_rollups", **{"from": "2024-01-01", "to": "2024-01-02"}, stdout=out)
+        self.assertIn("4 rollups written", out.getvalue())
+        self.assertEqual(self._rows(), incremental)
+
+        SalesRollup.objects.update(revenue=0)
+        call_command("backfill_rollups", stdout=io.StringIO())
+        self.assertEqual(self._rows(), incremental)
+
+        with self.assertRaises(CommandError):
+            call_command("backfill_rollups", **{"from": "new year"}, stdout=io.StringIO())
+
+    def test_sales_report(self):
+        self._refund(self.late)
+        report = sales_report(date_from=self._local(2024, 1, 1), date_to=self._local(2024, 1, 3))
+        self.assertEqual(report["totals"], {"orders": 3, "units_sold": 7, "revenue": Decimal("46.00"), "refunds": 1,
+                                            "units_refunded": 2, "refunded": Decimal("20.00"),
+                                            "refund_rate": round(2 / 7, 4)})
+        self.assertEqual([(row["bucket"], row["revenue"]) for row in report["buckets"]],
+                         [(self._local(2024, 1, 1), Decimal("30.00")), (self._local(2024, 1, 2), Decimal("16.00"))])
+        self.assertEqual([(row["category__name"], row["refund_rate"]) for row in report["categories"]],
+                         [("Lamps", round(2 / 3, 4)), ("Fans", 0)])
+        self.assertEqual([row["product__name"] for row in report["top_products"]], ["Fan", "Lamp"])
+
+        hours = sales_report(period=SalesRollup.HOUR, date_from=self._local(2024, 1, 1, 23, 30),
+                             category=self.lamps.pk)
+        self.assertEqual(hours["totals"]["units_sold"], 3)
+        self.assertEqual(sales_report(date_from=self._local(2024, 1, 2))["totals"]["revenue"], Decimal("16.00"))
+
+    def test_report_endpoint(self):
+        client = APIClient()
+        self.assertIn(client.get("/api/analytics/sales/").status_code, (401, 403))
+        client.force_authenticate(self.customer)
+        self.assertEqual(client.get("/api/analytics/sales/").status_code, 403)
+
+        client.force_authenticate(Customer.objects.create(username="analyst", is_staff=True))
+        # a 'to' date includes its own day
+        response = client.get("/api/analytics/sales/", {"from": "2024-01-01", "to": "2024-01-01"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Decimal(response.json()["totals"]["revenue"]), Decimal("30.00"))
+        self.assertEqual(response.json()["top_products"][0]["product__name"], "Lamp")
+
+        response = client.get("/api/analytics/sales/", {"from": "2024-01-01", "period": "hour",
+                                                         "category": self.fans.pk})
+        self.assertEqual([bucket["units_sold"] for bucket in response.json()["buckets"]], [4])
+
+        for params in ({"period": "week"}, {"from": "new year"}, {"to": "2024-13-01"}, {"category": "fans"},
+                       {"top": "all"}):
+            with self.subTest(params=params):
+                self.assertEqual(client.get("/api/analytics/sales/", params).status_code, 400)
+
+
+class ProductPhotoTest(TestCase):
+    """A job renders the resized copies of a photo, the copies of a replaced photo are deleted"""
+
+    def setUp(self):
+        media = TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        settings = self.settings(MEDIA_ROOT=media.name)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+        self.category = Category.objects.create(name="Lamps", slug="lamps")
+        self.product = Product.objects.create(name="Lamp", slug="lamp", price=Decimal("10.00"), amount=1,
+                                              category=self.category, photo=self._upload("lamp.jpg"))
+
+    def _upload(self, name, size=(800, 400)):
+        buffer = io.BytesIO()
+        Image.new("RGB", size, "orange").save(buffer, "JPEG")
+        return SimpleUploadedFile(name, buffer.getvalue(), content_type="image/jpeg")
+
+    def _generate(self):
+        TASKS["photo_variants"](product_id=self.product.pk)
+        self.product.refresh_from_db()
+        return list(self.product.photo_variants.values())
+
+    def _replace(self, photo):
+        serializer = ProductWriteSerializer(Product.objects.get(pk=self.product.pk), data={"photo": photo},
+                                            partial=True)
+        serializer.is_valid(raise_exception=True)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.product = serializer.save()
+
+    def test_variants_are_generated(self):
+        names = self._generate()
+        self.assertEqual(set(self.product.photo_variants),
+                         {f"{variant}.{extension}" for variant in VARIANTS for extension in ("webp", "jpg")})
+        for key, name in self.product.photo_variants.items():
+            variant = key.split(".")[0]
+            with default_storage.open(name) as stored, Image.open(stored) as image:
+                # copies are shrunk to their longest side, never enlarged
+                self.assertEqual(max(image.size), min(VARIANTS[variant], 800))
+        self.assertEqual(set(self.product.photo_urls), set(VARIANTS))
+
+        # a rerun replaces the copies in place
+        self.assertEqual(sorted(self._generate()), sorted(names))
+
+    def test_replacing_the_photo_deletes_the_old_variants(self):
+        old = self._generate()
+        self._replace(self._upload("brighter-lamp.jpg"))
+        self.assertEqual(self.product.photo_variants, {})
+        self.assertFalse(any(default_storage.exists(name) for name in old))
+        self.assertTrue(Job.objects.filter(name="photo_variants", kwargs={"product_id": self.product.pk}).exists())
+
+        new = self._generate()
+        self.assertTrue(new and all(default_storage.exists(name) for name in new))
+        self.assertFalse(set(new) & set(old))
+
+    def test_clearing_or_deleting_the_photo_deletes_the_variants(self):
+        names = self._generate()
+        product = Product.objects.get(pk=self.product.pk)
+        product.photo = None
+        with self.captureOnCommitCallbacks(execute=True):
+            product.save()
+        self.assertFalse(any(default_storage.exists(name) for name in names))
+
+        product.photo = self._upload("lamp.jpg")
+        product.save()
+        names = self._generate()
+        with self.captureOnCommitCallbacks(execute=True):
+            Product.objects.get(pk=self.product.pk).delete()
+        self.assertFalse(any(default_storage.exists(name) for name in names))
+
+    def test_other_changes_keep_the_variants(self):
+        names = self._generate()
+        product = Product.objects.get(pk=self.product.pk)
+        product.price = Decimal("12.00")
+        with self.captureOnCommitCallbacks(execute=True):
+            product.save()
+        self.assertTrue(all(default_storage.exists(name) for name in names))
+
+    def test_copies_of_a_photo_replaced_while_rendering_are_deleted(self):
+        rendered = []
+
+        def render_and_replace(photo_file):
+            Product.objects.filter(pk=self.product.pk).update(photo="photos/replaced.jpg")
+            for variant, extension, content in render_variants(photo_file):
+                rendered.append(variant_name(self.product.photo.name, variant, extension))
+                yield variant, extension, content
+
+        with patch("e_shop.images.render_variants", render_and_replace):
+            self.assertEqual(self._generate(), [])
+        self.assertTrue(rendered)
+        self.assertFalse(any(default_storage.exists(name) for name in rendered))
+
+
+class SidebarCacheTest(TestCase):
+    """The category sidebar is read once, the catalog changes that move its counts invalidate it"""
+
+    def setUp(self):
+        invalidate_sidebar()
+        self.addCleanup(invalidate_sidebar)
+        self.lamps = Category.objects.create(name="Lamps", slug="lamps")
+        self.fans = Category.objects.create(name="Fans", slug="fans")
+        self.lamp = Product.objects.create(name="Lamp", slug="lamp", price=Decimal("10.00"), amount=1,
+                                           category=self.lamps)
+        Product.objects.create(name="Hidden lamp", slug="hidden-lamp", price=Decimal("10.00"), amount=1,
+                               category=self.lamps, is_available=False)
+
+    def _counts(self, is_superuser=False):
+        return {category.slug: category.sidebar_count for category in get_sidebar_categories(is_superuser)}
+
+    def _change(self, change):
+        with self.captureOnCommitCallbacks(execute=True):
+            change()
+
+    def test_sidebar_is_cached_per_audience(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(self._counts(), {"lamps": 1, "fans": 0})
+        with self.assertNumQueries(1):
+            self.assertEqual(self._counts(is_superuser=True), {"lamps": 2, "fans": 0})
+        with self.assertNumQueries(0):
+            self.assertEqual(self._counts(), {"lamps": 1, "fans": 0})
+            self.assertEqual(self._counts(is_superuser=True), {"lamps": 2, "fans": 0})
+
+    def test_catalog_changes_invalidate_the_sidebar(self):
+        def create():
+            Product.objects.create(name="Fan", slug="fan", price=Decimal("4.00"), amount=1, category=self.fans)
+
+        def move():
+            lamp = Product.objects.get(pk=self.lamp.pk)
+            lamp.category = self.fans
+            lamp.save()
+
+        def toggle():
+            hidden = Product.objects.get(slug="hidden-lamp")
+            hidden.is_available = True
+            hidden.save()
+
+        def rename():
+            fans = Category.objects.get(pk=self.fans.pk)
+            fans.name = "Fans and heaters"
+            fans.save()
+
+        for change, counts in ((create, {"lamps": 1, "fans": 1}), (move, {"lamps": 0, "fans": 2}),
+                               (toggle, {"lamps": 1, "fans": 2}), (rename, {"lamps": 1, "fans": 2})):
+            with self.subTest(change=change.__name__):
+                self._counts()
+                self._change(change)
+                with self.assertNumQueries(1):
+                    self.assertEqual(self._counts(), counts)
+
+    def test_other_product_changes_keep_the_sidebar(self):
+        self._counts()
+
+        def reprice():
+            lamp = Product.objects.get(pk=self.lamp.pk)
+            lamp.price = Decimal("12.00")
+            lamp.save()
+
+        self._change(reprice)
+        with self.assertNumQueries(0):
+            self._counts()
+
+    def test_other_processes_see_an_invalidation(self):
+        with patch.dict(SIDEBAR_CACHE, {"CACHE_ALIAS": "default"}):
+            invalidate_sidebar()
+            self._counts()
+            with self.assertNumQueries(0):
+                self._counts()
+
+            # another process bumps the generation, the local copy is not read anymore
+            caches["default"].incr(SIDEBAR_GENERATION_KEY)
+            Category.objects.filter(pk=self.fans.pk).update(available_count=3)
+            with self.assertNumQueries(1):
+                self.assertEqual(self._counts(), {"lamps": 1, "fans": 3})
@@ -3,13 +3,16 @@
 
 from django.urls import path
 
-from .views import ShopHome, ProductCategory, ShowProduct, RegisterCustomer, \
-    Login, Logout, BuyView, WalletCustomer, AdminAddProduct, \
+from .async_views import shop_home
+from .views import ShopHome, ProductCategory, SearchProducts, ShowProduct, RegisterCustomer, \
+    Login, Logout, BuyView, ReserveProduct, ReleaseReservation, WalletCustomer, AdminAddProduct, \
     AdminAddCategory, AdminEditProduct, AdminEditCategory, ShowPurchase, \
-    RefundPurchase, AdminShowRefundPurchase, AdminRemoveRefundPurchase, AdminApproveRefundPurchase
+    RefundPurchase, AdminShowRefundPurchase, AdminRemoveRefundPurchase, AdminApproveRefundPurchase, \
+    AdminExportPurchases, AdminSalesDashboard, MetricsView
 
 urlpatterns = [
     path('', ShopHome.as_view(), name='home'),
+    path('async/', shop_home, name='async-home'),
 
     path('login/', Login.as_view(), name='login'),
     path('logout/', Logout.as_view(), name='logout'),
@@ -19,12 +22,18 @@ urlpatterns = [
     path('edit-product/<slug:prod_slug>', AdminEditProduct.as_view(), name='edit-product'),
     path('edit-category/<slug:cat_slug>', AdminEditCategory.as_view(), name='edit-category'),
     path('category/<slug:cat_slug>/', ProductCategory.as_view(), name='category'),
+    path('search/', SearchProducts.as_view(), name='search'),
     path('product/<slug:prod_slug>/', ShowProduct.as_view(), name='product'),
     path('product/buy/<slug:prod_slug>/', BuyView.as_view(), name='product-buy'),
+    path('product/reserve/<slug:prod_slug>/', ReserveProduct.as_view(), name='product-reserve'),
+    path('product/release/<slug:prod_slug>/', ReleaseReservation.as_view(), name='product-release'),
     path('customer/wallet/<int:cust_id>/', WalletCustomer.as_view(), name='wallet'),
     path('customer/purchase/', ShowPurchase.as_view(), name='purchase'),
     path('refund-purchase/<int:pur_id>/', RefundPurchase.as_view(), name='refund-purchase'),
     path('admin-refund/', AdminShowRefundPurchase.as_view(), name='admin-refund'),
     path('admin-refund-remove/<int:ref_id>/', AdminRemoveRefundPurchase.as_view(), name='admin-refund-remove'),
     path('admin-refund-approve/<int:ref_id>/', AdminApproveRefundPurchase.as_view(), name='admin-refund-approve'),
+    path('admin-export-purchases/', AdminExportPurchases.as_view(), name='admin-export-purchases'),
+    path('admin-sales/', AdminSalesDashboard.as_view(), name='admin-sales'),
+    path('metrics', MetricsView.as_view(), name='metrics'),
 ]
@@ -1,10 +1,16 @@
-from django.db.models import Count
+import hashlib
 
-from .models import Category
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.http import http_date, quote_etag
+
+from .cache import get_sidebar_categories, catalog_version, page_cache_key, \
+    get_cached_page, set_cached_page, last_modified
 
 menu = [{'title': "Add Category ", 'url_name': 'add-category'},
         {'title': "Add Product ", 'url_name': 'add-product'},
         {'title': "Show Refunds ", 'url_name': 'admin-refund'},
+        {'title': "Sales ", 'url_name': 'admin-sales'},
+        {'title': "Export Purchases ", 'url_name': 'admin-export-purchases'},
         ]
 
 
@@ -12,8 +18,8 @@ class DataMixin:
 
     def get_user_context(self, **kwargs):
         context = kwargs
-        categories = Category.objects.annotate(Count('product'))
-        context['categories'] = categories
+        context['categories'] = get_sidebar_categories(self.request.user.is_superuser)
+        context['catalog_version'] = catalog_version()
 
         if self.request.user.is_superuser:
             context['menu'] = menu
@@ -22,3 +28,44 @@ class DataMixin:
             context['cat_selected'] = 0
 
         return context
+
+
+class AnonymousPageCacheMixin:
+    """
+    Anonymous visitors get whole pages from the cache. Pages are keyed by the path
+    with its query (slugs and cursor) and by the catalog version, which is bumped
+    whenever a product or a category changes. ETag and Last-Modified let browsers
+    and CDNs revalidate with a 304. Views whose pages depend on more than the
+    catalog return it from page_cache_variant(), their pages are revalidated by ETag only.
+    """
+
+    def page_cache_variant(self):
+        return ""
+
+    def dispatch(self, request, *args, **kwargs):
+        if request.method not in ("GET", "HEAD") or request.user.is_authenticated:
+            response = super().dispatch(request, *args, **kwargs)
+            patch_vary_headers(response, ("Cookie", ))
+            return response
+
+        version = catalog_version()
+        variant = self.page_cache_variant()
+        key = page_cache_key(request, version, variant)
+        etag = quote_etag(hashlib.md5(key.encode()).hexdigest())
+        # the variant can change without the version, a date can't tell it
+        modified = None if variant else last_modified(version)
+
+        response = get_conditional_response(request, etag=etag, last_modified=modified)
+        if response is None:
+            response = get_cached_page(key)
+        if response is None:
+            response = super().dispatch(request, *args, **kwargs)
+            if response.status_code == 200 and hasattr(response, "render"):
+                response.add_post_render_callback(
+                    lambda rendered: None if rendered.cookies else set_cached_page(key, rendered))
+
+        response.headers["ETag"] = etag
+        if modified is not None:
+            response.headers["Last-Modified"] = http_date(modified)
+        patch_vary_headers(response, ("Cookie", ))
+        return response
@@ -0,0 +1,8 @@
+"""This is the validators of application E_SHOP"""
+
+from django.core.exceptions import ValidationError
+
+
+def validate_price(price):
+    if price <= 0:
+        raise ValidationError("The price can't be negative and is equal to zero")
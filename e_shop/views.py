@@ -1,28 +1,42 @@
 import warnings
+from datetime import timedelta
 
 from django.contrib.auth import login
 from django.contrib.auth.forms import AuthenticationForm
 from django.contrib.auth.mixins import LoginRequiredMixin, UserPassesTestMixin
 from django.contrib.auth.views import LoginView, LogoutView
-from django.db import transaction
-from django.shortcuts import redirect
+from django.http import HttpResponse, HttpResponseForbidden, HttpResponseBadRequest, \
+    StreamingHttpResponse
+from django.shortcuts import redirect, get_object_or_404
 from django.urls import reverse_lazy, reverse
 from django.utils import timezone
 from django.views import View
-from django.views.generic import ListView, DeleteView, CreateView, DetailView, UpdateView
+from django.views.generic import ListView, DeleteView, CreateView, DetailView, UpdateView, \
+    TemplateView, FormView
 from django.views.generic.detail import SingleObjectMixin
 
 from online_shop import settings
-from .forms import RegisterCustomerForm, BuyForm, WalletCustomerForm, AdminProductForm
-from .models import Product, Customer, Category, Purchase, PurchaseReturns
-from .utils import DataMixin
-
-
-class ShopHome(DataMixin, ListView):
+from .analytics import sales_report, report_arguments
+from .exports import purchase_rows, render, FORMATS
+from .forms import RegisterCustomerForm, BuyForm, ReserveForm, WalletCustomerForm, AdminProductForm
+from .middleware import REGISTRY, INSTRUMENTATION
+from .models import Product, Category, Purchase, PurchaseReturns
+from .pagination import KeysetPaginationMixin
+from .search import search_products, search_arguments, SEARCH_ORDERING
+from .reservations import available_to_sell, own_reservation, held_units
+from .services import buy_product, refund_purchase, reserve_stock, release_reservation, \
+    InsufficientFunds, OutOfStock, RefundError, CheckoutError
+from .utils import DataMixin, AnonymousPageCacheMixin
+from .wallet import deposit
+
+
+class ShopHome(AnonymousPageCacheMixin, DataMixin, KeysetPaginationMixin, ListView):
     model = Product
     template_name = "e_shop/index.html"
     context_object_name = "products"
     paginate_by = 4
+    keyset_ordering = ("name", "id")
+    read_replica = True
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
@@ -34,19 +48,35 @@ class ShopHome(DataMixin, ListView):
         return context
 
     def get_queryset(self):
-        return super().get_queryset() \
+        return super().get_queryset().select_related("category") \
             if self.request.user.is_superuser \
-            else Product.objects.filter(is_available=True)
+            else Product.objects.filter(is_available=True).select_related("category")
 
 
-class ShowProduct(DataMixin, DetailView):
+class ShowProduct(AnonymousPageCacheMixin, DataMixin, DetailView):
     model = Product
     slug_url_kwarg = 'prod_slug'
     template_name = 'e_shop/product.html'
     context_object_name = 'product'
+    read_replica = True
+
+    def page_cache_variant(self):
+        # anonymous visitors see the stock minus the holds, which change without a catalog version
+        product_id = Product.objects.filter(slug=self.kwargs[self.slug_url_kwarg]) \
+            .values_list("pk", flat=True).first()
+        if product_id is None:
+            return ""
+        return f"held-{held_units([product_id])[product_id]}"
 
     def get_context_data(self, **kwargs):
-        self.extra_context = {'buy_form': BuyForm(self.object)}
+        # the stock held for other customers can't be ordered
+        reservation = own_reservation(self.request.user, self.object)
+        available = available_to_sell(self.object, reservation)
+        self.extra_context = {'buy_form': BuyForm(self.object, available=available),
+                              'reserve_form': ReserveForm(available=available),
+                              'available': available,
+                              'reservation': reservation,
+                              'msg_reserve': self.request.session.pop('msg_reserve', None)}
 
         # additional context
         context = super().get_context_data(**kwargs)
@@ -72,31 +102,56 @@ class BuyView(LoginRequiredMixin, CreateView):
 
     def form_valid(self, form):
         purchase = form.save(commit=False)
-        purchase.customer = self.request.user
+        customer = self.request.user
 
-        # money sufficiency check
-        wallet_customer = purchase.customer.wallet
-        purchase_total = purchase.price_at_time_purchase * purchase.amount
-        if purchase_total > wallet_customer:
-            self.request.session["msg_lack_money"] = f"{purchase_total - wallet_customer}"
-            return redirect(reverse("wallet", kwargs={"cust_id": purchase.customer.pk}))
+        try:
+            self.object = buy_product(customer, purchase.product, purchase.amount)
+        except InsufficientFunds as exc:
+            self.request.session["msg_lack_money"] = f"{exc.lack}"
+            return redirect(reverse("wallet", kwargs={"cust_id": customer.pk}))
+        except OutOfStock:
+            return redirect(purchase.product.get_absolute_url())
 
-        purchase.customer.wallet -= purchase_total
-        purchase.product.amount -= purchase.amount
+        return redirect(self.get_success_url())
 
-        with transaction.atomic():
-            purchase.customer.save()
-            purchase.product.save()
-            purchase.save()
 
-        return super().form_valid(form=form)
+class ReserveProduct(LoginRequiredMixin, View):
+    """Hold units of a product for the customer for a while, e.g. during a flash sale"""
+    http_method_names = ["post"]
+    login_url = reverse_lazy("login")
+
+    def post(self, request, *args, **kwargs):
+        product = get_object_or_404(Product, slug=kwargs["prod_slug"])
+        form = ReserveForm(request.POST)
+        if not form.is_valid():
+            request.session["msg_reserve"] = " ".join(form.errors.get("amount", []))
+            return redirect(product.get_absolute_url())
 
+        try:
+            reserve_stock(request.user, product, form.cleaned_data["amount"])
+        except CheckoutError as exc:
+            request.session["msg_reserve"] = str(exc)
+        return redirect(product.get_absolute_url())
 
-class ShowPurchase(LoginRequiredMixin, DataMixin, ListView):
+
+class ReleaseReservation(LoginRequiredMixin, View):
+    http_method_names = ["post"]
+    login_url = reverse_lazy("login")
+
+    def post(self, request, *args, **kwargs):
+        product = get_object_or_404(Product, slug=kwargs["prod_slug"])
+        release_reservation(request.user, product)
+        return redirect(product.get_absolute_url())
+
+
+class ShowPurchase(LoginRequiredMixin, DataMixin, KeysetPaginationMixin, ListView):
     model = Purchase
     template_name = "e_shop/purchase.html"
     context_object_name = "purchases"
     login_url = reverse_lazy("login")
+    paginate_by = 10
+    keyset_ordering = ("-time_purchase", "-id")
+    read_replica = True
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
@@ -145,7 +200,7 @@ class RefundPurchase(LoginRequiredMixin, DataMixin, SingleObjectMixin, View):
     def check_period_refund(self):
         current_time = timezone.now()
         time_purchase = self.purchase.time_purchase
-        refund_end_time = time_purchase.replace(minute=time_purchase.minute + self.refund_period)
+        refund_end_time = time_purchase + timedelta(minutes=self.refund_period)
         check = current_time < refund_end_time
         return check
 
@@ -153,9 +208,7 @@ class RefundPurchase(LoginRequiredMixin, DataMixin, SingleObjectMixin, View):
         self.request.session["msg_request_refund"] = [self.purchase.pk, message]
 
 
-class WalletCustomer(LoginRequiredMixin, UpdateView):
-    model = Customer
-    pk_url_kwarg = "cust_id"
+class WalletCustomer(LoginRequiredMixin, FormView):
     form_class = WalletCustomerForm
     template_name = "e_shop/wallet.html"
     login_url = reverse_lazy("login")
@@ -172,22 +225,18 @@ class WalletCustomer(LoginRequiredMixin, UpdateView):
         return super().get_context_data(**context)
 
     def form_valid(self, form):
-        wallet_form = form.save(commit=False)
-
-        # add money to existing
-        current_wallet = self.request.user.wallet
-        wallet_form.wallet += current_wallet
-
-        with transaction.atomic():
-            wallet_form.save()
-
+        # the money is appended to the ledger of the logged in customer
+        deposit(self.request.user, form.cleaned_data["wallet"])
         return super().form_valid(form=form)
 
 
-class ProductCategory(DataMixin, ListView):
+class ProductCategory(AnonymousPageCacheMixin, DataMixin, KeysetPaginationMixin, ListView):
     model = Product
     template_name = 'e_shop/index.html'
     context_object_name = 'products'
+    paginate_by = 4
+    keyset_ordering = ("name", "id")
+    read_replica = True
 
     def get_queryset(self):
         if self.request.user.is_superuser:
@@ -195,7 +244,7 @@ class ProductCategory(DataMixin, ListView):
         else:
             queryset = Product.objects.filter(category__slug=self.kwargs["cat_slug"],
                                               is_available=True)
-        return queryset
+        return queryset.select_related("category")
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
@@ -209,6 +258,45 @@ class ProductCategory(DataMixin, ListView):
         return context
 
 
+class SearchProducts(DataMixin, KeysetPaginationMixin, ListView):
+    """Full-text search with category and price filters, best matches first"""
+    model = Product
+    template_name = 'e_shop/index.html'
+    context_object_name = 'products'
+    paginate_by = 4
+
+    def get(self, request, *args, **kwargs):
+        try:
+            self.search = search_arguments(request.GET)
+        except ValueError as exc:
+            return HttpResponseBadRequest(str(exc))
+        return super().get(request, *args, **kwargs)
+
+    @property
+    def keyset_ordering(self):
+        return SEARCH_ORDERING if self.search["query"] else ("name", "id")
+
+    def get_queryset(self):
+        if self.request.user.is_superuser:
+            queryset = Product.objects.all()
+        else:
+            queryset = Product.objects.filter(is_available=True)
+        return search_products(queryset.select_related("category"), **self.search)
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+
+        # additional context
+        params = self.request.GET.copy()
+        params.pop(self.cursor_kwarg, None)
+        context_add = self.get_user_context(title=f"Search-{self.search['query'] or ''}",
+                                            search=self.search,
+                                            pagination_query=f"{params.urlencode()}&" if params else "",
+                                            empty_message="Nothing was found")
+        context.update(context_add)
+        return context
+
+
 class RegisterCustomer(DataMixin, CreateView):
     form_class = RegisterCustomerForm
     template_name = 'e_shop/register.html'
@@ -334,6 +422,10 @@ class AdminShowRefundPurchase(LoginRequiredMixin, UserPassesTestMixin, DataMixin
     template_name = "e_shop/admin-refund.html"
     context_object_name = "refunds"
 
+    def get_queryset(self):
+        # the purchase, its customer and its product are shown for every request
+        return PurchaseReturns.objects.select_related("to_purchase__customer", "to_purchase__product")
+
     def test_func(self):
         return self.request.user.is_superuser
 
@@ -371,32 +463,73 @@ class AdminApproveRefundPurchase(LoginRequiredMixin, UserPassesTestMixin, Single
             warnings.warn\
                 ("For correct operation, the object must have the attributes of the PurchaseReturns class")
 
-        # data of the deleted purchase
-        purchase = return_purchase.to_purchase
-        product = purchase.product
-        amount_product = purchase.amount
-        price_product = purchase.price_at_time_purchase
-        sum_purchase = amount_product * price_product
-        customer = purchase.customer
+        try:
+            refund_purchase(return_purchase)
+        except RefundError:
+            # approved twice, e.g. from two tabs
+            pass
 
-        # the current state of the buyer's account
-        wallet = customer.wallet
+        return redirect("admin-refund")
+
+
+class AdminExportPurchases(LoginRequiredMixin, UserPassesTestMixin, View):
+    """
+    Purchase history as CSV or JSON Lines, streamed row by row.
+    Filters: from, to (dates or datetimes), customer and category (ids).
+    """
+    login_url = reverse_lazy("login")
+    content_types = {"csv": "text/csv", "jsonl": "application/jsonl"}
 
-        # the current quantity of the product in stock
-        product_amount = product.amount
+    def test_func(self):
+        return self.request.user.is_superuser
 
-        # return data
-        wallet += sum_purchase
-        customer.wallet = wallet
+    def get(self, request, *args, **kwargs):
+        export_format = request.GET.get("format", "csv")
+        if export_format not in FORMATS:
+            return HttpResponseBadRequest(f"Unknown format, use one of: {', '.join(FORMATS)}")
 
-        product_amount += amount_product
-        product.amount = product_amount
+        try:
+            rows = purchase_rows(date_from=request.GET.get("from"), date_to=request.GET.get("to"),
+                                 customer=request.GET.get("customer"),
+                                 category=request.GET.get("category"))
+        except ValueError as exc:
+            return HttpResponseBadRequest(str(exc))
 
-        # refund transaction
-        with transaction.atomic():
-            customer.save()
-            product.save()
-            return_purchase.delete()
-            purchase.delete()
+        response = StreamingHttpResponse(render(rows, export_format),
+                                         content_type=self.content_types[export_format])
+        response["Content-Disposition"] = f'attachment; filename="purchases.{export_format}"'
+        return response
 
-        return redirect("admin-refund")
+
+class AdminSalesDashboard(LoginRequiredMixin, UserPassesTestMixin, DataMixin, TemplateView):
+    template_name = "e_shop/admin-sales.html"
+    login_url = reverse_lazy("login")
+
+    def test_func(self):
+        return self.request.user.is_superuser
+
+    def get(self, request, *args, **kwargs):
+        try:
+            self.arguments = report_arguments(request.GET)
+        except ValueError as exc:
+            return HttpResponseBadRequest(str(exc))
+        return super().get(request, *args, **kwargs)
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context["report"] = sales_report(**self.arguments)
+
+        # additional context from the mixin
+        context_add = self.get_user_context(title="Sales")
+        context.update(context_add)
+        return context
+
+
+class MetricsView(View):
+    """Request metrics of this process in the Prometheus text format"""
+
+    def get(self, request, *args, **kwargs):
+        allowed_ips = INSTRUMENTATION.get("METRICS_ALLOWED_IPS", ())
+        if request.META.get("REMOTE_ADDR") not in allowed_ips and not request.user.is_superuser:
+            return HttpResponseForbidden()
+        return HttpResponse(REGISTRY.export(), content_type="text/plain; version=0.0.4")
@@ -0,0 +1,181 @@
+"""This is the wallet ledger of application E_SHOP"""
+
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import F, Sum, Max, Count, Value, OuterRef, Subquery, DecimalField, Q
+from django.db.models.functions import Coalesce, Now
+
+from online_shop import settings
+from .models import Customer, WalletTransaction, WalletSnapshot
+
+WALLET = getattr(settings, "WALLET", {})
+MATERIALIZE_MIN_TAIL = WALLET.get("MATERIALIZE_MIN_TAIL", 20)
+MATERIALIZE_BATCH_SIZE = WALLET.get("MATERIALIZE_BATCH_SIZE", 500)
+
+ZERO = Decimal("0.00")
+MONEY = DecimalField(max_digits=14, decimal_places=2)
+
+
+class WalletError(Exception):
+    pass
+
+
+def _snapshot_last():
+    # id of the last transaction folded into the snapshot of the customer of the row
+    return Coalesce(Subquery(WalletSnapshot.objects.filter(customer_id=OuterRef("customer_id"))
+                             .values("last_transaction_id")), Value(0))
+
+
+def with_balance(queryset):
+    """
+    Annotate customers with `balance`: the materialized snapshot plus the
+    transactions after it, read with the (customer, id) index in one query.
+    """
+    last = Coalesce(F("wallet_snapshot__last_transaction_id"), Value(0))
+    tail = WalletTransaction.objects.filter(customer=OuterRef("pk"), pk__gt=OuterRef("wallet_last")) \
+        .values("customer").annotate(total=Sum("amount")).values("total").order_by()
+    return queryset.annotate(wallet_last=last).annotate(
+        balance=Coalesce(F("wallet_snapshot__balance"), Value(ZERO), output_field=MONEY)
+        + Coalesce(Subquery(tail, output_field=MONEY), Value(ZERO), output_field=MONEY))
+
+
+def balance_of(customer):
+    """The current balance of a customer, a customer without transactions has 0"""
+    customer_id = getattr(customer, "pk", customer)
+    balance = with_balance(Customer.objects.filter(pk=customer_id)).values_list("balance", flat=True).first()
+    return balance if balance is not None else ZERO
+
+
+def lock_wallet(customer):
+    """
+    Lock the snapshot row of a customer and return the balance, call it inside
+    a transaction before appending. The row is created for customers without one.
+    Appends to a wallet are serialized on this narrow row, not on the customer.
+    """
+    customer_id = getattr(customer, "pk", customer)
+    return lock_wallets([customer_id])[customer_id]
+
+
+def lock_wallets(customer_ids):
+    """lock_wallet for many customers in a few queries, the rows are locked in the order of the ids"""
+    customer_ids = sorted(set(customer_ids))
+    snapshots = WalletSnapshot.objects.select_for_update().filter(customer_id__in=customer_ids) \
+        .order_by("customer_id")
+    locked = {pk: (balance, last) for pk, balance, last
+              in snapshots.values_list("customer_id", "balance", "last_transaction_id")}
+    if len(locked) < len(customer_ids):
+        WalletSnapshot.objects.bulk_create([WalletSnapshot(customer_id=customer_id) for customer_id in customer_ids
+                                            if customer_id not in locked], ignore_conflicts=True)
+        locked = {pk: (balance, last) for pk, balance, last
+                  in snapshots.values_list("customer_id", "balance", "last_transaction_id")}
+
+    balances = {customer_id: balance for customer_id, (balance, _) in locked.items()}
+    tail = Q()
+    for customer_id, (_, last) in locked.items():
+        tail |= Q(customer_id=customer_id, pk__gt=last)
+    for row in WalletTransaction.objects.filter(tail).values("customer_id") \
+            .annotate(total=Sum("amount")).order_by():
+        balances[row["customer_id"]] += row["total"]
+    return balances
+
+
+def append(customer, amount, kind, lock=True):
+    """
+    Append a transaction of `amount` (negative for debits) to the ledger of a
+    customer. Without `lock` the caller holds the lock of lock_wallet already.
+    """
+    customer_id = getattr(customer, "pk", customer)
+    with transaction.atomic():
+        if lock:
+            lock_wallet(customer_id)
+        return WalletTransaction.objects.create(customer_id=customer_id, amount=amount, kind=kind)
+
+
+def append_many(amounts, kind, lock=True):
+    """
+    Append one transaction per customer from {customer_id: amount}, locking the
+    wallets in the order of their ids unless the caller holds the locks already.
+    """
+    with transaction.atomic():
+        if lock:
+            lock_wallets(amounts)
+        return WalletTransaction.objects.bulk_create([
+            WalletTransaction(customer_id=customer_id, amount=amount, kind=kind)
+            for customer_id, amount in sorted(amounts.items())])
+
+
+def open_wallets(amounts):
+    """
+    Opening deposits of new customers from {customer_id: amount}, written in bulk:
+    nobody else writes to a wallet that has just been created.
+    """
+    return WalletTransaction.objects.bulk_create([
+        WalletTransaction(customer_id=customer_id, amount=amount, kind=WalletTransaction.DEPOSIT)
+        for customer_id, amount in amounts.items() if amount])
+
+
+def deposit(customer, amount, kind=WalletTransaction.DEPOSIT):
+    if amount <= 0:
+        raise WalletError("A deposit must be positive")
+    return append(customer, amount, kind)
+
+
+def materialize(customer_ids=None, min_tail=MATERIALIZE_MIN_TAIL, batch_size=MATERIALIZE_BATCH_SIZE):
+    """
+    Fold the transactions after the snapshot into it for the customers with at
+    least `min_tail` of them, so that balance reads stay short. Return how many
+    snapshots were moved forward.
+    """
+    candidates = WalletTransaction.objects.all()
+    if customer_ids is not None:
+        candidates = candidates.filter(customer_id__in=customer_ids)
+    candidates = candidates.filter(pk__gt=_snapshot_last()).values("customer_id") \
+        .annotate(count=Count("pk")).filter(count__gte=max(min_tail, 1)) \
+        .order_by("customer_id").values_list("customer_id", flat=True)
+
+    moved = 0
+    customer_ids = list(candidates)
+    for start in range(0, len(customer_ids), batch_size):
+        batch = customer_ids[start:start + batch_size]
+        with transaction.atomic():
+            # the locks keep appends out, the tails are complete while they are held
+            lock_wallets(batch)
+            tails = {row["customer_id"]: row for row in WalletTransaction.objects
+                     .filter(customer_id__in=batch, pk__gt=_snapshot_last())
+                     .values("customer_id").annotate(total=Sum("amount"), last=Max("pk")).order_by()}
+            for customer_id, row in tails.items():
+                moved += WalletSnapshot.objects.filter(customer_id=customer_id, last_transaction_id__lt=row["last"]) \
+                    .update(balance=F("balance") + row["total"], last_transaction_id=row["last"],
+                            time_update=Now())
+    return moved
+
+
+def reconcile(customer_ids=None, repair=False):
+    """
+    Compare the snapshots with the sums of the ledger up to them in one query and
+    return the drifted ones as [(customer_id, snapshot balance, ledger balance)].
+    With `repair` the drifted snapshots are set to the ledger.
+    """
+    ledger = WalletTransaction.objects.filter(customer_id=OuterRef("customer_id"),
+                                              pk__lte=OuterRef("last_transaction_id")) \
+        .values("customer").annotate(total=Sum("amount")).values("total").order_by()
+    snapshots = WalletSnapshot.objects.all()
+    if customer_ids is not None:
+        snapshots = snapshots.filter(customer_id__in=customer_ids)
+    snapshots = snapshots.annotate(ledger=Coalesce(Subquery(ledger, output_field=MONEY),
+                                                   Value(ZERO), output_field=MONEY)) \
+        .filter(~Q(balance=F("ledger"))).order_by("customer_id")
+
+    drifted = [(customer_id, balance, ledger)
+               for customer_id, balance, ledger in snapshots.values_list("customer_id", "balance", "ledger")]
+    if repair:
+        for customer_id, _, ledger in drifted:
+            with transaction.atomic():
+                last = WalletSnapshot.objects.select_for_update() \
+                    .values_list("last_transaction_id", flat=True).get(customer_id=customer_id)
+                total = WalletTransaction.objects.filter(customer_id=customer_id, pk__lte=last) \
+                    .aggregate(total=Sum("amount"))["total"]
+                WalletSnapshot.objects.filter(customer_id=customer_id).update(balance=total or ZERO,
+                                                                              time_update=Now())
+    return drifted
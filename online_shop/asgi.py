@@ -14,3 +14,10 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'online_shop.settings')
 
 application = get_asgi_application()
+
+# the typeahead index is read from the database in the background by every
+# process on its first request, a preforking server may fork after this import
+from django.core.signals import request_started  # noqa: E402
+from e_shop.suggest import SUGGEST_INDEX  # noqa: E402
+
+request_started.connect(SUGGEST_INDEX.warm_up_process, dispatch_uid="suggest-warm-up")
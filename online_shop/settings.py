@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/4.0/ref/settings/
 """
 
+import json
 import os.path
 from datetime import timedelta
 from pathlib import Path
@@ -46,11 +47,13 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'e_shop.middleware.InstrumentationMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'e_shop.routers.ReplicaRoutingMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -90,6 +93,48 @@ DATABASES = {
     }
 }
 
+# Caches shared by the processes of the site: page versions and pages, held stock
+# and the typeahead generation live in 'default'. CACHE_LOCATION is a Redis URL from
+# the environment, e.g. CACHE_LOCATION='redis://cache:6379/0'. Without it every process
+# has a LocMem cache of its own, which is only right for a single process: the check
+# e_shop.E001 fails when WEB_CONCURRENCY (the worker count of gunicorn) is above 1
+CACHE_LOCATION = os.environ.get('CACHE_LOCATION')
+if CACHE_LOCATION:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': CACHE_LOCATION,
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+
+WEB_CONCURRENCY = int(os.environ.get('WEB_CONCURRENCY') or 1)
+
+# Read replicas of the default database as JSON from the environment, each one
+# overrides the settings of the default database, e.g.
+# DATABASE_REPLICAS='{"replica": {"HOST": "db-replica-1"}}'
+# Reads of catalog and history models in the safe requests of views with
+# read_replica = True go to a replica, a session that has just written reads from
+# the primary for PIN seconds, so do pages and ETags of a catalog version younger
+# than that. Clients without a session cookie are pinned by user in CACHE_ALIAS (unit: second)
+DATABASE_REPLICAS = json.loads(os.environ.get('DATABASE_REPLICAS') or '{}')
+for alias, overrides in DATABASE_REPLICAS.items():
+    DATABASES[alias] = {**DATABASES['default'], **overrides, 'TEST': {'MIRROR': 'default'}}
+
+DATABASE_ROUTERS = ['e_shop.routers.ReplicaRouter']
+
+READ_REPLICAS = {
+    'ALIASES': list(DATABASE_REPLICAS),
+    'MODELS': ['e_shop.product', 'e_shop.category', 'e_shop.purchase', 'e_shop.purchasereturns'],
+    'PIN': 5,
+    'CACHE_ALIAS': 'default',
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/4.0/ref/settings/#auth-password-validators
@@ -142,6 +187,105 @@ AUTH_USER_MODEL = 'e_shop.Customer'
 # Refund item setup (unit: minute)
 GUARANTEED_REFUND_PERIOD = 3
 
+# Bigger batches of refund approvals are run by background jobs of this size
+REFUND_INLINE_LIMIT = 100
+
+# Uploaded catalogs bigger than this are imported by a background job (unit: byte)
+IMPORT_INLINE_LIMIT = 1024 * 1024
+
+# Stock held for a customer before the checkout (unit: second), the held counts of
+# the product pages are cached in CACHE_ALIAS, the sweeper deletes expired holds in batches
+STOCK_RESERVATIONS = {
+    'TTL': 60 * 10,
+    'CACHE_ALIAS': 'default',
+    'CACHE_TIMEOUT': 60 * 10,
+    'SWEEP_BATCH_SIZE': 1000,
+}
+
+# Wallet ledger, balances are snapshots plus the transactions after them, the
+# materialize_wallets command folds tails of at least MATERIALIZE_MIN_TAIL transactions
+WALLET = {
+    'MATERIALIZE_MIN_TAIL': 20,
+    'MATERIALIZE_BATCH_SIZE': 500,
+}
+
+# Checkout retries on serialization failures and deadlocks (unit: second)
+CHECKOUT_RETRY = {
+    'ATTEMPTS': 5,
+    'BACKOFF': 0.01,
+}
+
+# Lifetime of DRF tokens and the in-process cache of validated tokens (unit: second),
+# revocations reach every process through a generation per user kept in CACHE_ALIAS
+TOKEN_AUTHENTICATION = {
+    'TIME_TO_LIVE': 60 * 10,
+    'CACHE_TIMEOUT': 60,
+    'CACHE_MAXSIZE': 10000,
+    'CACHE_ALIAS': 'default',
+}
+
+# Category sidebar cache setup (unit: second)
+# CACHE_ALIAS is a key of CACHES shared between processes, None keeps the cache per-process
+CATEGORY_SIDEBAR_CACHE = {
+    'CACHE_ALIAS': None,
+    'TIMEOUT': 60 * 5,
+    'MAXSIZE': 16,
+}
+
+# Resized copies of product photos, VARIANTS are the longest sides in pixels
+PRODUCT_PHOTO_PIPELINE = {
+    'VARIANTS': {'thumbnail': 300, 'card': 600, 'full': 1600},
+    'QUALITY': 82,
+}
+
+# Background jobs run by manage.py run_worker, failed attempts wait BACKOFF * 2 ** n
+# seconds up to MAX_BACKOFF, live workers renew the leases of their running jobs and
+# a job not renewed for LEASE is given to another worker. PERIODIC tasks are queued
+# again every so many seconds (unit: second)
+JOB_QUEUE = {
+    'WORKERS': 4,
+    'POLL_INTERVAL': 1,
+    'MAX_ATTEMPTS': 5,
+    'BACKOFF': 5,
+    'MAX_BACKOFF': 60 * 60,
+    'LEASE': 60 * 10,
+    'KEEP_FINISHED': 60 * 60 * 24 * 7,
+    'PERIODIC': {
+        'sweep_reservations': 60,
+        'materialize_wallets': 60 * 5,
+        'purge_tokens': 60 * 60,
+    },
+}
+
+# Page cache of the storefront for anonymous visitors (unit: second), the versions
+# of the models are kept in it too and a bump is seen by the processes sharing CACHE_ALIAS
+STOREFRONT_PAGE_CACHE = {
+    'CACHE_ALIAS': 'default',
+    'TIMEOUT': 60 * 10,
+}
+
+# In-memory typeahead of /api/products/suggest, loaded when the server starts.
+# Processes publish their changes in CACHE_ALIAS for LOG_TIMEOUT seconds and replay
+# the others' within REFRESH seconds, they reload when a change has expired meanwhile.
+PRODUCT_SUGGEST = {
+    'MAX_ENTRIES': 1000000,
+    'LIMIT': 10,
+    'REFRESH': 30,
+    'LOG_TIMEOUT': 60 * 10,
+    'CACHE_ALIAS': 'default',
+}
+
+# Per-request metrics, exported at /metrics for superusers and for the scrapers at
+# METRICS_ALLOWED_IPS. Behind a reverse proxy every request comes from the proxy's
+# address, so only list addresses that reach the application directly.
+# A share of requests is checked for the same query repeated THRESHOLD times (N+1)
+INSTRUMENTATION = {
+    'DUPLICATE_QUERY_SAMPLE_RATE': 0.1,
+    'DUPLICATE_QUERY_THRESHOLD': 3,
+    'MAX_FINGERPRINTS': 200,
+    'METRICS_ALLOWED_IPS': [],
+}
+
 REST_FRAMEWORK = {
     'DEFAULT_RENDERER_CLASSES': (
         'rest_framework.renderers.JSONRenderer',
@@ -22,25 +22,33 @@ from rest_framework.authtoken.views import obtain_auth_token
 from rest_framework_simplejwt.views import TokenObtainPairView, TokenRefreshView
 
 from online_shop import settings
-from e_shop.API.resources import RegisterView, LogoutView, LogoutAllView, \
-    ProductViewSet, PurchaseViewSet, CategoryViewSet, RefundPurchaseViewSet
+from e_shop.API.async_resources import product_list, product_detail, category_list
+from e_shop.API.suggestions import product_suggest
+from e_shop.API.resources import RegisterView, LogoutView, LogoutAllView, SalesReportView, \
+    ProductViewSet, PurchaseViewSet, CategoryViewSet, RefundPurchaseViewSet, ReservationViewSet
 
 router = routers.SimpleRouter()
 router.register('shop-home', ProductViewSet)
 router.register('category', CategoryViewSet)
 router.register('purchase', PurchaseViewSet)
 router.register('refund', RefundPurchaseViewSet)
+router.register('reservation', ReservationViewSet, basename='reservation')
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('', include('e_shop.urls')),
     path('api/', include(router.urls)),
+    path('api/async/shop-home/', product_list, name='async-product-list'),
+    path('api/async/shop-home/<int:pk>/', product_detail, name='async-product-detail'),
+    path('api/async/category/', category_list, name='async-category-list'),
+    path('api/products/suggest', product_suggest, name='product-suggest'),
     path('api-token-auth/', obtain_auth_token),
     path('api/login/token-jwd/', TokenObtainPairView.as_view()),
     path('api/login/token-jwd/refresh/', TokenRefreshView.as_view()),
     path('api/logout/', LogoutView.as_view()),
     path('api/logout-all/', LogoutAllView.as_view()),
     path('api/register/', RegisterView.as_view()),
+    path('api/analytics/sales/', SalesReportView.as_view()),
 ]
 
 if settings.DEBUG: